@@ -1,14 +1,298 @@
+import ipaddress
+import re
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib import admin
-from .models import WifiSession, PaymentPlan
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.http import Http404, HttpResponseRedirect, StreamingHttpResponse
+from django.template.defaultfilters import filesizeformat
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.html import format_html
+from .models import Payment, PaymentPlan, RevenueRollup, UsageSample, VoucherBatch, WifiSession
+from .authcache import authorization_cache
+from .gateways import gateway_events
+from .expiry import notify_expiry_scheduler
+from .keyset import KeysetChangeList
+from .ledger import revenue_report
+from .macaddr import prefix_range
+from .metering import usage_since
+from .provisioning import provisioning_queue
+from .vouchers import csv_export, sheet_export
+
+IP_PREFIX_RE = re.compile(r'[0-9]{1,3}(\.[0-9]{0,3}){0,3}|[0-9a-f:]*:[0-9a-f:]*', re.IGNORECASE)
+
+
+def high_volume_admin():
+    return getattr(settings, 'WIFISESSION_ADMIN_HIGH_VOLUME', True)
+
+
+def indexed_search(search_term):
+    """Q matching `search_term` exactly or by prefix on indexed columns, or None"""
+    term = search_term.strip()
+    if not term:
+        return None
+    conditions = []
+    try:
+        conditions.append(Q(session_id=uuid.UUID(term)))
+    except ValueError:
+        pass
+    try:
+        conditions.append(Q(ip_address=str(ipaddress.ip_address(term))))
+    except ValueError:
+        if IP_PREFIX_RE.fullmatch(term):
+            # '10.0.3.' -> '10.0.3.' <= ip < '10.0.3/' - a range on the ip_address index
+            # (LIKE 'x%' can't use it: Django's LIKE ... ESCAPE disables SQLite's optimization)
+            term_lower = term.lower()
+            conditions.append(Q(ip_address__gte=term_lower, ip_address__lt=term_lower[:-1] + chr(ord(term_lower[-1]) + 1)))
+    try:
+        prefix_range(term)
+        conditions.append(Q(mac_address__prefix=term))
+    except ValueError:
+        pass
+    if not conditions:
+        return None
+    query = conditions[0]
+    for condition in conditions[1:]:
+        query |= condition
+    return query
 
 @admin.register(WifiSession)
 class WifiSessionAdmin(admin.ModelAdmin):
-    list_display = ['mac_address', 'ip_address', 'is_paid', 'payment_amount', 'created_at', 'expires_at']
-    list_filter = ['is_paid', 'is_active', 'created_at']
-    search_fields = ['mac_address', 'ip_address']
-    readonly_fields = ['session_id', 'created_at']
+    list_display = ['mac_address', 'ip_address', 'is_paid', 'payment_amount', 'created_at', 'expires_at', 'access_status']
+    list_filter = ['is_paid', 'is_active', 'access_status', 'created_at']
+    search_fields = ['ip_address']
+    readonly_fields = ['session_id', 'created_at', 'access_status', 'access_error', 'data_used_24h']
+    actions = ['retry_provisioning']
+    search_help_text = 'Session ID, IP address or prefix (10.0.3.), MAC address or prefix (aa:bb:cc)'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList if high_volume_admin() else super().get_changelist(request, **kwargs)
+
+    def get_sortable_by(self, request):
+        # Every ordering but the (created_at, id) keyset would sort the whole table
+        return () if high_volume_admin() else super().get_sortable_by(request)
+
+    def get_search_results(self, request, queryset, search_term):
+        if high_volume_admin():
+            if not search_term.strip():
+                return queryset, False
+            query = indexed_search(search_term)
+            return (queryset.none() if query is None else queryset.filter(query)), False
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        term = search_term.strip()
+        try:
+            prefix_range(term)
+        except ValueError:
+            return results, may_have_duplicates
+        # Whole or partial MAC in any notation: a range scan on the integer column
+        return results | queryset.filter(mac_address__prefix=term), may_have_duplicates
+
+    @admin.display(description='Data used (24h)')
+    def data_used_24h(self, obj):
+        # Change form only - one indexed read of the device's hourly usage samples
+        usage = usage_since(obj.mac_address, timezone.now() - timedelta(hours=24)) if obj.pk else None
+        return filesizeformat(usage[0]) if usage else '-'
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        authorization_cache.invalidate(obj.mac_address)
+        notify_expiry_scheduler(obj.mac_address, obj.expires_at if obj.is_active else None)
+        if obj.is_active and obj.is_paid:
+            gateway_events.grant(obj.mac_address, obj.ip_address, obj.expires_at)
+        else:
+            gateway_events.revoke([(obj.mac_address, obj.ip_address)])
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        authorization_cache.invalidate(obj.mac_address)
+        gateway_events.revoke([(obj.mac_address, obj.ip_address)])
+
+    def delete_queryset(self, request, queryset):
+        # "Delete selected" - delete_model isn't called per object
+        entries = list(queryset.values_list('mac_address', 'ip_address'))
+        super().delete_queryset(request, queryset)
+        for mac_address, _ip_address in entries:
+            authorization_cache.invalidate(mac_address)
+        gateway_events.revoke(entries)
+
+    @admin.action(description='Retry access provisioning')
+    def retry_provisioning(self, request, queryset):
+        sessions = queryset.filter(is_active=True, is_paid=True)
+        sessions.update(access_status='pending', access_error='')
+        for session in sessions:
+            provisioning_queue.submit(session)
+        self.message_user(request, f'Queued provisioning for {len(sessions)} sessions')
 
 @admin.register(PaymentPlan)
 class PaymentPlanAdmin(admin.ModelAdmin):
     list_display = ['name', 'price', 'duration_hours', 'is_active']
     list_filter = ['is_active']
+
+@admin.register(Payment)
+class PaymentAdmin(admin.ModelAdmin):
+    """The ledger is append-only: browse and search, never edit"""
+    list_display = ['reference', 'mac_address', 'plan', 'amount', 'created_at']
+    list_filter = ['plan', 'created_at']
+    search_fields = ['reference']
+    search_help_text = 'Payment reference, MAC address or prefix'
+    list_select_related = ['plan']
+    sortable_by = ()
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        query = Q(reference=term)
+        try:
+            prefix_range(term)
+            query |= Q(mac_address__prefix=term)
+        except ValueError:
+            pass
+        return queryset.filter(query), False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(RevenueRollup)
+class RevenueRollupAdmin(admin.ModelAdmin):
+    """Revenue report - reads RevenueRollup only, so its cost doesn't grow with the ledger"""
+    PERIODS = {'day': 30, 'hour': 48}  # period -> buckets shown
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        period = request.GET.get('period') if request.GET.get('period') in self.PERIODS else 'day'
+        plans, rows = revenue_report(period, self.PERIODS[period])
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Revenue',
+            'opts': self.model._meta,
+            'period': period,
+            'periods': list(self.PERIODS),
+            'plans': plans,
+            'rows': [
+                (start, [by_plan.get(plan.id, (0, 0)) for plan in plans], revenue, purchases)
+                for start, by_plan, revenue, purchases in rows
+            ],
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, 'admin/billing_app/revenuerollup/report.html', context)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(UsageSample)
+class UsageSampleAdmin(admin.ModelAdmin):
+    """Metered usage (billing_app/metering.py) - one resolution at a time, newest buckets first"""
+    list_display = ['mac_address', 'bucket_start', 'resolution', 'data', 'packets']
+    list_filter = ['resolution']
+    search_fields = ['mac_address']
+    search_help_text = 'MAC address or prefix'
+    sortable_by = ()
+    keyset_field = 'bucket_start'
+
+    @admin.display(description='Data')
+    def data(self, obj):
+        return filesizeformat(obj.bytes)
+
+    def changelist_view(self, request, extra_context=None):
+        # Keyset pages walk usage_resolution_bucket_idx, which needs a resolution - hourly by default
+        if 'resolution__exact' not in request.GET:
+            params = request.GET.copy()
+            params['resolution__exact'] = UsageSample.HOURLY
+            return HttpResponseRedirect(f'{request.path}?{params.urlencode()}')
+        return super().changelist_view(request, extra_context)
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        try:
+            prefix_range(term)
+        except ValueError:
+            return queryset.none(), False
+        return queryset.filter(mac_address__prefix=term), False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+@admin.register(VoucherBatch)
+class VoucherBatchAdmin(admin.ModelAdmin):
+    """Voucher print runs - created by `manage.py generate_vouchers`, exported as streamed CSV/HTML"""
+    list_display = ['id', 'label', 'plan', 'count', 'created_at', 'expires_at', 'is_active', 'exports']
+    list_filter = ['is_active', 'plan']
+    list_select_related = ['plan']
+    fields = ['plan', 'label', 'count', 'created_at', 'expires_at', 'is_active', 'exports']
+    readonly_fields = ['plan', 'count', 'created_at', 'exports']
+
+    @admin.display(description='Export')
+    def exports(self, obj):
+        if not obj.pk:
+            return '-'
+        return format_html(
+            '<a href="{}">CSV</a> | <a href="{}" target="_blank">Print sheet</a>',
+            reverse('admin:billing_app_voucherbatch_csv', args=[obj.pk]),
+            reverse('admin:billing_app_voucherbatch_sheet', args=[obj.pk]),
+        )
+
+    def get_urls(self):
+        return [
+            path('<int:pk>/export.csv', self.admin_site.admin_view(self.export_csv), name='billing_app_voucherbatch_csv'),
+            path('<int:pk>/sheet.html', self.admin_site.admin_view(self.export_sheet), name='billing_app_voucherbatch_sheet'),
+            *super().get_urls(),
+        ]
+
+    def exportable(self, request, pk):
+        # The codes themselves - only for staff who may change batches
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        batch = self.get_object(request, pk)
+        if batch is None:
+            raise Http404(f'No voucher batch {pk}')
+        return batch
+
+    def export_csv(self, request, pk):
+        batch = self.exportable(request, pk)
+        response = StreamingHttpResponse(csv_export(batch), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="vouchers-{batch.pk}.csv"'
+        return response
+
+    def export_sheet(self, request, pk):
+        batch = self.exportable(request, pk)
+        return StreamingHttpResponse(sheet_export(batch), content_type='text/html; charset=utf-8')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        # Redeemed vouchers back ledger payments - void a batch with is_active instead
+        return False
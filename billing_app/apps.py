@@ -1,6 +1,23 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class BillingAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'billing_app'
+
+    def ready(self):
+        from .plans import install_signal_handlers
+        install_signal_handlers()
+
+        from .metrics import install_collectors, install_query_counter
+        install_query_counter()
+        install_collectors()
+
+        if getattr(settings, 'FIREWALL_RECONCILE_ON_STARTUP', False):
+            from .reconcile import install_startup_hook
+            install_startup_hook()
+
+        if getattr(settings, 'GATEWAY_BUS_URL', None):
+            from .gateways import install_listener
+            install_listener()
@@ -0,0 +1,293 @@
+"""
+Lean, fingerprinted, precompressed asset bundle for the portal pages.
+
+static/ still holds the whole template theme, and every portal landing
+requested its CSS, scripts and images over the throttled pre-auth link.
+In development they came from the static() route, uncompressed and with
+no cache headers, so a phone re-fetched them all on every visit.
+
+`manage.py build_portal_assets` builds a separate bundle in
+PORTAL_ASSET_ROOT:
+
+- It follows PORTAL_TEMPLATES through {% extends %}/{% include %} and
+  collects only the files their {% static %} tags name, plus what those
+  stylesheets pull in with url() and @import.
+- It minifies stylesheets. Scripts are minified with rjsmin when it is
+  installed; files already shipped as *.min.* are left alone.
+- It names each file after its content hash (style.3f2a9c0d41be.css) and
+  rewrites stylesheet url()s to the hashed names.
+- It writes .gz and, when the brotli package is installed, .br copies of
+  every compressible file.
+- It records everything in manifest.json.
+
+With PORTAL_ASSETS_SERVE on, {% static %} emits the hashed URLs (see
+PortalAssetStorage), and serve_asset answers them. The response is the
+.br/.gz variant the client's Accept-Encoding allows, with a year-long
+immutable Cache-Control: a changed file gets a new name, so a cached copy
+is never stale. nginx can serve the same directory instead with
+`gzip_static on` (and `brotli_static on`).
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import posixpath
+import re
+import shutil
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import StaticFilesStorage
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.template.loader import get_template
+
+try:
+    import brotli
+except ImportError:  # .br variants are skipped
+    brotli = None
+
+try:
+    import rjsmin
+except ImportError:  # scripts are copied as they are
+    rjsmin = None
+
+DEFAULT_TEMPLATES = ('login.html', 'payment.html', 'success.html', 'error.html')
+MANIFEST_NAME = 'manifest.json'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.webmanifest', '.ico', '.ttf', '.eot', '.txt', '.html'}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+STATIC_TAG_RE = re.compile(r"""{%\s*static\s+['"]([^'"]+)['"]\s*%}""")
+TEMPLATE_TAG_RE = re.compile(r"""{%\s*(?:extends|include)\s+['"]([^'"]+)['"]""")
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)|@import\s+(['"])([^'"]+)\3""")
+CSS_TOKEN_RE = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/""", re.S)
+
+
+def asset_root():
+    return Path(getattr(settings, 'PORTAL_ASSET_ROOT', Path(settings.BASE_DIR) / 'portal_assets'))
+
+
+def serving():
+    return getattr(settings, 'PORTAL_ASSETS_SERVE', False)
+
+
+def template_assets(name, seen=None):
+    """Static paths a template and the templates it extends/includes reference, in order"""
+    seen = set() if seen is None else seen
+    if name in seen:
+        return []
+    seen.add(name)
+    source = Path(get_template(name).origin.name).read_text()
+    paths = []
+    for parent in TEMPLATE_TAG_RE.findall(source):
+        paths += template_assets(parent, seen)
+    paths += STATIC_TAG_RE.findall(source)
+    return list(dict.fromkeys(paths))
+
+
+def split_css_url(css_path, url):
+    """(static path, '?query#fragment') for a url()/@import in `css_path`; None for external ones"""
+    if url.startswith(('data:', 'http:', 'https:', '//', '#')):
+        return None
+    path = re.split(r'[?#]', url, maxsplit=1)[0]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(css_path), path)), url[len(path):]
+
+
+def minify_css(text):
+    """Drop comments and redundant whitespace - strings are left untouched"""
+    strings = []
+
+    def hold(match):
+        if match.group(1) is None:
+            return ''  # a comment
+        strings.append(match.group(1))
+        return f'\x00{len(strings) - 1}\x00'
+
+    code = re.sub(r'\s+', ' ', CSS_TOKEN_RE.sub(hold, text))
+    code = re.sub(r'\s*([{};,>])\s*', r'\1', code).replace(';}', '}').strip()
+    return re.sub(r'\x00(\d+)\x00', lambda match: strings[int(match.group(1))], code)
+
+
+def minify_js(name, text):
+    if rjsmin is None or name.endswith('.min.js'):
+        return text
+    return rjsmin.jsmin(text)
+
+
+def hashed_name(name, content):
+    root, ext = posixpath.splitext(name)
+    return f'{root}.{hashlib.md5(content).hexdigest()[:12]}{ext}'
+
+
+class AssetBuilder:
+    """Writes the bundle for `templates` into `root` and returns its manifest"""
+
+    def __init__(self, templates=None, root=None):
+        self.templates = list(templates or getattr(settings, 'PORTAL_TEMPLATES', DEFAULT_TEMPLATES))
+        self.root = Path(root or asset_root())
+        self.paths = {}  # static path -> hashed path
+        self.files = {}  # hashed path -> {'size', 'encodings', 'content_type'}
+        self.sources = {}  # static path -> size in static/
+        self.missing = []
+        self._building = set()  # stylesheets mid-rewrite - breaks @import cycles
+
+    def build(self):
+        staging = self.root.with_name(self.root.name + '.tmp')
+        shutil.rmtree(staging, ignore_errors=True)
+        self.out = staging
+        pages = {}
+        for template in self.templates:
+            pages[template] = template_assets(template)
+            for path in pages[template]:
+                self.add(path)
+        manifest = {
+            'paths': self.paths, 'files': self.files, 'sources': self.sources,
+            'templates': pages, 'missing': self.missing,
+        }
+        staging.mkdir(parents=True, exist_ok=True)
+        (staging / MANIFEST_NAME).write_text(json.dumps(manifest, indent=1, sort_keys=True))
+        # Swap the whole bundle at once, so the manifest never names a file that isn't there
+        previous = self.root.with_name(self.root.name + '.old')
+        shutil.rmtree(previous, ignore_errors=True)
+        if self.root.exists():
+            self.root.rename(previous)
+        staging.rename(self.root)
+        shutil.rmtree(previous, ignore_errors=True)
+        return manifest
+
+    def add(self, path):
+        """Build `path` (and, for stylesheets, what it references first); returns its hashed path"""
+        if path in self.paths or path in self._building:
+            return self.paths.get(path)
+        source = finders.find(path)
+        if source is None:
+            if path not in self.missing:
+                self.missing.append(path)
+            return None
+        content = Path(source).read_bytes()
+        self.sources[path] = len(content)
+        ext = posixpath.splitext(path)[1]
+        if ext == '.css':
+            self._building.add(path)
+            content = self.rewrite_css(path, content.decode('utf-8', 'surrogateescape')).encode('utf-8', 'surrogateescape')
+            self._building.discard(path)
+        elif ext == '.js':
+            content = minify_js(path, content.decode('utf-8', 'surrogateescape')).encode('utf-8', 'surrogateescape')
+
+        hashed = hashed_name(path, content)
+        self.paths[path] = hashed
+        self.files[hashed] = self.write(hashed, content)
+        return hashed
+
+    def rewrite_css(self, path, text):
+        """Minified stylesheet whose url()s point at the hashed names (commented-out ones are gone first)"""
+        def rewrite(match):
+            url = match.group(2) or match.group(4)
+            local = split_css_url(path, url)
+            hashed = self.add(local[0]) if local else None
+            if hashed is None:
+                return match.group(0)
+            # Keeps ?#iefix / #fontawesome
+            return match.group(0).replace(url, posixpath.relpath(hashed, posixpath.dirname(path)) + local[1], 1)
+
+        return CSS_URL_RE.sub(rewrite, minify_css(text))
+
+    def write(self, hashed, content):
+        target = self.out / hashed
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_bytes(content)
+        entry = {
+            'size': len(content), 'encodings': {},
+            'content_type': mimetypes.guess_type(hashed)[0] or 'application/octet-stream',
+        }
+        if posixpath.splitext(hashed)[1] in COMPRESSIBLE:
+            variants = {'gzip': ('.gz', lambda data: gzip.compress(data, 9, mtime=0))}
+            if brotli is not None:
+                variants['br'] = ('.br', lambda data: brotli.compress(data, quality=11))
+            for encoding, (suffix, compress) in variants.items():
+                packed = compress(content)
+                if len(packed) < len(content) * 0.9:  # not worth a variant otherwise
+                    Path(f'{target}{suffix}').write_bytes(packed)
+                    entry['encodings'][encoding] = len(packed)
+        return entry
+
+
+class PortalAssets:
+    """The built manifest, loaded once per process"""
+
+    def __init__(self, root=None):
+        self._root = root
+        self._manifest = None
+        self._lock = threading.Lock()
+
+    @property
+    def root(self):
+        return Path(self._root or asset_root())
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            with self._lock:
+                if self._manifest is None:
+                    try:
+                        self._manifest = json.loads((self.root / MANIFEST_NAME).read_text())
+                    except FileNotFoundError:
+                        self._manifest = {'paths': {}, 'files': {}}
+        return self._manifest
+
+    def reload(self):
+        self._manifest = None
+
+    def hashed(self, path):
+        return self.manifest['paths'].get(path)
+
+    def entry(self, hashed):
+        return self.manifest['files'].get(hashed)
+
+
+portal_assets = PortalAssets()
+
+
+class PortalAssetStorage(StaticFilesStorage):
+    """{% static %} resolves to the fingerprinted bundle when PORTAL_ASSETS_SERVE is on"""
+
+    def url(self, name):
+        if serving():
+            name = portal_assets.hashed(name) or name
+        return super().url(name)
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def serve_asset(request, path):
+    """A fingerprinted bundle file, precompressed per Accept-Encoding, cacheable forever"""
+    entry = portal_assets.entry(path) if serving() else None
+    if entry is None:
+        raise Http404(path)
+    etag = f'"{path.rsplit(".", 2)[-2]}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding', ''))
+        encoding = next((coding for coding in ('br', 'gzip') if coding in accepted and coding in entry['encodings']), None)
+        suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+        try:
+            response = FileResponse(open(portal_assets.root / f'{path}{suffix}', 'rb'),
+                                    content_type=entry['content_type'])
+        except FileNotFoundError:
+            raise Http404(path)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
@@ -0,0 +1,163 @@
+"""
+Per-process authorization cache for CaptivePortalMiddleware.
+
+Maps a device MAC to "authorized until <deadline>". Positive entries live
+until the session's expires_at, but at most AUTH_CACHE_POSITIVE_TTL
+seconds. Negative entries (unknown or unpaid devices) live only for a short
+TTL. The cache is bounded with LRU eviction. It is invalidated explicitly
+whenever a session's paid/active state changes (see process_payment and the
+cleanup commands). That only reaches other processes (the cleanup cron,
+the expiry scheduler, admin saves in another worker) through the gateway
+bus. Without GATEWAY_BUS_URL, the positive TTL bounds how long a revoked
+device stays authorized in a web worker.
+
+preload() loads every authorized device at once. Until a MAC is
+invalidated or evicted, a device the preload did not include is then
+known to be unauthorized, so decision() answers without a query
+(see probes.py).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class AuthorizationCache:
+    """Expiry-driven, LRU-capped MAC -> authorized cache"""
+
+    def __init__(self, max_entries=None, negative_ttl=None, positive_ttl=None, clock=time.time):
+        self.max_entries = (
+            max_entries if max_entries is not None
+            else getattr(settings, 'AUTH_CACHE_MAX_ENTRIES', 10000)
+        )
+        self.negative_ttl = (
+            negative_ttl if negative_ttl is not None
+            else getattr(settings, 'AUTH_CACHE_NEGATIVE_TTL', 5)
+        )
+        # 0 / None in settings = entries live until expires_at (invalidations arrive over the gateway bus)
+        self.positive_ttl = (
+            positive_ttl if positive_ttl is not None
+            else getattr(settings, 'AUTH_CACHE_POSITIVE_TTL', 5)
+        )
+        self.clock = clock
+        self._entries = OrderedDict()  # mac -> (authorized, valid_until, capped)
+        self._lock = threading.Lock()
+        self._complete = False  # every authorized device is in _entries
+        self._loading = False
+        self._changes = 0
+        self._dropped = {}  # mac -> _changes at invalidation/eviction since the last preload
+        self.preloaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, mac):
+        """Return True/False for a cached decision, None when the DB must be asked"""
+        with self._lock:
+            entry = self._entries.get(mac)
+            if entry is None:
+                self.misses += 1
+                return None
+            authorized, valid_until, capped = entry
+            if valid_until <= self.clock():
+                del self._entries[mac]
+                if capped:
+                    self._drop(mac)  # still paid as far as we know - ask the DB, don't assume unauthorized
+                self.misses += 1
+                return None
+            self._entries.move_to_end(mac)
+            self.hits += 1
+            return authorized
+
+    def set_authorized(self, mac, expires_at):
+        """Cache a paid session until its expires_at (an aware datetime), at most positive_ttl"""
+        with self._lock:
+            self._put_authorized(mac, expires_at.timestamp())
+
+    def _put_authorized(self, mac, expires):
+        if self.positive_ttl and self.clock() + self.positive_ttl < expires:
+            self._put_locked(mac, True, self.clock() + self.positive_ttl, capped=True)
+        else:
+            self._put_locked(mac, True, expires)
+
+    def set_unauthorized(self, mac):
+        """Cache a negative decision for unknown/unpaid devices"""
+        self._put(mac, False, self.clock() + self.negative_ttl)
+
+    def store_session(self, mac, session):
+        """Cache the decision the middleware would take for `session` (None = unknown device)"""
+        if (session is not None and
+                session.is_paid and
+                session.is_active and
+                session.expires_at and
+                session.expires_at.timestamp() > self.clock()):
+            self.set_authorized(mac, session.expires_at)
+            return True
+        self.set_unauthorized(mac)
+        return False
+
+    def _put(self, mac, authorized, valid_until):
+        with self._lock:
+            self._put_locked(mac, authorized, valid_until)
+
+    def _put_locked(self, mac, authorized, valid_until, capped=False):
+        self._entries[mac] = (authorized, valid_until, capped)
+        self._entries.move_to_end(mac)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._drop(evicted)
+            self.evictions += 1
+
+    def _drop(self, mac):
+        self._changes += 1
+        if self._complete or self._loading:
+            self._dropped[mac] = self._changes
+
+    def invalidate(self, mac):
+        with self._lock:
+            self._entries.pop(mac, None)
+            self._drop(mac)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dropped.clear()
+            self._complete = self._loading = False
+            self.preloaded_at = None
+
+    def begin_preload(self):
+        """Token to pass to preload() - take it before reading the sessions"""
+        with self._lock:
+            self._loading = True
+            return self._changes
+
+    def preload(self, entries, token):
+        """Cache every authorized (mac, expires_at) at once; MACs changed since `token` stay unknown"""
+        now = self.clock()
+        with self._lock:
+            self._dropped = {mac: change for mac, change in self._dropped.items() if change > token}
+            for mac, expires_at in entries:
+                if mac not in self._dropped and expires_at.timestamp() > now:
+                    self._put_authorized(mac, expires_at.timestamp())
+            self._complete = True
+            self._loading = False
+            self.preloaded_at = now
+
+    def decision(self, mac):
+        """get(), except that after a preload a device not among the authorized is False, not None"""
+        authorized = self.get(mac)
+        if authorized is None and self._complete and mac not in self._dropped:
+            return False
+        return authorized
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+authorization_cache = AuthorizationCache()
@@ -0,0 +1,58 @@
+"""
+Precompiled captive-portal bypass matcher.
+
+should_bypass used to loop over path prefixes and then run a full
+django.urls.resolve() for every request that missed them. BypassMatcher
+folds the prefixes and the URL patterns behind the bypass URL names into a
+single anchored regex once, so a bypass decision is one regex match.
+"""
+import re
+
+from django.urls import get_resolver
+
+# Named groups can't repeat inside one alternation; we only need to match
+NAMED_GROUP_RE = re.compile(r'\(\?P<\w+>')
+
+
+def _namespace(resolver, namespaces):
+    """Walk nested namespaces, returning the combined prefix regex and the inner resolver"""
+    prefix = ''
+    for namespace in namespaces:
+        ns_prefix, resolver = resolver.namespace_dict[namespace]
+        prefix += ns_prefix
+    return prefix, resolver
+
+
+def _patterns_for(resolver, url_name):
+    """Return the path_info regexes (without leading '/') a URL name can resolve to"""
+    *namespaces, name = url_name.split(':')
+    prefix, resolver = _namespace(resolver, namespaces)
+    return [prefix + pattern for _bits, pattern, _defaults, _converters in resolver.reverse_dict.getlist(name)]
+
+
+class BypassMatcher:
+    """Single-regex match for bypass prefixes, URL names and namespaces"""
+
+    def __init__(self, prefixes=(), url_names=(), namespaces=(), urlconf=None):
+        resolver = get_resolver(urlconf)
+        alternatives = [re.escape(prefix) for prefix in prefixes]
+
+        for url_name in url_names:
+            try:
+                patterns = _patterns_for(resolver, url_name)
+            except KeyError:
+                patterns = []
+            # Exact match - the pattern carries its own end anchor (\Z)
+            alternatives.extend('/' + NAMED_GROUP_RE.sub('(?:', p) for p in patterns)
+
+        for namespace in namespaces:
+            try:
+                prefix, _ = _namespace(resolver, namespace.split(':'))
+                alternatives.append('/' + NAMED_GROUP_RE.sub('(?:', prefix))
+            except KeyError:
+                pass
+
+        self.regex = re.compile('|'.join(f'(?:{alt})' for alt in alternatives)) if alternatives else None
+
+    def matches(self, path):
+        return bool(self.regex and self.regex.match(path))
@@ -0,0 +1,126 @@
+"""
+Bulk cleanup of expired sessions.
+
+The cron cleanup used to load every expired session, revoke access one
+device at a time and save() each row in full, holding SQLite's write lock
+for minutes after any downtime. Here expired sessions are read in
+bounded chunks: each chunk is deactivated with a single conditional
+UPDATE ... WHERE id IN (...), and the rows it changed are revoked in one
+firewall batch (or a bounded thread pool for per-device methods).
+"""
+import logging
+import time
+from dataclasses import dataclass
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .authcache import authorization_cache
+from .gateways import gateway_events
+from .models import WifiSession
+from .views import block_internet_access_bulk
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CleanupReport:
+    dry_run: bool = False
+    expired: int = 0
+    failed: int = 0
+    chunks: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rate(self):
+        """Sessions handled per second"""
+        return self.expired / self.elapsed if self.elapsed else 0.0
+
+
+def expired_sessions(now=None, limit=None):
+    """(id, mac_address, ip_address) of active sessions past expires_at, longest expired first"""
+    now = now or timezone.now()
+    # Ordered like wifisession_active_expiry_idx, so the rows stream straight off the index
+    sessions = WifiSession.objects.filter(is_active=True, expires_at__lt=now).order_by(
+        'expires_at', 'id'
+    ).values_list('id', 'mac_address', 'ip_address')
+    return sessions[:limit] if limit else sessions
+
+
+def deactivate_expired(ids, now):
+    """Deactivate those of `ids` still active and expired at `now`; returns the ids this UPDATE changed"""
+    if not ids:
+        return set()
+    if connection.vendor in ('sqlite', 'postgresql') and connection.features.can_return_rows_from_bulk_insert:
+        # UPDATE ... RETURNING (SQLite >= 3.35): exactly the rows this statement flipped, not
+        # ones a concurrent revoke or an admin deactivated in the meantime
+        qn = connection.ops.quote_name
+        fields = {name: WifiSession._meta.get_field(name) for name in ('id', 'is_active', 'expires_at')}
+        column = {name: qn(field.column) for name, field in fields.items()}
+        sql = (
+            f'UPDATE {qn(WifiSession._meta.db_table)} SET {column["is_active"]} = %s '
+            f'WHERE {column["id"]} IN ({", ".join(["%s"] * len(ids))}) '
+            f'AND {column["is_active"]} = %s AND {column["expires_at"]} <= %s RETURNING {column["id"]}'
+        )
+        params = [False, *ids, True, fields['expires_at'].get_db_prep_value(now, connection)]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return {row[0] for row in cursor.fetchall()}
+    with transaction.atomic():
+        changed = set(WifiSession.objects.select_for_update().filter(
+            id__in=ids, is_active=True, expires_at__lte=now,
+        ).values_list('id', flat=True))
+        WifiSession.objects.filter(id__in=changed).update(is_active=False)
+    return changed
+
+
+def expired_chunks(now, size, limit=None, dry_run=False):
+    """Expired sessions as lists of at most `size` rows, each read in full before it is acted on"""
+    handled = 0
+    while limit is None or handled < limit:
+        wanted = size if limit is None else min(size, limit - handled)
+        # A real run deactivates each chunk, so the next one is at the front again
+        start = handled if dry_run else 0
+        chunk = list(expired_sessions(now)[start:start + wanted])
+        if chunk:
+            yield chunk
+        if len(chunk) < wanted:
+            return
+        handled += len(chunk)
+
+
+def cleanup_expired_sessions(chunk_size=500, limit=None, dry_run=False, max_workers=8, now=None, on_chunk=None):
+    """Revoke and deactivate expired sessions chunk by chunk; on_chunk(rows, results) sees each one"""
+    report = CleanupReport(dry_run=dry_run)
+    started = time.perf_counter()
+    now = now or timezone.now()
+
+    for chunk in expired_chunks(now, chunk_size, limit, dry_run):
+        if dry_run:
+            results = [None] * len(chunk)
+        else:
+            # Deactivate only what is still expired - a session renewed since the read keeps
+            # its access - and then revoke exactly the rows this UPDATE changed. Deactivated
+            # even if the revoke fails: reconcile_firewall removes leftover rules
+            changed = deactivate_expired([row[0] for row in chunk], now)
+            chunk = [row for row in chunk if row[0] in changed]
+            results = block_internet_access_bulk(
+                [(mac_address, ip_address) for _id, mac_address, ip_address in chunk],
+                max_workers=max_workers,
+            )
+            for _id, mac_address, _ip_address in chunk:
+                authorization_cache.invalidate(mac_address)
+            gateway_events.revoke((mac_address, ip_address) for _id, mac_address, ip_address in chunk)
+
+        report.chunks += 1
+        report.expired += len(chunk)
+        report.failed += results.count(False)
+        if on_chunk:
+            on_chunk(chunk, results)
+
+    report.elapsed = time.perf_counter() - started
+    logger.info(
+        f"Session cleanup: expired={report.expired} failed={report.failed} chunks={report.chunks} "
+        f"elapsed={report.elapsed:.2f}s dry_run={report.dry_run}"
+    )
+    return report
@@ -0,0 +1,152 @@
+"""
+Event-driven session expiry.
+
+Instead of a cron job polling for expired sessions (and leaving access open
+for up to a full cron interval), run_expiry_scheduler keeps the upcoming
+deadlines in a min-heap and sleeps until the next one. New and extended
+sessions reach it as a small UDP datagram sent by notify_expiry_scheduler,
+so the table is only queried for a bounded look-ahead window.
+"""
+import heapq
+import json
+import logging
+import socket
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .authcache import authorization_cache
+from .gateways import gateway_events
+from .models import WifiSession
+
+logger = logging.getLogger(__name__)
+
+
+def scheduler_address():
+    return getattr(settings, 'EXPIRY_SCHEDULER_ADDRESS', ('127.0.0.1', 8765))
+
+
+def notify_expiry_scheduler(mac_address, expires_at):
+    """Tell a running scheduler about a new/changed deadline (fire and forget)"""
+    address = scheduler_address()
+    if not address:
+        return
+    message = json.dumps({
+        'mac': mac_address,
+        'expires_at': expires_at.timestamp() if expires_at else None,
+    }).encode()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(message, tuple(address))
+    except OSError as e:
+        # Scheduler down - its periodic window reload will still pick this up
+        logger.debug(f"Expiry scheduler notification failed: {e}")
+
+
+class ExpiryScheduler:
+    """Min-heap of session deadlines with lazy deletion for extended sessions"""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._heap = []
+        self._deadlines = {}  # mac -> current deadline (epoch seconds)
+        self.lateness = []  # seconds each revocation fired after expires_at
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def schedule(self, mac_address, deadline):
+        """Add or move a deadline; None removes it (session gone or unpaid)"""
+        if deadline is None:
+            self._deadlines.pop(mac_address, None)
+            return
+        if self._deadlines.get(mac_address) == deadline:
+            return
+        self._deadlines[mac_address] = deadline
+        heapq.heappush(self._heap, (deadline, mac_address))
+
+    def handle_datagram(self, data):
+        try:
+            message = json.loads(data)
+            self.schedule(message['mac'], message.get('expires_at'))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring malformed expiry notification: {e}")
+
+    def load_window(self, horizon):
+        """Schedule every active session expiring within `horizon` seconds (overdue included)"""
+        until = timezone.now() + timedelta(seconds=horizon)
+        sessions = WifiSession.objects.filter(is_active=True, expires_at__lte=until).values_list(
+            'mac_address', 'expires_at'
+        )
+        count = 0
+        for mac_address, expires_at in sessions.iterator():
+            self.schedule(mac_address, expires_at.timestamp())
+            count += 1
+        return count
+
+    def seconds_until_next(self):
+        while self._heap:
+            deadline, mac_address = self._heap[0]
+            if self._deadlines.get(mac_address) != deadline:
+                heapq.heappop(self._heap)  # superseded entry
+                continue
+            return max(0.0, deadline - self.clock())
+        return None
+
+    def pop_due(self):
+        """MACs whose current deadline has passed"""
+        now = self.clock()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, mac_address = heapq.heappop(self._heap)
+            if self._deadlines.get(mac_address) == deadline:
+                del self._deadlines[mac_address]
+                due.append(mac_address)
+        return due
+
+    def revoke(self, mac_addresses):
+        """Revoke sessions that are still expired in the DB; returns the number revoked"""
+        from .cleanup import deactivate_expired
+        from .views import block_internet_access_bulk
+
+        if not mac_addresses:
+            return 0
+        now = timezone.now()
+        # Re-check: a session may have been extended after the deadline was queued
+        rows = WifiSession.objects.filter(
+            mac_address__in=mac_addresses, is_active=True, expires_at__isnull=False,
+        ).values_list('id', 'mac_address', 'ip_address', 'expires_at')
+        expired = []
+        for row in rows:
+            if row[3] <= now:
+                expired.append(row)
+            else:
+                self.schedule(row[1], row[3].timestamp())
+
+        # Deactivate first, still conditionally, and revoke only what that UPDATE changed:
+        # a renewal that lands after the read keeps both its session and its access
+        changed = deactivate_expired([row[0] for row in expired], now)
+        expired = [row for row in expired if row[0] in changed]
+
+        block_internet_access_bulk([(mac_address, ip_address) for _id, mac_address, ip_address, _ in expired])
+        for _id, mac_address, _ip_address, expires_at in expired:
+            authorization_cache.invalidate(mac_address)
+            late = self.clock() - expires_at.timestamp()
+            self.lateness.append(late)
+            logger.info(f"Revoked {mac_address} {late * 1000:.0f} ms after expires_at")
+        gateway_events.revoke((mac_address, ip_address) for _id, mac_address, ip_address, _ in expired)
+        return len(expired)
+
+    def lateness_summary(self):
+        if not self.lateness:
+            return {'revoked': 0}
+        ordered = sorted(self.lateness)
+        return {
+            'revoked': len(ordered),
+            'mean_ms': sum(ordered) / len(ordered) * 1000,
+            'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+            'max_ms': ordered[-1] * 1000,
+        }
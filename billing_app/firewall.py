@@ -0,0 +1,428 @@
+"""
+Set-based traffic-control backends.
+
+The 'iptables' method adds two rules per customer to the CAPTIVE_PORTAL
+chain, so every packet walks a chain as long as the customer list. The
+backends here keep paid MACs/IPs in a kernel hash set instead and reference
+it from one rule: membership is O(1), and each element carries a timeout
+matching the session's expires_at so the kernel drops access on its own.
+
+Every grant/revoke is a single `ipset restore` / `nft -f -` batch. Commands
+go through an executor so tests can record the batches instead of running
+them. Each backend's counters() reads the per-device packet/byte counters
+of every paid-device rule or set element in one dump (billing_app/metering.py).
+"""
+import ipaddress
+import json
+import logging
+import math
+import subprocess
+from collections import Counter
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# ipset rejects timeouts above this (~24.8 days)
+IPSET_MAX_TIMEOUT = 2147483
+
+
+class CommandExecutor:
+    """Run firewall commands on the host, optionally through sudo"""
+
+    def __init__(self, use_sudo=None):
+        self.use_sudo = use_sudo if use_sudo is not None else getattr(settings, 'FIREWALL_USE_SUDO', True)
+
+    def run(self, args, input=None, check=True):
+        if self.use_sudo:
+            args = ['sudo', *args]
+        result = subprocess.run(args, input=input, capture_output=True, text=True, check=check)
+        return result.stdout
+
+
+class RecordingExecutor:
+    """Fake executor for tests - records every command batch, runs nothing"""
+
+    def __init__(self, outputs=None, fail=False):
+        self.batches = []
+        self.outputs = outputs or {}
+        self.fail = fail
+
+    def run(self, args, input=None, check=True):
+        self.batches.append((list(args), input))
+        if self.fail and check:
+            raise subprocess.CalledProcessError(1, args)
+        return self.outputs.get(args[0], '')
+
+
+def seconds_until(expires_at, now=None, maximum=None):
+    """Whole seconds until expires_at (at least 1); 0 means no timeout"""
+    if expires_at is None:
+        return 0
+    now = now or timezone.now()
+    seconds = max(1, math.ceil((expires_at - now).total_seconds()))
+    return min(seconds, maximum) if maximum else seconds
+
+
+def ipv4_only(ip_address):
+    """The IP sets are IPv4 - IPv6 clients are matched by MAC only"""
+    if not ip_address:
+        return None
+    try:
+        return ip_address if ipaddress.ip_address(ip_address).version == 4 else None
+    except ValueError:
+        return None
+
+
+class SetBackend:
+    """Common grant/revoke plumbing for the kernel-set backends"""
+
+    def __init__(self, executor=None):
+        self.executor = executor or CommandExecutor()
+        self._ready = False
+
+    def ensure(self):
+        """Create the sets and the single referencing rule (idempotent)"""
+        if not self._ready:
+            self.setup()
+            self._ready = True
+
+    def grant(self, entries):
+        """entries: iterable of (mac_address, ip_address, expires_at)"""
+        return self._apply(self.grant_payload(list(entries)), 'grant')
+
+    def revoke(self, entries):
+        """entries: iterable of (mac_address, ip_address)"""
+        return self._apply(self.revoke_payload(list(entries)), 'revoke')
+
+    def apply_diff(self, grant_entries, revoke_entries):
+        """Apply revocations and grants as one kernel transaction"""
+        self.ensure()
+        self.run_payload(self.revoke_payload(list(revoke_entries)) + self.grant_payload(list(grant_entries)))
+
+    def _apply(self, payload, action):
+        if not payload:
+            return True
+        try:
+            self.ensure()
+            self.run_payload(payload)
+            return True
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.error(f"Failed to {action} access via {self.method}: {e}")
+            return False
+
+
+class IpsetBackend(SetBackend):
+    """ipset hash:mac / hash:ip sets referenced from the CAPTIVE_PORTAL chain"""
+
+    method = 'ipset'
+
+    def __init__(self, executor=None, chain=None, mac_set=None, ip_set=None):
+        super().__init__(executor)
+        self.chain = chain or getattr(settings, 'CAPTIVE_PORTAL_CHAIN', 'CAPTIVE_PORTAL')
+        self.mac_set = mac_set or getattr(settings, 'IPSET_MAC_SET', 'wifi_paid_macs')
+        self.ip_set = ip_set or getattr(settings, 'IPSET_IP_SET', 'wifi_paid_ips')
+
+    def setup(self):
+        # "timeout 0" enables per-element timeouts without a set-wide default
+        self.run_payload(
+            f'create {self.mac_set} hash:mac timeout 0 counters\n'
+            f'create {self.ip_set} hash:ip family inet timeout 0 counters\n'
+        )
+        self.executor.run(['iptables', '-N', self.chain], check=False)
+        for set_name in (self.mac_set, self.ip_set):
+            rule = [self.chain, '-m', 'set', '--match-set', set_name, 'src', '-j', 'ACCEPT']
+            try:
+                self.executor.run(['iptables', '-C', *rule])
+            except subprocess.CalledProcessError:
+                self.executor.run(['iptables', '-I', *rule])
+
+    def snapshot(self):
+        """Current set members as a Counter of ('mac', value) / ('ip', value)"""
+        output = self.executor.run(['ipset', 'save'])
+        kinds = {self.mac_set: 'mac', self.ip_set: 'ip'}
+        items = Counter()
+        for line in output.splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'add' and fields[1] in kinds:
+                items[(kinds[fields[1]], fields[2].lower())] += 1
+        return items
+
+    def counters(self):
+        """{('mac'|'ip', value): (packets, bytes)} from the sets' per-element counters"""
+        output = self.executor.run(['ipset', 'save'])
+        kinds = {self.mac_set: 'mac', self.ip_set: 'ip'}
+        counters = {}
+        for line in output.splitlines():
+            # add wifi_paid_macs AA:BB:CC:DD:EE:FF timeout 3552 packets 10 bytes 840
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'add' and fields[1] in kinds:
+                options = dict(zip(fields[3::2], fields[4::2]))
+                counters[(kinds[fields[1]], fields[2].lower())] = (
+                    int(options.get('packets', 0)), int(options.get('bytes', 0))
+                )
+        return counters
+
+    def run_payload(self, payload):
+        # -exist: re-adding refreshes the timeout, deleting a missing element is a no-op
+        self.executor.run(['ipset', '-exist', 'restore'], input=payload)
+
+    def grant_payload(self, entries):
+        now = timezone.now()
+        lines = []
+        for mac_address, ip_address, expires_at in entries:
+            timeout = seconds_until(expires_at, now, IPSET_MAX_TIMEOUT)
+            if mac_address:
+                lines.append(f'add {self.mac_set} {mac_address} timeout {timeout}')
+            if ipv4_only(ip_address):
+                lines.append(f'add {self.ip_set} {ip_address} timeout {timeout}')
+        return ''.join(line + '\n' for line in lines)
+
+    def revoke_payload(self, entries):
+        lines = []
+        for mac_address, ip_address in entries:
+            if mac_address:
+                lines.append(f'del {self.mac_set} {mac_address}')
+            if ipv4_only(ip_address):
+                lines.append(f'del {self.ip_set} {ip_address}')
+        return ''.join(line + '\n' for line in lines)
+
+
+class NftablesBackend(SetBackend):
+    """nftables sets with per-element timeouts in a captive_portal table"""
+
+    method = 'nftables'
+
+    def __init__(self, executor=None, table=None, chain=None, mac_set='paid_macs', ip_set='paid_ips'):
+        super().__init__(executor)
+        self.table = table or getattr(settings, 'NFT_TABLE', 'inet captive_portal')
+        self.chain = chain or getattr(settings, 'NFT_CHAIN', 'captive_portal')
+        self.mac_set = mac_set
+        self.ip_set = ip_set
+
+    def setup(self):
+        # A base chain on the forward hook - nftables can't jump between tables, so a regular
+        # chain here would never see a packet. Every base chain on a hook runs and any drop is
+        # final, so an accept here can't override iptables' FORWARD DROP: this chain does the
+        # dropping for NFT_CLIENT_INTERFACE itself, and that iptables DROP has to go
+        interface = getattr(settings, 'NFT_CLIENT_INTERFACE', None)
+        rules = [f'ether saddr @{self.mac_set} accept', f'ip saddr @{self.ip_set} accept']
+        if interface:
+            rules = [
+                f'iifname != "{interface}" accept',  # replies and everything not from the clients
+                *rules,
+                'meta l4proto { tcp, udp } th dport 53 accept',  # DNS, for captive portal detection
+                'drop',
+            ]
+        self.run_payload(
+            f'table {self.table} {{\n'
+            f'  set {self.mac_set} {{ type ether_addr; flags timeout; counter; }}\n'
+            f'  set {self.ip_set} {{ type ipv4_addr; flags timeout; counter; }}\n'
+            f'  chain {self.chain} {{ type filter hook forward priority filter; policy accept; }}\n'
+            f'}}\n'
+            f'flush chain {self.table} {self.chain}\n'
+            + ''.join(f'add rule {self.table} {self.chain} {rule}\n' for rule in rules)
+        )
+
+    def snapshot(self):
+        """Current set members as a Counter of ('mac', value) / ('ip', value)"""
+        try:
+            output = self.executor.run(['nft', '-j', 'list', 'table', *self.table.split()])
+        except subprocess.CalledProcessError:
+            return Counter()  # table not created yet
+        kinds = {self.mac_set: 'mac', self.ip_set: 'ip'}
+        items = Counter()
+        for obj in json.loads(output or '{}').get('nftables', []):
+            nft_set = obj.get('set')
+            if not nft_set or nft_set.get('name') not in kinds:
+                continue
+            for elem in nft_set.get('elem', []):
+                # Elements with a timeout are wrapped as {"elem": {"val": ...}}
+                value = elem['elem']['val'] if isinstance(elem, dict) else elem
+                items[(kinds[nft_set['name']], str(value).lower())] += 1
+        return items
+
+    def counters(self):
+        """{('mac'|'ip', value): (packets, bytes)} from the sets' per-element counters"""
+        try:
+            output = self.executor.run(['nft', '-j', 'list', 'table', *self.table.split()])
+        except subprocess.CalledProcessError:
+            return {}
+        kinds = {self.mac_set: 'mac', self.ip_set: 'ip'}
+        counters = {}
+        for obj in json.loads(output or '{}').get('nftables', []):
+            nft_set = obj.get('set')
+            if not nft_set or nft_set.get('name') not in kinds:
+                continue
+            for elem in nft_set.get('elem', []):
+                # {"elem": {"val": ..., "timeout": ..., "counter": {"packets": n, "bytes": n}}}
+                if not isinstance(elem, dict):
+                    continue
+                counter = elem['elem'].get('counter', {})
+                key = (kinds[nft_set['name']], str(elem['elem']['val']).lower())
+                counters[key] = (counter.get('packets', 0), counter.get('bytes', 0))
+        return counters
+
+    def run_payload(self, payload):
+        # nft -f applies the whole file as one transaction
+        self.executor.run(['nft', '-f', '-'], input=payload)
+
+    def _upsert(self, set_name, element, timeout):
+        # add + delete + add refreshes an existing element's timeout atomically
+        timeout_clause = f' timeout {timeout}s' if timeout else ''
+        return [
+            f'add element {self.table} {set_name} {{ {element} }}',
+            f'delete element {self.table} {set_name} {{ {element} }}',
+            f'add element {self.table} {set_name} {{ {element}{timeout_clause} }}',
+        ]
+
+    def _remove(self, set_name, element):
+        # add first so the delete never fails on a missing element
+        return [
+            f'add element {self.table} {set_name} {{ {element} }}',
+            f'delete element {self.table} {set_name} {{ {element} }}',
+        ]
+
+    def grant_payload(self, entries):
+        now = timezone.now()
+        lines = []
+        for mac_address, ip_address, expires_at in entries:
+            timeout = seconds_until(expires_at, now)
+            if mac_address:
+                lines.extend(self._upsert(self.mac_set, mac_address, timeout))
+            if ipv4_only(ip_address):
+                lines.extend(self._upsert(self.ip_set, ip_address, timeout))
+        return ''.join(line + '\n' for line in lines)
+
+    def revoke_payload(self, entries):
+        lines = []
+        for mac_address, ip_address in entries:
+            if mac_address:
+                lines.extend(self._remove(self.mac_set, mac_address))
+            if ipv4_only(ip_address):
+                lines.extend(self._remove(self.ip_set, ip_address))
+        return ''.join(line + '\n' for line in lines)
+
+
+class IptablesChain:
+    """Read and atomically rewrite the per-rule CAPTIVE_PORTAL chain ('iptables' method)"""
+
+    method = 'iptables'
+
+    def __init__(self, executor=None, chain=None):
+        self.executor = executor or CommandExecutor()
+        self.chain = chain or getattr(settings, 'CAPTIVE_PORTAL_CHAIN', 'CAPTIVE_PORTAL')
+        self.items = Counter()
+        self.other_rules = []
+
+    def snapshot(self):
+        """Paid-device rules in the chain; unrelated rules are kept aside verbatim"""
+        output = self.executor.run(['iptables-save', '-t', 'filter'])
+        self.items = Counter()
+        self.other_rules = []
+        for line in output.splitlines():
+            fields = line.split()
+            if fields[:2] != ['-A', self.chain]:
+                continue
+            item = self.item_for(fields[2:])
+            if item:
+                self.items[item] += 1
+            else:
+                self.other_rules.append(' '.join(fields[2:]))
+        return self.items
+
+    def counters(self):
+        """{('mac'|'ip', value): (packets, bytes)} summed over the chain's paid-device rules"""
+        output = self.executor.run(['iptables-save', '-c', '-t', 'filter'])
+        counters = {}
+        for line in output.splitlines():
+            # [12:3456] -A CAPTIVE_PORTAL -m mac --mac-source AA:BB:CC:DD:EE:FF -j ACCEPT
+            fields = line.split()
+            if len(fields) < 3 or not fields[0].startswith('[') or fields[1:3] != ['-A', self.chain]:
+                continue
+            item = self.item_for(fields[3:])
+            if item:
+                packets, bytes_ = (int(n) for n in fields[0].strip('[]').split(':'))
+                seen_packets, seen_bytes = counters.get(item, (0, 0))
+                counters[item] = (seen_packets + packets, seen_bytes + bytes_)
+        return counters
+
+    @staticmethod
+    def item_for(rule):
+        """('mac'|'ip', value) for a paid-device rule's arguments, else None"""
+        if len(rule) == 6 and rule[:3] == ['-m', 'mac', '--mac-source'] and rule[4:] == ['-j', 'ACCEPT']:
+            return ('mac', rule[3].lower())
+        if len(rule) == 4 and rule[0] == '-s' and rule[2:] == ['-j', 'ACCEPT']:
+            return ('ip', rule[1].removesuffix('/32'))
+        return None
+
+    def rule_for(self, kind, value):
+        if kind == 'mac':
+            return f'-m mac --mac-source {value} -j ACCEPT'
+        return f'-s {value} -j ACCEPT'
+
+    def revoke(self, entries):
+        """Delete many devices' rules in one iptables-restore; fails as a whole if any rule is missing"""
+        lines = ['*filter']
+        for mac_address, ip_address in entries:
+            if mac_address:
+                lines.append(f'-D {self.chain} {self.rule_for("mac", mac_address)}')
+            if ip_address:
+                lines.append(f'-D {self.chain} {self.rule_for("ip", ip_address)}')
+        lines.append('COMMIT')
+        self.executor.run(['iptables-restore', '--noflush'], input='\n'.join(lines) + '\n')
+
+    def apply_delta(self, grant_entries, revoke_entries, dedupe=False):
+        """Insert/delete only the rules that change, in one iptables-restore --noflush
+
+        The chain is never redeclared, so rules added by anyone else keep their
+        place and every remaining rule keeps the packet/byte counters the usage
+        meter reads. Re-reads the chain first; with dedupe, extra copies of a
+        device's rule are deleted too.
+        """
+        self.snapshot()
+        lines = ['*filter']
+        for mac_address, ip_address in revoke_entries:
+            for item in (('mac', mac_address), ('ip', ip_address)):
+                if item[1] and self.items[item]:
+                    lines.extend([f'-D {self.chain} {self.rule_for(*item)}'] * self.items.pop(item))
+        if dedupe:
+            for item, count in list(self.items.items()):
+                if count > 1:
+                    lines.extend([f'-D {self.chain} {self.rule_for(*item)}'] * (count - 1))
+                    self.items[item] = 1
+        for mac_address, ip_address, _expires_at in grant_entries:
+            for item in (('mac', mac_address), ('ip', ip_address)):
+                if item[1] and not self.items[item]:
+                    lines.append(f'-I {self.chain} {self.rule_for(*item)}')
+                    self.items[item] = 1
+        if len(lines) > 1:
+            lines.append('COMMIT')
+            self.executor.run(['iptables-restore', '--noflush'], input='\n'.join(lines) + '\n')
+
+    def apply_diff(self, grant_entries, revoke_entries):
+        """reconcile_firewall's batch: the delta plus dropping duplicate rules, never a rewrite"""
+        self.apply_delta(grant_entries, revoke_entries, dedupe=True)
+
+BACKENDS = {
+    IpsetBackend.method: IpsetBackend,
+    NftablesBackend.method: NftablesBackend,
+}
+
+_backends = {}
+
+
+def get_firewall_backend(method):
+    """Shared backend instance for a TRAFFIC_CONTROL_METHOD (sets are created once)"""
+    if method not in _backends:
+        _backends[method] = BACKENDS[method]()
+    return _backends[method]
+
+
+def reset_firewall_backends(executor=None):
+    """Drop cached backends; with an executor, rebuild them around it (tests)"""
+    _backends.clear()
+    if executor is not None:
+        for method, backend_class in BACKENDS.items():
+            _backends[method] = backend_class(executor=executor)
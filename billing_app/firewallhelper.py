@@ -0,0 +1,368 @@
+"""
+Long-lived privileged firewall helper on a Unix socket.
+
+allow_access_iptables / block_access_iptables ran `sudo iptables` up to
+three times per customer. Every run paid for sudo's PAM and sudoers
+parsing, then for iptables taking the xtables lock and reloading the
+ruleset, and concurrent payments queued on that lock one rule at a time.
+
+`manage.py run_firewall_helper` runs once per gateway, as root, and owns
+the paid-device ruleset. The app sends it batches of grants and
+revocations over FIREWALL_HELPER_SOCKET:
+
+    G aa:bb:cc:dd:ee:ff 10.0.0.5 3600     grant (MAC, IP, timeout seconds)
+    R aa:bb:cc:dd:ee:ff -                 revoke ('-' = no MAC / no IP)
+    <empty line>                          end of batch
+
+The helper answers with one line per item, in order: `ok`, or `err
+<reason>`. Every item is validated before anything reaches iptables, so a
+malformed item fails on its own without affecting the rest of its batch.
+
+Batches that arrive within FIREWALL_HELPER_WINDOW seconds of each other
+are coalesced into a single ruleset commit: one iptables-restore, ipset
+restore or nft -f (see billing_app/firewall.py). When one commit carries
+several operations on the same rule, the last one wins. An iptables commit
+re-reads the chain and only inserts/deletes the rules that change (under
+--noflush), so rules added by reconcile_firewall or by hand stay, and so do
+the counters run_usage_meter reads.
+
+With --fake, commands go to FakeExecutor instead of the kernel, which
+charges a configurable latency per command. This lets the throughput be
+measured without root (`manage.py bench_firewall_helper`).
+"""
+import ipaddress
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .firewall import BACKENDS, IptablesChain, ipv4_only, seconds_until
+from .macaddr import normalize_mac
+
+logger = logging.getLogger(__name__)
+
+GRANT, REVOKE = 'G', 'R'
+METHODS = ('iptables', *BACKENDS)  # TRAFFIC_CONTROL_METHODs the helper can apply
+MAX_LINE = 256
+MAX_BATCH = 4096  # items per request; the client splits larger ones
+
+
+class HelperError(Exception):
+    pass
+
+
+def encode_op(action, mac_address, ip_address, timeout=0):
+    line = f'{action} {mac_address or "-"} {ip_address or "-"}'
+    return f'{line} {timeout}' if action == GRANT else line
+
+
+def parse_op(line):
+    """(action, mac, ip, timeout) for one request line; ValueError says what is wrong with it"""
+    fields = line.split()
+    if not fields or fields[0] not in (GRANT, REVOKE) or len(fields) != (4 if fields[0] == GRANT else 3):
+        raise ValueError('malformed item')
+    action, mac_field, ip_field = fields[:3]
+    mac_address = ip_address = None
+    if mac_field != '-':
+        mac_address = normalize_mac(mac_field)
+        if mac_address is None:
+            raise ValueError('invalid MAC address')
+    if ip_field != '-':
+        try:
+            ip_address = str(ipaddress.ip_address(ip_field))
+        except ValueError:
+            raise ValueError('invalid IP address')
+        if '%' in ip_address:
+            raise ValueError('invalid IP address')
+    if mac_address is None and ip_address is None:
+        raise ValueError('no MAC or IP address')
+    timeout = 0
+    if action == GRANT:
+        if not fields[3].isdigit():
+            raise ValueError('invalid timeout')
+        timeout = int(fields[3])
+    return action, mac_address, ip_address, timeout
+
+
+class FakeExecutor:
+    """Runs nothing: each command holds a lock for `latency` seconds, standing in for the xtables lock"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.commands = 0
+        self._lock = threading.Lock()
+
+    def run(self, args, input=None, check=True):
+        with self._lock:
+            self.commands += 1
+            if self.latency:
+                time.sleep(self.latency)
+        return ''
+
+
+class Ruleset:
+    """The paid-device rules for one method; changed one coalesced commit at a time"""
+
+    def __init__(self, method, executor):
+        if method not in METHODS:
+            raise ValueError(f'The firewall helper cannot apply TRAFFIC_CONTROL_METHOD {method!r}')
+        self.method = method
+        self.target = IptablesChain(executor) if method == 'iptables' else BACKENDS[method](executor)
+        self.refresh()
+
+    def refresh(self):
+        """Re-read the chain / re-create the sets - after someone else changed them"""
+        if self.method == 'iptables':
+            self.target.snapshot()
+        else:
+            self.target._ready = False
+            self.target.ensure()
+
+    def commit(self, ops):
+        """Apply ops in one kernel transaction; the last op on each MAC/IP wins"""
+        final = {}
+        for action, mac_address, ip_address, timeout in ops:
+            # IPv6 clients are matched by MAC only, as with the kernel sets
+            for item in (('mac', mac_address), ('ip', ipv4_only(ip_address))):
+                if item[1]:
+                    final[item] = (action, timeout)
+
+        now = timezone.now()
+        grants, revokes = [], []
+        for (kind, value), (action, timeout) in final.items():
+            mac_address, ip_address = (value, None) if kind == 'mac' else (None, value)
+            if action == GRANT:
+                grants.append((mac_address, ip_address, now + timedelta(seconds=timeout) if timeout else None))
+            else:
+                revokes.append((mac_address, ip_address))
+        # The chain is shared with reconcile_firewall and admins: only the changed rules are
+        # inserted/deleted against a fresh read, never a rewrite that would drop their
+        # rules or zero the counters the usage meter reads
+        apply = self.target.apply_delta if self.method == 'iptables' else self.target.apply_diff
+        try:
+            apply(grants, revokes)
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.warning(f'Firewall commit failed ({e}), re-reading the ruleset and retrying')
+            self.refresh()
+            apply(grants, revokes)
+
+
+class FirewallHelperHandler(socketserver.StreamRequestHandler):
+
+    def read_batch(self):
+        """The request's lines, or None when the client hung up or broke the protocol"""
+        lines = []
+        while True:
+            line = self.rfile.readline(MAX_LINE)
+            if not line.endswith(b'\n') or len(lines) > MAX_BATCH:
+                return None
+            line = line.decode('ascii', 'replace').strip()
+            if not line:
+                return lines
+            lines.append(line)
+
+    def handle(self):
+        while (lines := self.read_batch()) is not None:
+            results, ops = [], []
+            for line in lines:
+                try:
+                    ops.append(parse_op(line))
+                    results.append(None)
+                except ValueError as e:
+                    results.append(f'err {e}')
+            error = self.server.submit(ops) if ops else None
+            ok = f'err {error}' if error else 'ok'
+            self.wfile.write(''.join(f'{result or ok}\n' for result in results).encode())
+
+
+class FirewallHelper(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The helper daemon: one thread per client connection, one committer thread"""
+
+    daemon_threads = True
+
+    def __init__(self, path, ruleset, window=None, mode=0o660, group=None):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, FirewallHelperHandler)
+        os.chmod(path, mode)
+        if group:
+            shutil.chown(path, group=group)
+        self.ruleset = ruleset
+        self.window = window if window is not None else getattr(settings, 'FIREWALL_HELPER_WINDOW', 0.005)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._stopping = False
+        self._committer = threading.Thread(target=self.commit_loop, name='firewall-helper-commit', daemon=True)
+        self.requests = self.ops = self.commits = self.failures = self.largest = 0
+
+    def submit(self, ops):
+        """Queue one request's ops for the next commit and wait for it; returns the error, if any"""
+        slot = {'ops': ops, 'done': threading.Event(), 'error': None}
+        with self._cond:
+            if self._stopping:
+                return 'helper is shutting down'
+            self._pending.append(slot)
+            self._cond.notify()
+        slot['done'].wait()
+        return slot['error']
+
+    def commit_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+            if self.window:
+                time.sleep(self.window)  # let concurrent requests join this commit
+            with self._cond:
+                batch, self._pending = self._pending, []
+            error = self.commit([op for slot in batch for op in slot['ops']])
+            self.requests += len(batch)
+            for slot in batch:
+                slot['error'] = error
+                slot['done'].set()
+
+    def commit(self, ops):
+        try:
+            self.ruleset.commit(ops)
+        except Exception as e:
+            # Anything a backend raises (a command, an unparsable snapshot) fails this batch only -
+            # the committer thread must survive, or every waiting client blocks forever
+            self.failures += 1
+            logger.error(f'Firewall helper commit of {len(ops)} items via {self.ruleset.method} failed: {e!r}')
+            return ' '.join(str(e).split()) or type(e).__name__
+        self.commits += 1
+        self.ops += len(ops)
+        self.largest = max(self.largest, len(ops))
+        return None
+
+    def start(self):
+        """Serve from daemon threads; returns self for chaining"""
+        self._committer.start()
+        threading.Thread(target=self.serve_forever, name='firewall-helper', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._committer.is_alive():
+            self._committer.join()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+    def stats(self):
+        return {
+            'requests': self.requests, 'items': self.ops, 'commits': self.commits,
+            'failed_commits': self.failures, 'largest_commit': self.largest,
+        }
+
+
+class FirewallHelperClient:
+    """The app's side of FIREWALL_HELPER_SOCKET - one kept-alive connection per thread"""
+
+    def __init__(self, path=None, timeout=None):
+        self._path = path
+        self._timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def path(self):
+        return self._path or getattr(settings, 'FIREWALL_HELPER_SOCKET', None)
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and conn[0] != self.path:
+            self.close()
+            conn = None
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self._timeout or getattr(settings, 'FIREWALL_HELPER_TIMEOUT', 10))
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            conn = self._local.conn = (self.path, sock, sock.makefile('rb'))
+        return conn
+
+    def _roundtrip(self, lines):
+        _path, sock, reader = self._connection()
+        sock.sendall(''.join(f'{line}\n' for line in [*lines, '']).encode())
+        results = []
+        for _ in lines:
+            line = reader.readline()
+            if not line.endswith(b'\n'):
+                raise ConnectionError('connection closed')
+            results.append(line.decode().strip())
+        return results
+
+    def submit(self, lines):
+        """Send request lines in batches of MAX_BATCH; one result line per request line"""
+        results = []
+        for start in range(0, len(lines), MAX_BATCH):
+            chunk = lines[start:start + MAX_BATCH]
+            reused = getattr(self._local, 'conn', None) is not None
+            try:
+                results += self._roundtrip(chunk)
+                continue
+            except (OSError, ConnectionError) as e:
+                self.close()
+                if not reused:
+                    raise HelperError(f'{self.path}: {e}') from e
+            # The kept-alive connection had gone stale (helper restarted) - one retry
+            try:
+                results += self._roundtrip(chunk)
+            except (OSError, ConnectionError) as e:
+                self.close()
+                raise HelperError(f'{self.path}: {e}') from e
+        return results
+
+    def _apply(self, lines, action):
+        try:
+            results = self.submit(lines)
+        except HelperError as e:
+            logger.error(f'Failed to {action} access via the firewall helper: {e}')
+            return [False] * len(lines)
+        for line, result in zip(lines, results):
+            if result != 'ok':
+                logger.error(f'Firewall helper could not {action} {line!r}: {result}')
+        return [result == 'ok' for result in results]
+
+    def grant(self, entries):
+        """entries: iterable of (mac_address, ip_address, expires_at); one bool per entry"""
+        now = timezone.now()
+        return self._apply([
+            encode_op(GRANT, mac_address, ip_address, seconds_until(expires_at, now))
+            for mac_address, ip_address, expires_at in entries
+        ], 'grant')
+
+    def revoke(self, entries):
+        """entries: iterable of (mac_address, ip_address); one bool per entry"""
+        return self._apply([encode_op(REVOKE, mac_address, ip_address) for mac_address, ip_address in entries],
+                           'revoke')
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn[2].close()
+            conn[1].close()
+            self._local.conn = None
+
+
+firewall_helper = FirewallHelperClient()
@@ -0,0 +1,500 @@
+"""
+Multi-gateway mode: one shared session store, access events fanned out to every node.
+
+A venue with several gateways used to run one app and one db.sqlite3 per
+gateway, so a customer who paid on one was a stranger on the next. In
+multi-gateway mode every node points DATABASES at the same server (see
+SHARED_DB_HOST in settings), and grants and revocations are published to
+a Redis stream (GATEWAY_BUS_URL). Each node then reacts to the events:
+
+- Every web process runs an AuthorizationListener thread. It drops the
+  affected MACs from that process's authorization cache as soon as XREAD
+  returns - no polling, no TTL wait.
+- One GatewaySync per node (`manage.py run_gateway_sync`) applies the other
+  nodes' grants and revocations to the local firewall. Remote grants are
+  MAC-only, since the IP belongs to the other gateway's network; remote
+  revocations carry the IP as well, so no rule for it outlives the session.
+
+A stream rather than plain PUBLISH/SUBSCRIBE doubles as the catch-up log.
+GatewaySync persists the id of the last event it applied and resumes from
+it after a restart. If the stream was trimmed past that id (the node was
+offline longer than GATEWAY_BUS_MAXLEN events), the node reconciles its
+firewall against the shared database instead.
+
+The bus speaks plain RESP over TCP or a Unix socket, so any Redis-compatible
+server works with no client library. LocalBus (`local://`) is an in-process
+stand-in, and billing_app/redisstub.py serves one over a socket for tests.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs, urlparse
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .authcache import authorization_cache
+
+logger = logging.getLogger(__name__)
+
+
+class BusError(Exception):
+    pass
+
+
+def parse_id(event_id):
+    """'1760700000000-3' -> (1760700000000, 3), for ordering stream ids"""
+    ms, _, seq = event_id.partition('-')
+    return int(ms), int(seq or 0)
+
+
+def encode_command(args):
+    parts = [f'*{len(args)}\r\n'.encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    """One RESP2 reply from a binary file object; error replies come back as BusError instances"""
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('connection closed')
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b'+':
+        return rest.decode()
+    if prefix == b'-':
+        return BusError(rest.decode())
+    if prefix == b':':
+        return int(rest)
+    if prefix == b'$':
+        length = int(rest)
+        return None if length < 0 else reader.read(length + 2)[:-2].decode()
+    if prefix == b'*':
+        length = int(rest)
+        return None if length < 0 else [read_reply(reader) for _ in range(length)]
+    raise BusError(f'unexpected reply {line!r}')
+
+
+class RespConnection:
+    """Minimal RESP client: redis://[:password@]host:port/db or unix:///path/to.sock?db=0"""
+
+    def __init__(self, url, timeout=5.0):
+        parsed = urlparse(url)
+        if parsed.scheme == 'unix':
+            self.family, self.address = socket.AF_UNIX, parsed.path
+            self.db = parse_qs(parsed.query).get('db', ['0'])[0]
+        elif parsed.scheme == 'redis':
+            self.family, self.address = socket.AF_INET, (parsed.hostname or '127.0.0.1', parsed.port or 6379)
+            self.db = parsed.path.strip('/') or '0'
+        else:
+            raise ValueError(f'Unsupported bus URL {url!r}')
+        self.url = url
+        self.password = parsed.password
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+
+    def _connect(self):
+        if self.family == socket.AF_UNIX:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+        else:
+            sock = socket.create_connection(self.address, timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock, self._reader = sock, sock.makefile('rb')
+        setup = ([('AUTH', self.password)] if self.password else []) + ([('SELECT', self.db)] if self.db != '0' else [])
+        if setup:
+            self._roundtrip(setup, self.timeout)
+
+    def _roundtrip(self, commands, timeout):
+        self._sock.settimeout(timeout)
+        self._sock.sendall(b''.join(encode_command(command) for command in commands))
+        replies = [read_reply(self._reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, BusError):
+                raise reply
+        return replies
+
+    def pipeline(self, commands, timeout=None):
+        """Send all commands in one write and read their replies"""
+        reused = self._sock is not None
+        try:
+            if not reused:
+                self._connect()
+            return self._roundtrip(commands, timeout or self.timeout)
+        except (OSError, ConnectionError) as e:
+            self.close()
+            if not reused:
+                raise BusError(f'{self.url}: {e}') from e
+        # The kept-alive connection had gone stale - one retry on a fresh one
+        try:
+            self._connect()
+            return self._roundtrip(commands, timeout or self.timeout)
+        except (OSError, ConnectionError) as e:
+            self.close()
+            raise BusError(f'{self.url}: {e}') from e
+
+    def execute(self, *args, timeout=None):
+        return self.pipeline([args], timeout)[0]
+
+    def close(self):
+        if self._sock is not None:
+            self._reader.close()
+            self._sock.close()
+            self._sock = self._reader = None
+
+
+class RedisStreamBus:
+    """Access events in a Redis stream: XADD to publish, XREAD to follow, XRANGE for catch-up bounds"""
+
+    def __init__(self, url, stream=None, maxlen=None):
+        self.stream = stream or getattr(settings, 'GATEWAY_BUS_STREAM', 'wifi:access-events')
+        self.maxlen = maxlen or getattr(settings, 'GATEWAY_BUS_MAXLEN', 100000)
+        self._writer = RespConnection(url)
+        self._reader = RespConnection(url)  # XREAD BLOCK holds its connection
+        self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+
+    def publish_many(self, events):
+        commands = [
+            ('XADD', self.stream, 'MAXLEN', '~', self.maxlen, '*', 'event', json.dumps(event))
+            for event in events
+        ]
+        with self._write_lock:
+            return self._writer.pipeline(commands)
+
+    def read(self, after, count=500, block=None):
+        """[(id, event)] after `after` ('$' = only new ones), waiting up to `block` seconds for one"""
+        args = ['XREAD', 'COUNT', count]
+        if block is not None:
+            args += ['BLOCK', max(1, int(block * 1000))]
+        args += ['STREAMS', self.stream, after]
+        with self._read_lock:
+            reply = self._reader.execute(*args, timeout=(block or 0) + self._reader.timeout)
+        if not reply:
+            return []
+        return [(event_id, json.loads(dict(zip(fields[::2], fields[1::2]))['event'])) for event_id, fields in reply[0][1]]
+
+    def _edge(self, command, start, end):
+        with self._read_lock:
+            reply = self._reader.execute(command, self.stream, start, end, 'COUNT', 1)
+        return reply[0][0] if reply else None
+
+    def first_id(self):
+        return self._edge('XRANGE', '-', '+')
+
+    def last_id(self):
+        return self._edge('XREVRANGE', '+', '-')
+
+
+class LocalBus:
+    """In-process stream with the RedisStreamBus interface - tests, and the redisstub server"""
+
+    def __init__(self, maxlen=None):
+        self.maxlen = maxlen
+        self._entries = []  # [(parsed id, id, event)], ascending
+        self._cond = threading.Condition()
+
+    def _next_id(self):
+        ms = int(time.time() * 1000)
+        if self._entries:
+            last_ms, last_seq = self._entries[-1][0]
+            if ms <= last_ms:
+                return last_ms, last_seq + 1
+        return ms, 0
+
+    def publish_many(self, events):
+        ids = []
+        with self._cond:
+            for event in events:
+                parsed = self._next_id()
+                event_id = f'{parsed[0]}-{parsed[1]}'
+                self._entries.append((parsed, event_id, event))
+                ids.append(event_id)
+            if self.maxlen and len(self._entries) > self.maxlen:
+                del self._entries[:len(self._entries) - self.maxlen]
+            self._cond.notify_all()
+        return ids
+
+    def read(self, after, count=500, block=None):
+        deadline = None if block is None else time.monotonic() + block
+        with self._cond:
+            if after == '$':
+                after = self._entries[-1][1] if self._entries else '0-0'
+            start = parse_id(after)
+            while True:
+                found = [(event_id, event) for parsed, event_id, event in self._entries if parsed > start][:count]
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if found or remaining is None or remaining <= 0:
+                    return found
+                self._cond.wait(remaining)
+
+    def entries(self):
+        with self._cond:
+            return [(event_id, event) for _parsed, event_id, event in self._entries]
+
+    def first_id(self):
+        with self._cond:
+            return self._entries[0][1] if self._entries else None
+
+    def last_id(self):
+        with self._cond:
+            return self._entries[-1][1] if self._entries else None
+
+
+_local_buses = {}
+
+
+def open_bus(url=None):
+    """A bus for GATEWAY_BUS_URL (None when multi-gateway mode is off)"""
+    url = url or getattr(settings, 'GATEWAY_BUS_URL', None)
+    if not url:
+        return None
+    if url.startswith('local://'):
+        # Shared per name, so publishers and listeners in one process meet
+        return _local_buses.setdefault(url, LocalBus(getattr(settings, 'GATEWAY_BUS_MAXLEN', None)))
+    return RedisStreamBus(url)
+
+
+def node_id():
+    return getattr(settings, 'GATEWAY_NODE_ID', None) or socket.gethostname()
+
+
+class GatewayEvents:
+    """Publishes this node's grants and revocations (no-op unless GATEWAY_BUS_URL is set)"""
+
+    def __init__(self, url=None):
+        self._url = url
+        self._bus = None
+        self._bus_url = None
+        self._lock = threading.Lock()
+        self.published = 0
+        self.failed = 0
+
+    @property
+    def url(self):
+        return self._url or getattr(settings, 'GATEWAY_BUS_URL', None)
+
+    @property
+    def bus(self):
+        url = self.url
+        with self._lock:
+            if self._bus is None or self._bus_url != url:
+                self._bus, self._bus_url = open_bus(url), url
+            return self._bus
+
+    @property
+    def enabled(self):
+        return bool(self.url)
+
+    def grant(self, mac_address, ip_address, expires_at):
+        self.publish([{'op': 'grant', 'mac': mac_address, 'ip': ip_address,
+                       'expires_at': expires_at.timestamp() if expires_at else None}])
+
+    def revoke(self, entries):
+        """entries: iterable of (mac_address, ip_address)"""
+        self.publish([{'op': 'revoke', 'mac': mac_address, 'ip': ip_address} for mac_address, ip_address in entries])
+
+    def publish(self, events):
+        if not events or not self.enabled:
+            return
+        origin = node_id()
+        for event in events:
+            event['node'] = origin
+        try:
+            self.bus.publish_many(events)
+            self.published += len(events)
+        except BusError as e:
+            # The database already holds the change; peers converge on their next catch-up or reconcile
+            self.failed += len(events)
+            logger.warning(f"Publishing {len(events)} access events failed: {e}")
+
+
+gateway_events = GatewayEvents()
+
+
+class AuthorizationListener:
+    """Drops MACs from this process's authorization cache as every node's events arrive"""
+
+    def __init__(self, bus=None, cache=None):
+        self._bus = bus
+        self.cache = cache or authorization_cache
+        self._stop = threading.Event()
+        self._thread = None
+        self.received = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='gateway-auth-listener', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        bus = self._bus or open_bus()
+        after = '$'
+        while not self._stop.is_set():
+            try:
+                events = bus.read(after, block=1.0)
+            except Exception as e:
+                # Events may have been missed (disconnected, or a batch that didn't decode) - forget
+                # every cached decision rather than let this thread die and invalidation stop
+                logger.warning(
+                    f"Gateway event listener could not read the bus ({e}); clearing the authorization cache"
+                )
+                self.cache.clear()
+                after = '$'
+                self._stop.wait(1.0)
+                continue
+            for event_id, event in events:
+                after = event_id
+                try:
+                    self.cache.invalidate(event['mac'])
+                except Exception as e:
+                    logger.warning(f"Skipping malformed gateway event {event_id}: {e!r}")
+                    continue
+                self.received += 1
+
+
+authorization_listener = AuthorizationListener()
+
+
+def _start_listener(**kwargs):
+    from django.core.signals import request_started
+    request_started.disconnect(_start_listener, dispatch_uid='gateway_auth_listener')
+    authorization_listener.start()
+
+
+def install_listener():
+    """Start following the bus when this process serves its first request"""
+    from django.core.signals import request_started
+    request_started.connect(_start_listener, dispatch_uid='gateway_auth_listener')
+
+
+class GatewaySync:
+    """Applies other nodes' access events to this node's firewall, resuming from a persisted cursor"""
+
+    def __init__(self, bus=None, node=None, cursor_path=None, grant=None, revoke=None, resync=None):
+        self.bus = bus or open_bus()
+        self.node = node or node_id()
+        self.cursor_path = cursor_path or getattr(settings, 'GATEWAY_SYNC_CURSOR', None)
+        self._grant = grant
+        self._revoke = revoke
+        self._resync = resync
+        self.cursor = None
+        self.applied = 0
+        self.skipped = 0
+        self.resyncs = 0
+
+    def load_cursor(self):
+        try:
+            with open(self.cursor_path) as fh:
+                return fh.read().strip() or None
+        except (OSError, TypeError):
+            return None
+
+    def save_cursor(self, event_id):
+        self.cursor = event_id
+        if not self.cursor_path:
+            return
+        tmp = f'{self.cursor_path}.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(event_id)
+        os.replace(tmp, self.cursor_path)
+
+    def catch_up(self):
+        """Resume from the saved cursor, or resync from the database when events were lost"""
+        cursor = self.load_cursor()
+        first = self.bus.first_id()
+        if cursor is not None and (first is None or parse_id(cursor) >= parse_id(first)):
+            self.cursor = cursor
+            return cursor
+        # No cursor, or the stream was trimmed past it. Take the position first,
+        # so events published during the resync are applied afterwards
+        last = self.bus.last_id() or '0-0'
+        logger.info(f"Gateway {self.node}: cursor {cursor} not in the stream (starts at {first}) - resyncing")
+        self.resync()
+        self.save_cursor(last)
+        return last
+
+    def resync(self):
+        self.resyncs += 1
+        authorization_cache.clear()
+        if self._resync:
+            return self._resync()
+        from .reconcile import ReconcileNotSupported, reconcile_firewall
+        try:
+            reconcile_firewall()
+        except ReconcileNotSupported as e:
+            logger.warning(f"Gateway {self.node}: cannot resync the firewall ({e})")
+
+    def apply(self, events):
+        """Apply a batch - the last event per MAC wins; this node's own events were applied at the source"""
+        latest = {}
+        for event_id, event in events:
+            authorization_cache.invalidate(event['mac'])
+            if event.get('node') == self.node:
+                self.skipped += 1
+                continue
+            latest.pop(event['mac'], None)
+            latest[event['mac']] = event
+        by_op = defaultdict(list)
+        now = time.time()
+        for mac_address, event in latest.items():
+            if event['op'] == 'grant' and event.get('expires_at') and event['expires_at'] <= now:
+                continue  # expired while we were catching up
+            by_op[event['op']].append(event)
+        if by_op['revoke']:
+            # With the IP too: the origin gateway may have granted a `-s ip` rule
+            # for it; where it has none, the revoke skips what isn't there
+            self.revoke([(event['mac'], event.get('ip')) for event in by_op['revoke']])
+        for event in by_op['grant']:
+            self.grant(event)
+        self.applied += len(by_op['revoke']) + len(by_op['grant'])
+
+    def grant(self, event):
+        if self._grant:
+            return self._grant(event)
+        from datetime import datetime, timezone as dt_timezone
+
+        from .views import allow_internet_access
+        expires_at = datetime.fromtimestamp(event['expires_at'], dt_timezone.utc) if event.get('expires_at') else None
+        return allow_internet_access(event['mac'], None, expires_at)
+
+    def revoke(self, entries):
+        if self._revoke:
+            return self._revoke(entries)
+        from .views import block_internet_access_bulk
+        return block_internet_access_bulk(entries)
+
+    def run_once(self, block=None, count=500):
+        if self.cursor is None:
+            self.catch_up()
+        events = self.bus.read(self.cursor, count=count, block=block)
+        if events:
+            self.apply(events)
+            self.save_cursor(events[-1][0])
+        return len(events)
+
+    def run(self, block=1.0, stop=None):
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            try:
+                close_old_connections()
+                self.run_once(block)
+            except BusError as e:
+                logger.warning(f"Gateway {self.node}: bus unavailable ({e}), retrying")
+                self.cursor = None  # catch up again once it is back
+                stop.wait(1.0)
+
+    def stats(self):
+        return {'node': self.node, 'cursor': self.cursor, 'applied': self.applied,
+                'skipped': self.skipped, 'resyncs': self.resyncs}
@@ -0,0 +1,131 @@
+"""
+Admin changelist for tables too big to count or OFFSET through.
+
+The stock changelist runs COUNT(*) on every view (twice with a filter
+applied) and pages with LIMIT/OFFSET, which reads and discards every row
+before the page. On SQLite, that read holds the database busy while the
+portal is trying to write. KeysetChangeList instead:
+
+- pages on (created_at, id) - or the ModelAdmin's keyset_field: each page
+  seeks that column's index just below the last row shown, so page 1,000
+  costs the same as page 1;
+- shows an estimated total (planner statistics or the primary-key span)
+  for the unfiltered list, and a count capped at COUNT_LIMIT when filters
+  or a search are applied.
+"""
+from datetime import datetime, timedelta, timezone
+
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.db.models import Q
+
+CURSOR_VAR = 'cursor'
+COUNT_LIMIT = 1000
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(when, pk):
+    delta = when - EPOCH
+    return f'{(delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds}.{pk}'
+
+
+def decode_cursor(value):
+    """(datetime, id) from encode_cursor(), or None for a missing/garbled cursor"""
+    try:
+        micros, pk = value.split('.')
+        return EPOCH + timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def estimated_count(model, using='default'):
+    """Row count without scanning: planner statistics, else the primary-key span"""
+    connection = connections[using]
+    table = model._meta.db_table
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+                row = cursor.fetchone()
+                if row and row[0] >= 0:
+                    return row[0]
+            elif connection.vendor == 'sqlite':
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+                if cursor.fetchone():
+                    # Left by ANALYZE (or PRAGMA optimize): "<rows> <rows per key>..."
+                    cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s', [table])
+                    counts = [int(stat.split()[0]) for stat, in cursor.fetchall()]
+                    if counts:
+                        return max(counts)
+    except DatabaseError:
+        pass
+    # Both ends of the primary-key index - overestimates only by deleted rows
+    pks = model._base_manager.using(using).order_by()
+    first = pks.values_list('pk', flat=True).order_by('pk').first()
+    last = pks.values_list('pk', flat=True).order_by('-pk').first()
+    return 0 if first is None else last - first + 1
+
+
+class KeysetChangeList(ChangeList):
+    """Changelist paged by (keyset_field, id), newest first, with estimated counts"""
+
+    keyset = True  # Picked up by templates/admin/billing_app/pagination.html
+    # Facets are a COUNT per filter choice - never offered
+    add_facets = property(lambda self: False, lambda self, value: None)
+    is_facets_optional = property(lambda self: False, lambda self, value: None)
+
+    @property
+    def keyset_field(self):
+        return getattr(self.model_admin, 'keyset_field', 'created_at')
+
+    @property
+    def ordering(self):
+        return (f'-{self.keyset_field}', '-pk')
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_query_string(self, new_params=None, remove=None):
+        # Changing a filter or search starts again from the newest row
+        return super().get_query_string(new_params, [CURSOR_VAR, *(remove or [])])
+
+    def get_ordering(self, request, queryset):
+        return list(self.ordering)
+
+    def get_results(self, request):
+        queryset = self.queryset.order_by(*self.ordering)
+        cursor = decode_cursor(request.GET.get(CURSOR_VAR))
+        if cursor:
+            when, pk = cursor
+            field = self.keyset_field
+            # field <= x bounds the index range; the OR only breaks ties
+            queryset = queryset.filter(Q(**{f'{field}__lt': when}) | Q(**{field: when, 'pk__lt': pk}),
+                                       **{f'{field}__lte': when})
+        rows = list(queryset[:self.list_per_page + 1])
+        has_next = len(rows) > self.list_per_page
+        self.result_list = rows[:self.list_per_page]
+
+        filtered = bool(self.has_active_filters or self.query)
+        if filtered:
+            self.result_count = self.queryset.order_by()[:COUNT_LIMIT].count()
+            self.result_count_capped = self.result_count >= COUNT_LIMIT
+        else:
+            self.result_count = estimated_count(self.model, self.queryset.db)
+            self.result_count_capped = False
+        self.result_count_estimated = not filtered
+
+        last = self.result_list[-1] if has_next else None
+        self.next_url = self.get_query_string({CURSOR_VAR: encode_cursor(getattr(last, self.keyset_field), last.pk)}) if last else None
+        self.first_url = self.get_query_string() if cursor else None
+
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.can_show_all = False
+        self.multi_page = bool(self.next_url or self.first_url)
+        # Only for templates that read paginator attributes - never counted
+        self.paginator = Paginator(self.queryset.none(), self.list_per_page)
+        self.paginator.__dict__['count'] = self.result_count
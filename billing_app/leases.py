@@ -0,0 +1,338 @@
+"""
+IP -> MAC index built from the DHCP server's lease file.
+
+The DHCP server (dnsmasq or ISC dhcpd) already knows the MAC behind every
+address it handed out, while the kernel neighbor table may not have an entry
+yet right after a phone associates. When DHCP_LEASE_FILE is set, the file is
+parsed once into memory and kept current from inotify events (stat polling
+where inotify is unavailable). Only changes are applied:
+
+- ISC dhcpd appends a lease block per change: just the appended bytes are
+  parsed.
+- dnsmasq rewrites the whole file: records are compared by hash with the
+  previous version, and only new lines are parsed.
+
+Expired and released leases are dropped; lookups that miss fall back to the
+neighbor table.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import select
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAC_RE = re.compile(r'^([0-9a-f]{2}:){5}[0-9a-f]{2}$')
+
+
+class DnsmasqLeases:
+    """`<expiry epoch> <mac> <ip> <hostname> <client-id>` - one lease per line, file rewritten on change"""
+
+    name = 'dnsmasq'
+    append_only = False
+
+    def split(self, text):
+        """(records, characters consumed) - a trailing partial line is left for later"""
+        end = text.rfind('\n') + 1
+        return text[:end].splitlines(), end
+
+    def parse(self, record):
+        """(ip, mac, expires epoch or 0 for never, active) or None"""
+        fields = record.split()
+        if len(fields) < 3 or not fields[0].isdigit():
+            return None  # 'duid ...' line or junk
+        mac = fields[1].lower()
+        if not MAC_RE.match(mac):
+            return None  # non-Ethernet hardware type
+        return fields[2], mac, int(fields[0]), True
+
+
+class IscLeases:
+    """dhcpd.leases: `lease <ip> { ... }` blocks appended per change, the last one wins"""
+
+    name = 'isc'
+    append_only = True
+    BLOCK_RE = re.compile(r'^lease\s+(\S+)\s*\{(.*?)^\}', re.MULTILINE | re.DOTALL)
+    INACTIVE = {'free', 'expired', 'released', 'abandoned', 'reset', 'backup'}
+
+    def split(self, text):
+        records, end = [], 0
+        for match in self.BLOCK_RE.finditer(text):
+            records.append(match.group(0))
+            end = match.end()
+        return records, end
+
+    def parse(self, record):
+        match = self.BLOCK_RE.match(record)
+        if not match:
+            return None
+        ip, mac, expires, active = match.group(1), None, 0, True
+        for statement in match.group(2).split(';'):
+            words = statement.split()
+            if words[:2] == ['hardware', 'ethernet'] and len(words) > 2:
+                mac = words[2].lower()
+            elif words[:1] == ['ends'] and len(words) > 1:
+                expires = self.parse_time(words[1:])
+            elif words[:2] == ['binding', 'state'] and len(words) > 2:
+                active = words[2] not in self.INACTIVE
+        if not mac or not MAC_RE.match(mac):
+            return None
+        return ip, mac, expires, active
+
+    @staticmethod
+    def parse_time(words):
+        # 'never' | 'epoch 1760700000' | '<weekday> 2026/10/17 12:00:00' (UTC)
+        if words[0] == 'never':
+            return 0
+        if words[0] == 'epoch':
+            return int(words[1])
+        when = datetime.strptime(f'{words[1]} {words[2]}', '%Y/%m/%d %H:%M:%S')
+        return int(when.replace(tzinfo=timezone.utc).timestamp())
+
+
+FORMATS = {'dnsmasq': DnsmasqLeases, 'isc': IscLeases}
+
+
+def sniff_format(text):
+    return IscLeases() if re.search(r'^lease\s+\S+\s*\{', text, re.MULTILINE) else DnsmasqLeases()
+
+
+class InotifyWatcher:
+    """Call `callback` when `path` is written, replaced or recreated (Linux inotify through libc)"""
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, path, callback, debounce=0.05):
+        self.directory, self.filename = os.path.split(os.path.abspath(path))
+        self.callback = callback
+        self.debounce = debounce
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # Watch the directory: dhcpd and some dnsmasq builds replace the file by rename
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(self.directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch({self.directory}) failed')
+        self._stop = threading.Event()
+
+    def _touched(self, data):
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            _wd, _mask, _cookie, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+            offset += self.EVENT.size + length
+            if os.fsdecode(name) == self.filename:
+                return True
+        return False
+
+    def _drain(self):
+        try:
+            return os.read(self.fd, 65536)
+        except BlockingIOError:
+            return b''
+
+    def run(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 1.0)
+            if not ready or not self._touched(self._drain()):
+                continue
+            # A rewrite arrives as a burst of events - apply it once
+            time.sleep(self.debounce)
+            self._drain()
+            try:
+                self.callback()
+            except Exception:
+                logger.exception(f"Applying lease file changes from {self.filename} failed")
+        os.close(self.fd)
+
+    def stop(self):
+        self._stop.set()
+
+
+class PollingWatcher:
+    """stat() the lease file every `interval` seconds - for hosts without inotify"""
+
+    def __init__(self, path, callback, interval=1.0):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.callback()
+            except Exception:
+                logger.exception(f"Applying lease file changes from {self.path} failed")
+
+    def stop(self):
+        self._stop.set()
+
+
+class LeaseIndex:
+    """In-memory IP -> (MAC, expiry) from a DHCP lease file, updated incrementally"""
+
+    def __init__(self, path=None, format=None, clock=time.time, watch=True):
+        self.path = path if path is not None else getattr(settings, 'DHCP_LEASE_FILE', None)
+        self.format = format or getattr(settings, 'DHCP_LEASE_FORMAT', None)
+        self.clock = clock
+        self.watch = watch
+        self.parser = None
+        self._leases = {}  # ip -> (mac, expires)
+        self._records = {}  # hash(record) -> ip, for every record in the current file
+        self._current = {}  # ip -> hash of the record that set the lease
+        self._inode = None
+        self._offset = 0
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._watcher = None
+        self.hits = 0
+        self.misses = 0
+        self.parsed = 0  # records parsed since startup
+        self.rewrites = 0
+        self.appends = 0
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def lookup(self, ip):
+        """MAC holding a current lease on `ip`, or None"""
+        if not self.path or not ip:
+            return None
+        if not self._loaded:
+            self.start()
+        lease = self._leases.get(ip)
+        if lease is not None:
+            mac, expires = lease
+            if not expires or expires > self.clock():
+                self.hits += 1
+                return mac
+        self.misses += 1
+        return None
+
+    def start(self):
+        """Parse the file and start watching it (idempotent)"""
+        with self._lock:
+            if self._loaded:
+                return
+            self._refresh_locked()
+            self._loaded = True
+            if self.watch and self._watcher is None:
+                self._watcher = self._make_watcher()
+                threading.Thread(target=self._watcher.run, name='dhcp-lease-watcher', daemon=True).start()
+
+    def stop(self):
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+
+    def _make_watcher(self):
+        try:
+            return InotifyWatcher(self.path, self.refresh)
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify unavailable ({e}) - polling {self.path}")
+            return PollingWatcher(self.path, self.refresh, getattr(settings, 'DHCP_LEASE_POLL_INTERVAL', 1.0))
+
+    def refresh(self):
+        """Apply whatever changed in the lease file since the last read"""
+        with self._lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            logger.warning(f"Lease file {self.path} unreadable: {e}")
+            return
+        if stat.st_ino == self._inode and stat.st_mtime_ns == self._mtime and stat.st_size == self._offset:
+            return
+
+        with open(self.path, 'rb') as fh:
+            if self.parser is None:
+                head = fh.read(65536).decode('utf-8', 'surrogateescape')
+                self.parser = FORMATS[self.format]() if self.format in FORMATS else sniff_format(head)
+                fh.seek(0)
+            appended = (
+                self.parser.append_only and self._inode is not None
+                and stat.st_ino == self._inode and stat.st_size >= self._offset
+            )
+            if appended:
+                fh.seek(self._offset)
+            data = fh.read()
+
+        # surrogateescape round-trips any byte, so offsets stay exact
+        text = data.decode('utf-8', 'surrogateescape')
+        records, consumed = self.parser.split(text)
+        if appended:
+            self._apply_appended(records)
+            self._offset += len(text[:consumed].encode('utf-8', 'surrogateescape'))
+            self.appends += 1
+        else:
+            self._apply_rewrite(records)
+            self._offset = len(text[:consumed].encode('utf-8', 'surrogateescape'))
+            self.rewrites += 1
+        self._inode = stat.st_ino
+        self._mtime = stat.st_mtime_ns
+
+    def _apply(self, record, key):
+        parsed = self.parser.parse(record)
+        self.parsed += 1
+        if parsed is None:
+            self._records[key] = None  # comment or junk - not parsed again
+            return
+        ip, mac, expires, active = parsed
+        self._records[key] = ip
+        self._current[ip] = key
+        if active:
+            self._leases[ip] = (mac, expires)
+        else:
+            self._leases.pop(ip, None)
+
+    def _apply_appended(self, records):
+        for record in records:
+            self._apply(record, hash(record))
+
+    def _apply_rewrite(self, records):
+        keyed = [(hash(record), record) for record in records]
+        new_keys = {key for key, _record in keyed}
+        for key in self._records.keys() - new_keys:
+            ip = self._records.pop(key)
+            if ip is not None and self._current.get(ip) == key:
+                # The record behind this lease is gone - e.g. dnsmasq dropped it
+                del self._current[ip]
+                self._leases.pop(ip, None)
+        for key, record in keyed:
+            if key not in self._records:
+                self._apply(record, key)
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'format': self.parser.name if self.parser else None,
+            'leases': len(self._leases),
+            'hits': self.hits,
+            'misses': self.misses,
+            'parsed': self.parsed,
+            'appends': self.appends,
+            'rewrites': self.rewrites,
+        }
+
+
+lease_index = LeaseIndex()
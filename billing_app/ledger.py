@@ -0,0 +1,129 @@
+"""
+Append-only payment ledger with hourly and daily revenue rollups.
+
+process_payment used to overwrite the device's single WifiSession row, so a
+repeat customer's earlier purchases vanished and revenue could only be
+summed by scanning sessions. Every purchase is now a Payment row that is
+never updated (apart from its rolled_up bookkeeping flag) or deleted.
+RevenueRollup holds, per plan, the revenue and purchase count of each hour
+and day, so reports read a few rows per bucket however long the ledger
+grows.
+
+Rollups are incremented in the payment's own transaction
+(REVENUE_ROLLUP_ON_WRITE, the default). With it off, process_payment only
+appends, and the compact_revenue command folds the backlog in batches:
+one grouped increment per (bucket, plan) instead of one per payment.
+"""
+import logging
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Payment, PaymentPlan, RevenueRollup
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ('hour', 'day')
+
+
+def bucket_start(at, period):
+    """Start of the hour/day holding `at`, in TIME_ZONE"""
+    local = timezone.localtime(at).replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0) if period == 'day' else local
+
+
+def rollup_on_write():
+    return getattr(settings, 'REVENUE_ROLLUP_ON_WRITE', True)
+
+
+def _increment(period, start, plan_id, revenue, purchases):
+    changes = {'revenue': F('revenue') + revenue, 'purchases': F('purchases') + purchases}
+    bucket = RevenueRollup.objects.filter(period=period, bucket_start=start, plan_id=plan_id)
+    if bucket.update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            RevenueRollup.objects.create(period=period, bucket_start=start, plan_id=plan_id,
+                                         revenue=revenue, purchases=purchases)
+    except IntegrityError:
+        # Another writer created the bucket first
+        bucket.update(**changes)
+
+
+def apply_to_rollups(payments):
+    """Add (plan_id, amount, created_at) rows to their hour and day buckets - call inside a transaction"""
+    totals = defaultdict(lambda: [0, 0])
+    for plan_id, amount, created_at in payments:
+        for period in PERIODS:
+            total = totals[period, bucket_start(created_at, period), plan_id]
+            total[0] += amount
+            total[1] += 1
+    for (period, start, plan_id), (revenue, purchases) in totals.items():
+        _increment(period, start, plan_id, revenue, purchases)
+    return len(totals)
+
+
+def record_payment(plan, mac_address, session=None, amount=None, reference=None, at=None):
+    """Append a Payment (and, on write, its rollup increments) in one transaction"""
+    on_write = rollup_on_write()
+    with transaction.atomic():
+        payment = Payment.objects.create(
+            reference=reference or f"pay_{uuid.uuid4().hex}",
+            session=session,
+            plan=plan,
+            mac_address=mac_address,
+            amount=Decimal(plan.price if amount is None else amount),
+            created_at=at or timezone.now(),
+            rolled_up=on_write,
+        )
+        if on_write:
+            apply_to_rollups([(payment.plan_id, payment.amount, payment.created_at)])
+    return payment
+
+
+def compact(batch_size=1000, limit=None):
+    """Fold payments not yet in RevenueRollup into it, oldest first; returns how many"""
+    done = 0
+    while limit is None or done < limit:
+        size = batch_size if limit is None else min(batch_size, limit - done)
+        with transaction.atomic():
+            # skip_locked lets several compactors share the backlog (ignored on SQLite)
+            rows = list(
+                Payment.objects.filter(rolled_up=False).order_by('id')
+                .select_for_update(skip_locked=True)
+                .values_list('id', 'plan_id', 'amount', 'created_at')[:size]
+            )
+            if not rows:
+                break
+            apply_to_rollups([row[1:] for row in rows])
+            Payment.objects.filter(id__in=[row[0] for row in rows]).update(rolled_up=True)
+        done += len(rows)
+    return done
+
+
+def revenue_report(period='day', buckets=30, now=None):
+    """(plans, rows) for the last `buckets` hours/days, newest first, read from RevenueRollup only
+
+    Each row is (bucket_start, {plan_id: (revenue, purchases)}, revenue, purchases).
+    """
+    now = now or timezone.now()
+    step = timedelta(days=1) if period == 'day' else timedelta(hours=1)
+    since = bucket_start(now, period) - step * (buckets - 1)
+    rollups = RevenueRollup.objects.filter(period=period, bucket_start__gte=since).order_by('-bucket_start', 'plan_id')
+
+    rows, plan_ids = {}, set()
+    for rollup in rollups:
+        by_plan = rows.setdefault(rollup.bucket_start, {})
+        by_plan[rollup.plan_id] = (rollup.revenue, rollup.purchases)
+        plan_ids.add(rollup.plan_id)
+    plans = list(PaymentPlan.objects.filter(id__in=plan_ids).order_by('price', 'id'))
+    return plans, [
+        (start, by_plan, sum(revenue for revenue, _n in by_plan.values()), sum(n for _r, n in by_plan.values()))
+        for start, by_plan in rows.items()
+    ]
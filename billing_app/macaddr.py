@@ -0,0 +1,146 @@
+"""
+MAC addresses as 48-bit integers.
+
+WifiSession.mac_address used to store whatever string `arp` printed, in any
+case or separator style, so equal devices could fail to match, and the
+admin searched it with LIKE scans. MACs are now parsed once at ingress and
+stored in a BIGINT column. MACAddressField still reads and writes canonical
+'aa:bb:cc:dd:ee:ff' strings, and lookups accept any common notation.
+Prefix lookups (`mac_address__prefix='aa:bb:cc'`, e.g. a vendor OUI) become
+an index range scan over the unique index.
+"""
+import ipaddress
+import re
+import zlib
+
+from django.core import exceptions
+from django.db import models
+from django.db.models import Lookup
+from django.db.models.query_utils import DeferredAttribute
+
+MAC_BITS = 48
+MAX_MAC = (1 << MAC_BITS) - 1
+
+CANONICAL_RE = re.compile(r'([0-9a-f]{2}:){5}[0-9a-f]{2}')
+HEX_RE = re.compile(r'[0-9a-f]+')
+# aa:bb:cc:dd:ee:ff  aa-bb-cc-dd-ee-ff  aabb.ccdd.eeff  aabbccddeeff  (any case; prefixes of these)
+OCTET_SEPARATED_RE = re.compile(r'[0-9a-f]{1,2}(?:[:-][0-9a-f]{1,2}){0,5}')
+DOTTED_RE = re.compile(r'[0-9a-f]{4}(?:\.[0-9a-f]{4}){0,2}')
+
+
+def _octets(value):
+    """Octet list for any supported notation (possibly fewer than 6), or None"""
+    value = value.strip().lower()
+    if OCTET_SEPARATED_RE.fullmatch(value) and (':' in value or '-' in value):
+        return [int(part, 16) for part in re.split(r'[:-]', value)]
+    if DOTTED_RE.fullmatch(value):
+        digits = value.replace('.', '')
+    elif HEX_RE.fullmatch(value) and len(value) % 2 == 0 and len(value) <= 12:
+        digits = value
+    else:
+        return None
+    return [int(digits[i:i + 2], 16) for i in range(0, len(digits), 2)]
+
+
+def parse_mac(value):
+    """48-bit int for a MAC in any common notation (or an int); ValueError otherwise"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        if 0 <= value <= MAX_MAC:
+            return value
+        raise ValueError(f'{value} is not a 48-bit MAC address')
+    octets = _octets(str(value)) if value is not None else None
+    if not octets or len(octets) != 6:
+        raise ValueError(f'{value!r} is not a MAC address')
+    return int.from_bytes(bytes(octets), 'big')
+
+
+def format_mac(value):
+    """Canonical 'aa:bb:cc:dd:ee:ff' for a 48-bit int"""
+    return ':'.join(f'{octet:02x}' for octet in value.to_bytes(6, 'big'))
+
+
+def normalize_mac(value):
+    """Canonical string for any common notation, or None when `value` is not a MAC"""
+    try:
+        return format_mac(parse_mac(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def prefix_range(prefix):
+    """(first, last) 48-bit values sharing the 1-6 octet `prefix`, e.g. an OUI 'aa:bb:cc'"""
+    octets = _octets(str(prefix))
+    if not octets or len(octets) > 6:
+        raise ValueError(f'{prefix!r} is not a MAC prefix')
+    shift = 8 * (6 - len(octets))
+    first = int.from_bytes(bytes(octets), 'big') << shift
+    return first, first | ((1 << shift) - 1)
+
+
+def dev_mac(client_ip):
+    """Stable locally administered MAC standing in for a device in development"""
+    try:
+        address = ipaddress.ip_address(client_ip)
+    except ValueError:
+        address = None
+    if address is not None and address.version == 4:
+        return format_mac(0x0200_0000_0000 | int(address))  # 02:00:<IPv4 octets>
+    return format_mac(0x0201_0000_0000 | zlib.crc32(str(client_ip).encode()))
+
+
+class MACAddressDescriptor(DeferredAttribute):
+    """Normalizes on assignment, so instances only ever hold canonical strings"""
+
+    def __set__(self, instance, value):
+        if value is not None and not (isinstance(value, str) and CANONICAL_RE.fullmatch(value)):
+            # Invalid values are kept as-is for full_clean() to report
+            value = normalize_mac(value) or value
+        instance.__dict__[self.field.attname] = value
+
+
+class MACAddressField(models.BigIntegerField):
+    """MAC stored as a 48-bit integer; Python values are canonical strings"""
+
+    description = 'MAC address (48-bit integer)'
+    descriptor_class = MACAddressDescriptor
+
+    @property
+    def validators(self):
+        # parse_mac enforces the range; IntegerField's range validators expect ints
+        return list(self._validators)
+
+    def to_python(self, value):
+        if value is None or value == '':
+            return None
+        try:
+            return format_mac(parse_mac(value))
+        except (TypeError, ValueError):
+            raise exceptions.ValidationError(f'“{value}” is not a valid MAC address.', code='invalid')
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else format_mac(value)
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        return parse_mac(value)
+
+    def formfield(self, **kwargs):
+        from django import forms
+        return models.Field.formfield(self, **{'form_class': forms.CharField, 'max_length': 17, **kwargs})
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj) or ''
+
+
+@MACAddressField.register_lookup
+class MACPrefix(Lookup):
+    """mac_address__prefix='aa:bb:cc' -> BETWEEN first AND last (uses the column's index)"""
+
+    lookup_name = 'prefix'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        first, last = prefix_range(self.rhs)
+        return f'{lhs} BETWEEN %s AND %s', [*lhs_params, first, last]
@@ -0,0 +1,135 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+
+from billing_app.authcache import authorization_cache
+from billing_app.neighbors import StaticSource, neighbor_table
+
+
+class SlowSource(StaticSource):
+    """Static neighbor table that takes `latency` seconds to load, like forking `arp`"""
+
+    def __init__(self, table, latency):
+        super().__init__(table)
+        self.latency = latency
+
+    def __call__(self):
+        time.sleep(self.latency)
+        return super().__call__()
+
+    async def aload(self):
+        await asyncio.sleep(self.latency)
+        return super().__call__()
+
+
+class Command(BaseCommand):
+    help = 'Compare WSGI (thread pool) and ASGI (event loop) throughput for captive-portal probes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=5000)
+        parser.add_argument('--concurrency', type=int, default=1000, help='In-flight ASGI requests')
+        parser.add_argument('--threads', type=int, default=32, help='WSGI worker threads (gunicorn --threads)')
+        parser.add_argument('--devices', type=int, default=250, help='Distinct client IPs')
+        parser.add_argument('--lookup-latency', type=float, default=0.005,
+                            help='Seconds per neighbor-table reload (0 disables the simulated I/O)')
+        parser.add_argument('--path', default='/generate_204')
+
+    def wsgi_environ(self, path, ip):
+        return {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'portal',
+            'SERVER_PORT': '80', 'REMOTE_ADDR': ip, 'wsgi.input': BytesIO(), 'wsgi.url_scheme': 'http',
+            'wsgi.errors': self.stderr, 'SERVER_PROTOCOL': 'HTTP/1.1',
+        }
+
+    def asgi_scope(self, path, ip):
+        return {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+            'headers': [(b'host', b'portal')], 'client': (ip, 40000), 'server': ('portal', 80),
+        }
+
+    def run_wsgi(self, app, targets, threads):
+        def one(target):
+            start = time.perf_counter()
+            body = app(self.wsgi_environ(*target), lambda status, headers, exc_info=None: None)
+            b''.join(body)
+            body.close()
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            return list(pool.map(one, targets))
+
+    async def run_asgi(self, app, targets, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(target):
+            messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+            done = asyncio.Event()
+
+            async def receive():
+                if messages:
+                    return messages.pop()
+                # Like a real server: the client disconnects after the response
+                await done.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.body' and not message.get('more_body'):
+                    done.set()
+
+            async with semaphore:
+                start = time.perf_counter()
+                await app(self.asgi_scope(*target), receive, send)
+                return time.perf_counter() - start
+
+        return await asyncio.gather(*(one(target) for target in targets))
+
+    def report(self, label, latencies, elapsed):
+        ordered = sorted(latencies)
+        p50 = ordered[len(ordered) // 2] * 1000
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000
+        self.stdout.write(
+            f'  {label:<6} {len(ordered) / elapsed:8.0f} req/s  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms'
+        )
+        return len(ordered) / elapsed
+
+    def timed(self, label, run):
+        # Every device starts unknown: first request per device misses both caches
+        authorization_cache.clear()
+        neighbor_table._table, neighbor_table._loaded_at = {}, None
+        start = time.perf_counter()
+        latencies = run()
+        return self.report(label, latencies, time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        ips = [f'10.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff or 1}' for i in range(1, options['devices'] + 1)]
+        macs = {ip: f'02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}' for i, ip in enumerate(ips)}
+        targets = [(options['path'], ips[i % len(ips)]) for i in range(options['requests'])]
+
+        # Reload on every lookup so each request pays the simulated neighbor I/O
+        saved = (neighbor_table._source, neighbor_table.ttl, neighbor_table.min_refresh_interval)
+        neighbor_table.set_source(SlowSource(macs, options['lookup_latency']))
+        neighbor_table.ttl = neighbor_table.min_refresh_interval = 0 if options['lookup_latency'] else 30
+
+        wsgi_app = get_wsgi_application()
+        asgi_app = get_asgi_application()
+        self.stdout.write(
+            f'{len(targets)} requests to {options["path"]} from {len(ips)} devices, '
+            f'lookup latency {options["lookup_latency"] * 1000:.0f} ms'
+        )
+        try:
+            wsgi = self.timed('WSGI', lambda: self.run_wsgi(wsgi_app, targets, options['threads']))
+            asgi = self.timed('ASGI', lambda: asyncio.run(self.run_asgi(asgi_app, targets, options['concurrency'])))
+        finally:
+            neighbor_table.set_source(saved[0])
+            neighbor_table.ttl, neighbor_table.min_refresh_interval = saved[1], saved[2]
+
+        self.stdout.write(
+            f'(WSGI: {options["threads"]} threads, ASGI: {options["concurrency"]} concurrent requests)'
+        )
+        self.stdout.write(self.style.SUCCESS(f'ASGI/WSGI throughput: {asgi / wsgi:.1f}x'))
@@ -0,0 +1,81 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.urls import resolve
+
+from billing_app.middleware import CaptivePortalMiddleware
+
+
+def legacy_should_bypass(middleware, path):
+    """The prefix loop + resolve() matcher CaptivePortalMiddleware used before"""
+    for bypass_url in middleware.bypass_urls:
+        if path.startswith(bypass_url):
+            return True
+
+    try:
+        resolved_url = resolve(path)
+        if resolved_url.url_name in middleware.bypass_url_names:
+            return True
+        if resolved_url.namespace:
+            full_name = f"{resolved_url.namespace}:{resolved_url.url_name}"
+            if full_name in middleware.bypass_url_names or resolved_url.namespace in ['admin']:
+                return True
+    except Exception:
+        pass
+
+    return False
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark the captive portal bypass matcher against the old resolve() loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--paths', type=int, default=5000, help='Number of request paths to generate')
+        parser.add_argument('--rounds', type=int, default=5, help='Timed passes over the path set')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def generate_paths(self, count, seed):
+        rng = random.Random(seed)
+        templates = [
+            # Unpaid clients browsing the internet - the common, expensive case
+            lambda: f'/{rng.choice(["news", "search", "video", "feed"])}/{rng.randint(1, 10**6)}',
+            lambda: f'/generate_204?x={rng.randint(1, 1000)}',
+            lambda: f'/static/assets/img/{rng.randint(1, 500)}.png',
+            lambda: f'/admin/billing_app/wifisession/{rng.randint(1, 1000)}/change/',
+            lambda: f'/select-plan/{rng.randint(1, 20)}/',
+            lambda: '/',
+            lambda: '/payment/',
+        ]
+        weights = [60, 15, 10, 5, 5, 3, 2]
+        return [rng.choices(templates, weights)[0]() for _ in range(count)]
+
+    def time_matcher(self, matcher, paths, rounds):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for path in paths:
+                matcher(path)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def handle(self, *args, **options):
+        middleware = CaptivePortalMiddleware(lambda request: None)
+        paths = self.generate_paths(options['paths'], options['seed'])
+
+        disagreements = [
+            path for path in paths
+            if legacy_should_bypass(middleware, path) != middleware.bypass_matcher.matches(path)
+        ]
+        if disagreements:
+            self.stdout.write(self.style.WARNING(f'{len(disagreements)} paths disagree, e.g. {disagreements[:5]}'))
+
+        legacy = self.time_matcher(lambda path: legacy_should_bypass(middleware, path), paths, options['rounds'])
+        compiled = self.time_matcher(middleware.bypass_matcher.matches, paths, options['rounds'])
+
+        count = len(paths)
+        self.stdout.write(f'Paths: {count} (best of {options["rounds"]} rounds)')
+        self.stdout.write(f'  legacy resolve() loop: {legacy * 1000:8.2f} ms  {legacy / count * 1e6:7.2f} us/path')
+        self.stdout.write(f'  compiled matcher:      {compiled * 1000:8.2f} ms  {compiled / count * 1e6:7.2f} us/path')
+        self.stdout.write(self.style.SUCCESS(f'Speedup: {legacy / compiled:.1f}x'))
@@ -0,0 +1,159 @@
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+from django.utils import timezone
+
+from billing_app.models import WifiSession
+from billing_app.sessionwriter import UnpaidSessionWriter
+
+
+class Command(BaseCommand):
+    help = 'Concurrent portal/payment/cleanup load on SQLite: default settings vs the production profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent request threads')
+        parser.add_argument('--seconds', type=float, default=5.0, help='Run time per profile')
+        parser.add_argument('--paid', type=int, default=2000, help='Paid sessions seeded for payment updates')
+        parser.add_argument('--expired', type=int, default=5000, help='Expired sessions seeded for cleanup')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def profiles(self):
+        return [
+            ('default', {}, {}, False),
+            ('production', {'CONN_MAX_AGE': 600, 'CONN_HEALTH_CHECKS': True},
+             settings.SQLITE_PRODUCTION_OPTIONS, True),
+        ]
+
+    def add_database(self, alias, path, extra, options):
+        databases = connections.configure_settings({
+            'default': settings.DATABASES['default'],
+            alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path, 'OPTIONS': dict(options), **extra},
+        })
+        connections.settings[alias] = databases[alias]
+        call_command('migrate', database=alias, verbosity=0)
+
+    def seed(self, alias, options):
+        now = timezone.now()
+        rows = [
+            WifiSession(mac_address=f'02:aa:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}:00',
+                        ip_address='10.1.0.1', is_paid=True, is_active=True, expires_at=now + timedelta(hours=1))
+            for i in range(options['paid'])
+        ] + [
+            WifiSession(mac_address=f'02:ee:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}:00',
+                        ip_address='10.2.0.1', is_paid=True, is_active=True, expires_at=now - timedelta(minutes=5))
+            for i in range(options['expired'])
+        ]
+        WifiSession.objects.using(alias).bulk_create(rows, batch_size=500)
+        return [row.mac_address for row in rows[:options['paid']]]
+
+    def run_profile(self, alias, paid_macs, batching, options):
+        deadline = time.monotonic() + options['seconds']
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+        lock = threading.Lock()
+        writer = UnpaidSessionWriter(using=alias) if batching else None
+        sessions = WifiSession.objects.using(alias)
+
+        def land(rng):
+            # portal_login for a device seen for the first time
+            octets = uuid.uuid4().hex[:10]
+            mac = '02:' + ':'.join(octets[i:i + 2] for i in range(0, 10, 2))
+            if writer:
+                writer.add(mac, '10.3.0.1')
+            else:
+                sessions.create(mac_address=mac, ip_address='10.3.0.1')
+
+        def pay(rng):
+            # process_payment: read the session, then write it back
+            with transaction.atomic(using=alias):
+                session = sessions.get(mac_address=rng.choice(paid_macs))
+                session.expires_at = timezone.now() + timedelta(hours=1)
+                session.save(update_fields=['expires_at'])
+
+        def browse(rng):
+            sessions.filter(mac_address=rng.choice(paid_macs)).only('is_paid', 'expires_at').first()
+
+        operations = [(land, 50), (pay, 20), (browse, 30)]
+
+        def worker(seed):
+            rng = random.Random(seed)
+            while time.monotonic() < deadline:
+                operation = rng.choices([op for op, _ in operations], [w for _, w in operations])[0]
+                start = time.perf_counter()
+                try:
+                    operation(rng)
+                    ok = True
+                except OperationalError as e:
+                    ok = False
+                    with lock:
+                        errors[operation.__name__] += 1
+                    if 'locked' not in str(e):
+                        raise
+                finally:
+                    # End of "request" - closes the connection unless CONN_MAX_AGE keeps it
+                    connections[alias].close_if_unusable_or_obsolete()
+                if ok:
+                    with lock:
+                        latencies[operation.__name__].append(time.perf_counter() - start)
+
+        def cleanup():
+            # cleanup_expired_sessions: chunked UPDATE ... WHERE id IN (...)
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    ids = list(sessions.filter(is_active=True, expires_at__lt=timezone.now())
+                               .values_list('id', flat=True)[:500])
+                    if ids:
+                        sessions.filter(id__in=ids).update(is_active=False)
+                    else:
+                        time.sleep(0.01)
+                    latencies['cleanup'].append(time.perf_counter() - start)
+                except OperationalError:
+                    errors['cleanup'] += 1
+                finally:
+                    connections[alias].close_if_unusable_or_obsolete()
+
+        threads = [threading.Thread(target=worker, args=(options['seed'] + i,)) for i in range(options['threads'])]
+        threads.append(threading.Thread(target=cleanup))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if writer:
+            writer.flush()
+        connections[alias].close()
+        return latencies, errors
+
+    def report(self, name, latencies, errors, seconds):
+        total_ok = sum(len(values) for values in latencies.values())
+        self.stdout.write(f'{name}: {total_ok / seconds:.0f} ops/s, {sum(errors.values())} "database is locked" errors')
+        for operation in ('land', 'pay', 'browse', 'cleanup'):
+            ordered = sorted(latencies.get(operation, []))
+            if not ordered:
+                self.stdout.write(f'  {operation:<8} no successful operations, {errors[operation]} errors')
+                continue
+            p50 = ordered[len(ordered) // 2] * 1000
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000
+            self.stdout.write(
+                f'  {operation:<8} {len(ordered):7d} ok  {errors[operation]:5d} locked  '
+                f'p50 {p50:8.2f} ms  p99 {p99:8.2f} ms'
+            )
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, extra, db_options, batching in self.profiles():
+                alias = f'bench_{name}'
+                self.add_database(alias, os.path.join(tmp, f'{name}.sqlite3'), extra, db_options)
+                paid_macs = self.seed(alias, options)
+                latencies, errors = self.run_profile(alias, paid_macs, batching, options)
+                self.report(name, latencies, errors, options['seconds'])
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from billing_app.firewallhelper import FakeExecutor, FirewallHelper, FirewallHelperClient, Ruleset
+
+
+class Command(BaseCommand):
+    help = 'Grants per second: sudo iptables per rule vs the coalescing firewall helper (fake mode, no root needed)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grants', type=int, default=1000, help='Customers granted per run')
+        parser.add_argument('--clients', type=int, default=16, help='Concurrent payment threads')
+        parser.add_argument('--latency', type=float, default=0.005,
+                            help='Simulated cost of one firewall command under the xtables lock (seconds)')
+        parser.add_argument('--window', type=float, default=0.005, help='Helper coalescing window (seconds)')
+
+    def time_run(self, label, grant, entries, clients, executor):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            results = list(pool.map(grant, entries))
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'  {label:<22} {len(entries) / elapsed:8.0f} grants/s  {elapsed / len(entries) * 1000:7.2f} ms/grant  '
+            f'{executor.commands:6d} commands  {results.count(False)} failed'
+        )
+        return elapsed
+
+    def handle(self, *args, **options):
+        count = options['grants']
+        entries = [
+            (f'02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}',
+             f'10.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff}', None)
+            for i in range(1, count + 1)
+        ]
+        self.stdout.write(
+            f'{count} grants from {options["clients"]} threads, '
+            f'{options["latency"] * 1000:g} ms per firewall command'
+        )
+
+        per_rule = FakeExecutor(options['latency'])
+
+        def legacy(entry):
+            # What allow_access_iptables does: -N, then -I for the MAC and for the IP
+            mac_address, ip_address, _expires_at = entry
+            per_rule.run(['sudo', 'iptables', '-N', 'CAPTIVE_PORTAL'], check=False)
+            per_rule.run(['sudo', 'iptables', '-I', 'CAPTIVE_PORTAL', '-m', 'mac', '--mac-source', mac_address,
+                          '-j', 'ACCEPT'])
+            per_rule.run(['sudo', 'iptables', '-I', 'CAPTIVE_PORTAL', '-s', ip_address, '-j', 'ACCEPT'])
+            return True
+
+        with tempfile.TemporaryDirectory() as tmp:
+            coalesced = FakeExecutor(options['latency'])
+            server = FirewallHelper(os.path.join(tmp, 'helper.sock'), Ruleset('iptables', coalesced),
+                                    options['window']).start()
+            client = FirewallHelperClient(server.server_address)
+            coalesced.commands = 0  # not the startup snapshot
+            try:
+                baseline = self.time_run('sudo per rule', legacy, entries, options['clients'], per_rule)
+                helper = self.time_run('firewall helper', lambda entry: client.grant([entry])[0], entries,
+                                       options['clients'], coalesced)
+            finally:
+                server.stop()
+
+        stats = server.stats()
+        self.stdout.write(
+            f'  helper: {stats["commits"]} commits for {stats["requests"]} requests '
+            f'(largest {stats["largest_commit"]} items)'
+        )
+        self.stdout.write(self.style.SUCCESS(f'Speedup: {baseline / helper:.1f}x'))
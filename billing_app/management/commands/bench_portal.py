@@ -0,0 +1,219 @@
+import contextvars
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, redirect_stdout
+from http.cookies import SimpleCookie
+from io import BytesIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from billing_app.authcache import authorization_cache
+from billing_app.models import Payment, PaymentPlan, RevenueRollup, WifiSession
+from billing_app.neighbors import StaticSource, neighbor_table
+from billing_app.plans import plan_catalog
+from billing_app.provisioning import provisioning_queue
+
+# View being driven, so subprocesses spawned on the event loop are attributed too
+current_view = contextvars.ContextVar('current_view', default='background')
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+class Device:
+    """One phone: its address, MAC and cookie jar"""
+
+    def __init__(self, ip, mac):
+        self.ip = ip
+        self.mac = mac
+        self.cookies = {}
+
+    def cookie_header(self):
+        return '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+
+
+class Recorder:
+    """Latency, query and spawn counts per view, shared by all client threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(int)
+        self.spawns = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def request(self, view, elapsed, queries, status):
+        with self._lock:
+            self.latencies[view].append(elapsed)
+            self.queries[view] += queries
+            self.statuses[view][status] += 1
+
+    def spawn(self):
+        with self._lock:
+            self.spawns[current_view.get()] += 1
+
+    def report(self, elapsed):
+        views = {}
+        for view, latencies in self.latencies.items():
+            ordered = sorted(latencies)
+            views[view] = {
+                'requests': len(ordered),
+                'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+                'queries_per_request': round(self.queries[view] / len(ordered), 3),
+                'spawns_per_request': round(self.spawns[view] / len(ordered), 3),
+                'statuses': dict(self.statuses[view]),
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'requests': total,
+            'elapsed_s': round(elapsed, 3),
+            'requests_per_sec': round(total / elapsed, 1) if elapsed else 0.0,
+            'queries_per_request': round(sum(self.queries.values()) / total, 3) if total else 0.0,
+            'spawns_per_request': round(sum(self.spawns.values()) / total, 3) if total else 0.0,
+            'background_spawns': self.spawns.get('background', 0),
+            'views': views,
+        }
+
+
+class Command(BaseCommand):
+    help = 'Drive the full captive-portal flow for N simulated devices through the real middleware and views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=200, help='Distinct devices (IP + MAC) to simulate')
+        parser.add_argument('--threads', type=int, default=16, help='Concurrent clients (gunicorn --threads)')
+        parser.add_argument('--browse', type=int, default=20, help='Browsing requests per paid device')
+        parser.add_argument('--browse-path', default='/generate_204', help='Path paid devices keep hitting')
+        parser.add_argument('--reuse-db', action='store_true',
+                            help='Run against the configured database instead of a throwaway SQLite file')
+        parser.add_argument('--output', help='Also write the JSON report to this file')
+
+    def call(self, app, recorder, device, view, method, path, body=b''):
+        environ = {
+            'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'portal',
+            'SERVER_PORT': '80', 'REMOTE_ADDR': device.ip, 'wsgi.input': BytesIO(body),
+            'wsgi.url_scheme': 'http', 'wsgi.errors': self.stderr, 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'CONTENT_LENGTH': str(len(body)), 'CONTENT_TYPE': 'application/json',
+        }
+        if device.cookies:
+            environ['HTTP_COOKIE'] = device.cookie_header()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split()[0])
+            for name, value in headers:
+                if name.lower() == 'set-cookie':
+                    for morsel in SimpleCookie(value).values():
+                        device.cookies[morsel.key] = morsel.value
+
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        token = current_view.set(view)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count_query):
+                chunks = app(environ, start_response)
+                content = b''.join(chunks)
+                chunks.close()
+        finally:
+            current_view.reset(token)
+        recorder.request(view, time.perf_counter() - start, queries, response.get('status'))
+        return content
+
+    def flow(self, app, recorder, device, plan_id, options):
+        # Unknown device: the OS probe is redirected, the phone opens the portal
+        self.call(app, recorder, device, 'probe', 'GET', options['browse_path'])
+        self.call(app, recorder, device, 'portal_login', 'GET', '/')
+        self.call(app, recorder, device, 'select_plan', 'GET', f'/select-plan/{plan_id}/')
+        self.call(app, recorder, device, 'payment_page', 'GET', '/payment/')
+        payment = json.loads(self.call(app, recorder, device, 'process_payment', 'POST', '/process-payment/', b'{}'))
+        if payment.get('status_url'):
+            self.call(app, recorder, device, 'provisioning_status', 'GET', payment['status_url'])
+        self.call(app, recorder, device, 'internet_access', 'GET', '/internet-access/')
+        for _ in range(options['browse']):
+            self.call(app, recorder, device, 'browse', 'GET', options['browse_path'])
+
+    def handle(self, *args, **options):
+        count = options['devices']
+        devices = [
+            Device(f'10.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff}',
+                   f'02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}')
+            for i in range(1, count + 1)
+        ]
+        recorder = Recorder()
+        real_popen_init = subprocess.Popen.__init__
+
+        def counting_popen_init(popen, *args, **kwargs):
+            recorder.spawn()
+            return real_popen_init(popen, *args, **kwargs)
+
+        with ExitStack() as stack:
+            if not options['reuse_db']:
+                tmp = stack.enter_context(tempfile.TemporaryDirectory())
+                connections.close_all()
+                stack.enter_context(mock.patch.dict(connections.settings['default'],
+                                                    {'NAME': os.path.join(tmp, 'bench.sqlite3')}))
+                stack.callback(connections.close_all)
+                call_command('migrate', verbosity=0)
+            stack.enter_context(override_settings(TRAFFIC_CONTROL_METHOD='simulation'))
+            saved_source = neighbor_table._source
+            neighbor_table.set_source(StaticSource({device.ip: device.mac for device in devices}))
+            stack.callback(neighbor_table.set_source, saved_source)
+            authorization_cache.clear()
+            plan = PaymentPlan.objects.create(name='Bench 1 Hour', price='1.00', duration_hours=1)
+            # Undone in reverse: the bench's ledger rows go before its plan (PROTECT), then the
+            # bench devices' paid sessions - left in a reused database, reconcile_firewall,
+            # requeue_provisioning and gateway resyncs would grant those fake MACs real access
+            stack.callback(WifiSession.objects.filter(
+                mac_address__range=(devices[0].mac, devices[-1].mac), created_at__gte=timezone.now(),
+            ).delete)
+            stack.callback(PaymentPlan.objects.filter(pk=plan.pk).delete)
+            stack.callback(RevenueRollup.objects.filter(plan=plan).delete)
+            stack.callback(Payment.objects.filter(plan=plan).delete)
+            plan_catalog.invalidate()
+
+            app = get_wsgi_application()
+            stack.enter_context(mock.patch.object(subprocess.Popen, '__init__', counting_popen_init))
+            # Simulation mode prints every grant
+            stack.enter_context(redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                for future in [pool.submit(self.flow, app, recorder, device, plan.id, options) for device in devices]:
+                    future.result()
+            elapsed = time.perf_counter() - start
+            provisioning_queue.join(timeout=30)
+
+        report = {
+            'devices': count,
+            'threads': options['threads'],
+            'browse_per_device': options['browse'],
+            'environment': settings.ENVIRONMENT,
+            'debug': settings.DEBUG,
+            **recorder.report(elapsed),
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output + '\n')
+        self.stdout.write(output)
@@ -0,0 +1,110 @@
+import os
+import random
+import tempfile
+import time
+from contextlib import ExitStack
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db import connection, connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from billing_app.authcache import authorization_cache
+from billing_app.models import WifiSession
+from billing_app.neighbors import StaticSource, neighbor_table
+from billing_app.probes import PROBES
+
+FAST_PATH = 'billing_app.middleware.CaptivePortalProbeMiddleware'
+
+
+class Command(BaseCommand):
+    help = 'Connectivity-probe requests per second, with and without the in-memory probe fast path'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20000)
+        parser.add_argument('--devices', type=int, default=500, help='Distinct devices (IP + MAC) probing')
+        parser.add_argument('--paid', type=float, default=0.3, help='Fraction of devices with a paid session')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--reuse-db', action='store_true',
+                            help='Run against the configured database instead of a throwaway SQLite file')
+
+    def environ(self, path, ip):
+        return {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'portal',
+            'SERVER_PORT': '80', 'REMOTE_ADDR': ip, 'wsgi.input': BytesIO(), 'wsgi.url_scheme': 'http',
+            'wsgi.errors': self.stderr, 'SERVER_PROTOCOL': 'HTTP/1.1',
+        }
+
+    def run(self, label, middleware, targets):
+        with override_settings(MIDDLEWARE=middleware):
+            app = get_wsgi_application()
+        authorization_cache.clear()
+        statuses, queries = {}, 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        def start_response(status, headers, exc_info=None):
+            statuses[status[:3]] = statuses.get(status[:3], 0) + 1
+
+        with connection.execute_wrapper(count_query):
+            start = time.perf_counter()
+            for path, ip in targets:
+                body = app(self.environ(path, ip), start_response)
+                b''.join(body)
+                body.close()
+            elapsed = time.perf_counter() - start
+
+        rate = len(targets) / elapsed
+        self.stdout.write(
+            f'  {label:<16} {rate:9.0f} probes/s  {elapsed / len(targets) * 1e6:7.1f} us/probe  '
+            f'{queries / len(targets):5.3f} queries/probe  {dict(sorted(statuses.items()))}'
+        )
+        return rate
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        count = options['devices']
+        ips = [f'10.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff}' for i in range(1, count + 1)]
+        macs = {ip: f'02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}' for i, ip in enumerate(ips, 1)}
+        paid = ips[:int(count * options['paid'])]
+        paths = list(PROBES)
+        targets = [(rng.choice(paths), rng.choice(ips)) for _ in range(options['requests'])]
+
+        with ExitStack() as stack:
+            if not options['reuse_db']:
+                tmp = stack.enter_context(tempfile.TemporaryDirectory())
+                connections.close_all()
+                stack.enter_context(mock.patch.dict(connections.settings['default'],
+                                                    {'NAME': os.path.join(tmp, 'bench.sqlite3')}))
+                stack.callback(connections.close_all)
+                call_command('migrate', verbosity=0)
+            stack.enter_context(override_settings(ENVIRONMENT='production', DEBUG=False))
+            saved_source = neighbor_table._source
+            neighbor_table.set_source(StaticSource(macs))
+            stack.callback(neighbor_table.set_source, saved_source)
+            stack.callback(authorization_cache.clear)
+
+            expires_at = timezone.now() + timedelta(hours=1)
+            sessions = WifiSession.objects.bulk_create([
+                WifiSession(mac_address=macs[ip], ip_address=ip, is_paid=True, is_active=True, expires_at=expires_at)
+                for ip in paid
+            ])
+            stack.callback(WifiSession.objects.filter(pk__in=[s.pk for s in sessions]).delete)
+
+            self.stdout.write(
+                f'{len(targets)} probes over {len(paths)} OS probe URLs from {count} devices ({len(paid)} paid)'
+            )
+            stack_without = [name for name in settings.MIDDLEWARE if name != FAST_PATH]
+            full_stack = self.run('full stack', stack_without, targets)
+            fast_path = self.run('probe fast path', [FAST_PATH, *stack_without], targets)
+
+        self.stdout.write(self.style.SUCCESS(f'Speedup: {fast_path / full_stack:.1f}x'))
@@ -0,0 +1,53 @@
+import time
+
+import requests
+from django.core.management.base import BaseCommand
+
+from billing_app.router import RouterClient
+from billing_app.routerstub import StubRouter
+
+
+class Command(BaseCommand):
+    help = 'Benchmark router_api calls: per-call requests.post vs the pooled RouterClient (against a local stub)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=500, help='MACs to whitelist per run')
+        parser.add_argument('--latency', type=float, default=0.0, help='Stub router latency per request (seconds)')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def time_run(self, label, run, count):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'  {label:<28} {elapsed * 1000:9.1f} ms  {elapsed / count * 1000:7.2f} ms/device  '
+            f'{count / elapsed:8.0f} devices/s'
+        )
+        return elapsed
+
+    def handle(self, *args, **options):
+        server = StubRouter(latency=options['latency']).start()
+        macs = [f'02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x}' for i in range(options['devices'])]
+        auth = (server.username, server.password)
+
+        def legacy():
+            # What allow_access_router_api used to do: a fresh connection per device
+            for mac in macs:
+                requests.post(f'{server.base_url}/api/whitelist/add', json={'mac': mac}, auth=auth, timeout=5)
+
+        pooled = RouterClient(base_url=server.base_url, auth=auth, batch_api=False)
+        batched = RouterClient(base_url=server.base_url, auth=auth, batch_api=True,
+                               batch_size=options['batch_size'])
+        try:
+            self.stdout.write(f'Devices: {len(macs)}  stub latency: {options["latency"] * 1000:.0f} ms')
+            baseline = self.time_run('requests.post per call', legacy, len(macs))
+            keepalive = self.time_run('pooled session', lambda: pooled.whitelist_add(macs), len(macs))
+            batch = self.time_run(f'batch of {options["batch_size"]}', lambda: batched.whitelist_add(macs), len(macs))
+        finally:
+            pooled.close()
+            batched.close()
+            server.stop()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Speedup: keep-alive {baseline / keepalive:.1f}x, batched {baseline / batch:.1f}x'
+        ))
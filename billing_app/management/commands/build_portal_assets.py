@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from billing_app.assets import AssetBuilder, brotli, portal_assets, rjsmin
+
+
+def delivered(entry):
+    """Bytes a browser accepting br/gzip downloads for a bundle file"""
+    return min([entry['size'], *entry['encodings'].values()])
+
+
+class Command(BaseCommand):
+    help = 'Build the fingerprinted, precompressed asset bundle for the portal templates and report the savings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--template', action='append', dest='templates',
+                            help='Template to collect assets for (repeatable; default: PORTAL_TEMPLATES)')
+        parser.add_argument('--output', help='Bundle directory (default: PORTAL_ASSET_ROOT)')
+
+    def handle(self, *args, **options):
+        builder = AssetBuilder(options['templates'], options['output'])
+        manifest = builder.build()
+        portal_assets.reload()
+
+        files = manifest['files']
+        self.stdout.write(
+            f'{len(manifest["paths"])} assets -> {builder.root} '
+            f'({sum(entry["size"] for entry in files.values())} bytes, '
+            f'{sum(delivered(entry) for entry in files.values())} compressed)'
+        )
+        if brotli is None:
+            self.stdout.write('brotli not installed - only .gz variants written')
+        if rjsmin is None:
+            self.stdout.write('rjsmin not installed - scripts copied unminified')
+        for path in manifest['missing']:
+            self.stdout.write(self.style.WARNING(f'Referenced but not found: {path}'))
+
+        # What each page's own <link>/<script>/<img> tags fetch, before and after
+        self.stdout.write(f'{"Page":<16} {"files":>5} {"before":>10} {"minified":>10} {"delivered":>10}')
+        for template, paths in manifest['templates'].items():
+            built = [manifest['paths'][path] for path in paths if path in manifest['paths']]
+            before = sum(manifest['sources'][path] for path in paths if path in manifest['sources'])
+            minified = sum(files[name]['size'] for name in built)
+            after = sum(delivered(files[name]) for name in built)
+            self.stdout.write(
+                f'{template:<16} {len(built):>5} {before:>10} {minified:>10} {after:>10}  '
+                f'({(1 - after / before) * 100 if before else 0:.0f}% smaller)'
+            )
+        if not getattr(settings, 'PORTAL_ASSETS_SERVE', False):
+            self.stdout.write('PORTAL_ASSETS_SERVE is off - templates still link the original files')
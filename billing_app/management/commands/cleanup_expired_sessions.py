@@ -1,25 +1,50 @@
-from django.core.management.base import BaseCommand
-from django.utils import timezone
-from billing_app.models import WifiSession
-from billing_app.views import block_internet_access
+from django.core.management.base import BaseCommand, CommandError
+
+from billing_app.cleanup import cleanup_expired_sessions
+
 
 class Command(BaseCommand):
-    help = 'Clean up expired WiFi sessions'
+    help = 'Clean up expired WiFi sessions in chunks (one firewall batch and one UPDATE per chunk)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Sessions revoked per batch')
+        parser.add_argument('--limit', type=int, help='Stop after this many sessions')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Thread pool size for methods without batch revokes (router_api)')
+        parser.add_argument('--dry-run', action='store_true', help='List expired sessions without revoking them')
 
     def handle(self, *args, **options):
-        expired_sessions = WifiSession.objects.filter(
-            expires_at__lt=timezone.now(),
-            is_active=True
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        verbose = options['verbosity'] >= 2
+
+        def report_chunk(rows, results):
+            if not verbose:
+                return
+            for (_id, mac_address, ip_address), ok in zip(rows, results):
+                if options['dry_run']:
+                    self.stdout.write(f'Would expire {mac_address} ({ip_address})')
+                elif ok:
+                    self.stdout.write(self.style.SUCCESS(f'Blocked access for {mac_address}'))
+                else:
+                    self.stdout.write(self.style.WARNING(f'Failed to block {mac_address} - deactivated anyway'))
+
+        report = cleanup_expired_sessions(
+            chunk_size=options['chunk_size'],
+            limit=options['limit'],
+            dry_run=options['dry_run'],
+            max_workers=options['workers'],
+            on_chunk=report_chunk,
+        )
+
+        summary = (
+            f'{report.expired} sessions in {report.chunks} chunks, '
+            f'{report.elapsed:.2f}s ({report.rate:.0f} sessions/s)'
         )
-        
-        for session in expired_sessions:
-            # Block internet access
-            block_internet_access(session.mac_address)
-            
-            # Deactivate session
-            session.is_active = False
-            session.save()
-            
-            self.stdout.write(
-                self.style.SUCCESS(f'Expired session for {session.mac_address}')
-            )
\ No newline at end of file
+        if report.dry_run:
+            self.stdout.write(self.style.WARNING(f'Dry run - would expire {summary}'))
+        elif report.failed:
+            self.stdout.write(self.style.WARNING(f'Expired {summary}; {report.failed} firewall revokes failed'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Expired {summary}'))
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from billing_app.ledger import compact
+
+
+class Command(BaseCommand):
+    help = 'Fold payments into the hourly/daily revenue rollups (for REVENUE_ROLLUP_ON_WRITE = False)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Payments folded per transaction')
+        parser.add_argument('--interval', type=float,
+                            help='Keep running, compacting every this many seconds (default: run once)')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        while True:
+            close_old_connections()
+            started = time.monotonic()
+            folded = compact(batch_size=options['batch_size'])
+            if folded or options['interval'] is None:
+                elapsed = time.monotonic() - started
+                self.stdout.write(self.style.SUCCESS(f'Rolled up {folded} payments in {elapsed:.2f}s'))
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,64 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from billing_app.models import PaymentPlan, VoucherBatch
+from billing_app.vouchers import csv_export, generate_batch, sheet_export
+
+
+class Command(BaseCommand):
+    help = 'Generate a batch of prepaid voucher codes for a plan, optionally exporting it as CSV / printable HTML'
+
+    def add_arguments(self, parser):
+        parser.add_argument('plan', type=int, nargs='?', help='PaymentPlan id the vouchers are for')
+        parser.add_argument('count', type=int, nargs='?', help='Number of codes')
+        parser.add_argument('--label', default='', help='Name for the batch, e.g. the venue or print run')
+        parser.add_argument('--valid-days', type=int, help='Unredeemed codes expire after this many days')
+        parser.add_argument('--chunk-size', type=int, help='Vouchers per bulk_create transaction (default: VOUCHER_CHUNK_SIZE)')
+        parser.add_argument('--batch', type=int, help='Export this existing batch instead of generating one')
+        parser.add_argument('--csv', help='Write every code of the batch to this CSV file')
+        parser.add_argument('--sheet', help="Write printable cards for the batch's unused codes to this HTML file")
+
+    def handle(self, *args, **options):
+        if options['batch'] is not None:
+            try:
+                batch = VoucherBatch.objects.select_related('plan').get(pk=options['batch'])
+            except VoucherBatch.DoesNotExist:
+                raise CommandError(f'No voucher batch {options["batch"]}')
+        else:
+            batch = self.generate(options)
+
+        for option, export in (('csv', csv_export), ('sheet', sheet_export)):
+            if options[option]:
+                with open(options[option], 'w', newline='') as f:
+                    f.writelines(export(batch))
+                self.stdout.write(f'Wrote {options[option]}')
+
+    def generate(self, options):
+        if options['plan'] is None or options['count'] is None:
+            raise CommandError('Give a plan id and a count (or --batch to export an existing batch)')
+        if options['count'] < 1:
+            raise CommandError('count must be at least 1')
+        try:
+            plan = PaymentPlan.objects.get(pk=options['plan'])
+        except PaymentPlan.DoesNotExist:
+            raise CommandError(f'No payment plan {options["plan"]}')
+        expires_at = None
+        if options['valid_days']:
+            expires_at = timezone.now() + timedelta(days=options['valid_days'])
+
+        started = time.monotonic()
+
+        def progress(created, count):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'  {created}/{count}')
+
+        batch = generate_batch(plan, options['count'], options['label'], expires_at, options['chunk_size'], progress)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Batch {batch.pk}: {batch.count} vouchers for {plan.name} in {elapsed:.2f}s '
+            f'({batch.count / elapsed:.0f}/s)'
+        ))
+        return batch
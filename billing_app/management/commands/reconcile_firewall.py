@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from billing_app.reconcile import ReconcileNotSupported, get_reconcile_backend, reconcile_firewall
+
+
+class Command(BaseCommand):
+    help = 'Converge firewall rules/sets to the active WiFi sessions in one batch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report drift without changing the firewall')
+        parser.add_argument('--method', help='Override TRAFFIC_CONTROL_METHOD (iptables, ipset, nftables)')
+        parser.add_argument('--verbose-drift', action='store_true', help='List every missing/stale entry')
+
+    def handle(self, *args, **options):
+        try:
+            backend = get_reconcile_backend(options['method'])
+        except ReconcileNotSupported as e:
+            raise CommandError(str(e))
+
+        started = time.perf_counter()
+        report = reconcile_firewall(backend, dry_run=options['dry_run'])
+        total_ms = (time.perf_counter() - started) * 1000
+
+        self.stdout.write(f'Method: {report.method}')
+        self.stdout.write(f'Desired entries: {report.desired}  Current entries: {report.current}')
+        self.stdout.write(
+            f'Drift: {len(report.missing)} missing, {len(report.stale)} stale, {report.duplicates} duplicates'
+        )
+        if options['verbose_drift']:
+            for kind, value in report.missing:
+                self.stdout.write(f'  + {kind} {value}')
+            for kind, value in report.stale:
+                self.stdout.write(f'  - {kind} {value}')
+
+        timings = '  '.join(f'{name}={value:.1f}' for name, value in report.timings.items())
+        self.stdout.write(f'Timing (ms): {timings}  total={total_ms:.1f}')
+
+        if not report.drift:
+            self.stdout.write(self.style.SUCCESS('Firewall already in sync'))
+        elif report.applied:
+            self.stdout.write(self.style.SUCCESS(f'Applied {report.drift} changes in one batch'))
+        else:
+            self.stdout.write(self.style.WARNING('Dry run - no changes applied'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from billing_app.provisioning import ProvisioningQueue
+
+
+class Command(BaseCommand):
+    help = "Apply the grants of paid sessions a previous process left 'pending' (once per host, before the web workers)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=float, help='Seconds to wait for grants and their retries')
+
+    def handle(self, *args, **options):
+        provisioning = ProvisioningQueue()
+        count = provisioning.requeue_pending()
+        if not count:
+            self.stdout.write('No pending sessions')
+            return
+        if not provisioning.join(options['timeout']):
+            unfinished = provisioning.stats()['unfinished']
+            self.stdout.write(self.style.WARNING(f'Re-queued {count} sessions, {unfinished} still unfinished'))
+            return
+        self.stdout.write(self.style.SUCCESS(f'Re-queued {count} sessions, all attempted'))
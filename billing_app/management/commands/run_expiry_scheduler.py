@@ -0,0 +1,75 @@
+import select
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from billing_app.expiry import ExpiryScheduler, scheduler_address
+
+
+class Command(BaseCommand):
+    help = 'Revoke WiFi access exactly at each session\'s expires_at (replaces cron cleanup)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horizon', type=int, default=3600,
+                            help='Look-ahead window (seconds) loaded from the database')
+        parser.add_argument('--address', help='host:port to listen on for notifications')
+        parser.add_argument('--stats-interval', type=int, default=300,
+                            help='Seconds between lateness summaries')
+
+    def handle(self, *args, **options):
+        if options['address']:
+            host, port = options['address'].rsplit(':', 1)
+            address = (host, int(port))
+        else:
+            address = tuple(scheduler_address())
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(address)
+        sock.setblocking(False)
+
+        scheduler = ExpiryScheduler()
+        horizon = options['horizon']
+        # Reload the window halfway through so nothing falls past its edge
+        reload_every = max(1, horizon // 2)
+        next_reload = 0
+        next_stats = time.monotonic() + options['stats_interval']
+
+        self.stdout.write(f'Expiry scheduler listening on {address[0]}:{address[1]} (horizon {horizon}s)')
+        try:
+            while True:
+                if time.monotonic() >= next_reload:
+                    close_old_connections()
+                    loaded = scheduler.load_window(horizon)
+                    self.stdout.write(f'Loaded {loaded} upcoming expiries')
+                    next_reload = time.monotonic() + reload_every
+
+                timeout = scheduler.seconds_until_next()
+                until_reload = max(0.0, next_reload - time.monotonic())
+                timeout = until_reload if timeout is None else min(timeout, until_reload)
+
+                readable, _, _ = select.select([sock], [], [], timeout)
+                if readable:
+                    while True:
+                        try:
+                            data = sock.recv(4096)
+                        except BlockingIOError:
+                            break
+                        scheduler.handle_datagram(data)
+
+                due = scheduler.pop_due()
+                if due:
+                    close_old_connections()
+                    revoked = scheduler.revoke(due)
+                    if revoked:
+                        self.stdout.write(self.style.SUCCESS(f'Revoked {revoked} expired sessions'))
+
+                if time.monotonic() >= next_stats:
+                    self.stdout.write(f'Lateness: {scheduler.lateness_summary()}')
+                    scheduler.lateness.clear()
+                    next_stats = time.monotonic() + options['stats_interval']
+        except KeyboardInterrupt:
+            self.stdout.write(f'Lateness: {scheduler.lateness_summary()}')
+        finally:
+            sock.close()
@@ -0,0 +1,55 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from billing_app.firewall import CommandExecutor
+from billing_app.firewallhelper import METHODS, FakeExecutor, FirewallHelper, Ruleset
+
+
+class Command(BaseCommand):
+    help = 'Run the privileged firewall helper the app sends grants/revocations to (as root, one per gateway)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', help='Unix socket to listen on (default: FIREWALL_HELPER_SOCKET)')
+        parser.add_argument('--method', choices=METHODS,
+                            help='Ruleset to manage (default: TRAFFIC_CONTROL_METHOD)')
+        parser.add_argument('--window', type=float,
+                            help='Seconds to coalesce requests into one commit (default: FIREWALL_HELPER_WINDOW)')
+        parser.add_argument('--group', help='Group allowed to connect (the socket is mode 0660)')
+        parser.add_argument('--sudo', action='store_true',
+                            help='Run the firewall commands through sudo (when not started as root)')
+        parser.add_argument('--fake', action='store_true',
+                            help='Run no firewall commands - for throughput testing without root')
+        parser.add_argument('--fake-latency', type=float, default=0.005,
+                            help='With --fake: seconds each command holds the simulated xtables lock')
+
+    def handle(self, *args, **options):
+        path = options['socket'] or getattr(settings, 'FIREWALL_HELPER_SOCKET', None)
+        if not path:
+            raise CommandError('Set FIREWALL_HELPER_SOCKET or pass --socket')
+        method = options['method'] or getattr(settings, 'TRAFFIC_CONTROL_METHOD', 'simulation')
+        if method not in METHODS:
+            raise CommandError(f'TRAFFIC_CONTROL_METHOD {method!r} needs no firewall helper (use --method)')
+
+        if options['fake']:
+            executor = FakeExecutor(options['fake_latency'])
+        else:
+            executor = CommandExecutor(use_sudo=options['sudo'])
+        server = FirewallHelper(path, Ruleset(method, executor), options['window'], group=options['group'])
+
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        server.start()
+        self.stdout.write(
+            f'Firewall helper ({method}{", fake" if options["fake"] else ""}) on {path}, '
+            f'coalescing window {server.window * 1000:g} ms'
+        )
+        try:
+            stop.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+        self.stdout.write(f'Stopped: {server.stats()}')
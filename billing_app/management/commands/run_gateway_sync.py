@@ -0,0 +1,42 @@
+import contextlib
+import os
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from billing_app.gateways import BusError, GatewaySync, node_id, open_bus
+
+
+class Command(BaseCommand):
+    help = "Apply the other gateways' grants and revocations to this gateway's firewall (one per gateway)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--block', type=float, default=1.0,
+                            help='Seconds each XREAD waits for new events')
+        parser.add_argument('--resync', action='store_true',
+                            help='Ignore the saved cursor: reconcile from the database, then follow new events')
+
+    def handle(self, *args, **options):
+        bus = open_bus()
+        if bus is None:
+            raise CommandError('GATEWAY_BUS_URL is not set - this gateway is running standalone')
+        sync = GatewaySync(bus, node_id())
+        if options['resync'] and sync.cursor_path:
+            # Without a cursor, catch_up() reconciles before following the stream
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(sync.cursor_path)
+
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        try:
+            cursor = sync.catch_up()
+        except BusError as e:
+            raise CommandError(f'Cannot reach {settings.GATEWAY_BUS_URL}: {e}')
+        self.stdout.write(f'Gateway {sync.node} following {settings.GATEWAY_BUS_URL} from event {cursor}')
+        try:
+            sync.run(block=options['block'], stop=stop)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(f"Stopped: {sync.stats()}")
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from billing_app.routerstub import StubRouter
+
+
+class Command(BaseCommand):
+    help = 'Serve a local stub of the router whitelist API (for offline testing of router_api)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default='127.0.0.1:8081', help='host:port to listen on')
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of requests answered 503')
+
+    def handle(self, *args, **options):
+        host, port = options['address'].rsplit(':', 1)
+        server = StubRouter(
+            (host, int(port)),
+            username=settings.ROUTER_USERNAME,
+            password=settings.ROUTER_PASSWORD,
+            latency=options['latency'],
+            failure_rate=options['failure_rate'],
+        )
+        self.stdout.write(f'Stub router listening on {server.base_url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(f'Served {server.requests} requests, {len(server.whitelist)} MACs whitelisted')
+        finally:
+            server.server_close()
@@ -0,0 +1,163 @@
+"""
+Per-device usage metering from firewall counters.
+
+Plans are sold by time, but operators still want to see who uses what.
+Running `iptables -L` per device would cost a process spawn per MAC. Instead,
+every collection reads every paid-device rule or set element in one dump
+through the traffic-control backend's counters():
+
+- `iptables-save -c` for the CAPTIVE_PORTAL chain;
+- `ipset save` or `nft -j list table` for the set methods (their sets are
+  created with counters).
+
+The collector subtracts the previous reading to get per-MAC deltas. A
+counter that went backwards (a rule rewritten, an element re-added) counts
+from zero. IP rules are attributed to the MAC of the active session on that
+IP. Deltas are stored in UsageSample at three resolutions:
+
+- raw, one row per collection;
+- 5-minute buckets;
+- hourly buckets.
+
+The coarser buckets are incremented in the same transaction as the raw
+rows, so downsampling never has to re-read raw data. Each tier is pruned
+after its USAGE_RETENTION.
+
+The grant rules match on the device's source address, so these are the
+bytes and packets each device sent. Run `manage.py run_usage_meter` as one
+process per gateway. Deltas live in its memory, so the first reading after
+a restart only sets a baseline.
+"""
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import UsageSample, WifiSession
+from .reconcile import get_reconcile_backend
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETENTION = {'raw': 86400, '5m': 7 * 86400, '1h': 90 * 86400}
+TIERS = {'raw': UsageSample.RAW, '5m': UsageSample.FIVE_MINUTES, '1h': UsageSample.HOURLY}
+
+
+def floor_time(when, seconds):
+    """Start of the `seconds`-long bucket holding `when` (buckets aligned to the epoch, UTC)"""
+    epoch_seconds = int(when.timestamp())
+    return when - timedelta(seconds=epoch_seconds % seconds, microseconds=when.microsecond)
+
+
+@dataclass
+class MeterReport:
+    devices: int = 0
+    bytes: int = 0
+    packets: int = 0
+    pruned: int = 0
+    unattributed: list = field(default_factory=list)  # IPs with traffic but no active session
+    elapsed: float = 0.0
+
+
+class UsageMeter:
+    """Turns successive counter dumps into UsageSample rows"""
+
+    def __init__(self, source=None, retention=None):
+        self._source = source
+        self.retention = {**DEFAULT_RETENTION, **(retention or getattr(settings, 'USAGE_RETENTION', {}))}
+        self._previous = None  # (kind, value) -> (packets, bytes) at the last collection
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = get_reconcile_backend()
+        return self._source
+
+    def deltas(self, readings):
+        """{(kind, value): (packets, bytes)} grown since the previous readings"""
+        previous, self._previous = self._previous, readings
+        if previous is None:
+            return {}
+        deltas = {}
+        for key, (packets, bytes_) in readings.items():
+            seen_packets, seen_bytes = previous.get(key, (0, 0))
+            if packets < seen_packets or bytes_ < seen_bytes:
+                seen_packets = seen_bytes = 0  # counter reset
+            if bytes_ > seen_bytes or packets > seen_packets:
+                deltas[key] = (packets - seen_packets, bytes_ - seen_bytes)
+        return deltas
+
+    def by_mac(self, deltas, report):
+        """Fold ('ip', ...) deltas into the MAC of the active session holding that IP"""
+        ips = [value for kind, value in deltas if kind == 'ip']
+        owners = dict(
+            WifiSession.objects.filter(ip_address__in=ips, is_active=True).values_list('ip_address', 'mac_address')
+        ) if ips else {}
+        usage = {}
+        for (kind, value), (packets, bytes_) in deltas.items():
+            mac = value if kind == 'mac' else owners.get(value)
+            if mac is None:
+                report.unattributed.append(value)
+                continue
+            seen_packets, seen_bytes = usage.get(mac, (0, 0))
+            usage[mac] = (seen_packets + packets, seen_bytes + bytes_)
+        return usage
+
+    def collect(self, now=None):
+        """Read the counters once, store the deltas and prune expired samples"""
+        started = time.perf_counter()
+        now = now or timezone.now()
+        report = MeterReport()
+        usage = self.by_mac(self.deltas(self.source.counters()), report)
+        with transaction.atomic():
+            if usage:
+                self.store(usage, now)
+            report.pruned = self.prune(now)
+        report.devices = len(usage)
+        report.packets = sum(packets for packets, _b in usage.values())
+        report.bytes = sum(bytes_ for _p, bytes_ in usage.values())
+        report.elapsed = time.perf_counter() - started
+        return report
+
+    def store(self, usage, now):
+        UsageSample.objects.bulk_create([
+            UsageSample(mac_address=mac, resolution=UsageSample.RAW, bucket_start=now, packets=packets, bytes=bytes_)
+            for mac, (packets, bytes_) in usage.items()
+        ])
+        for resolution in (UsageSample.FIVE_MINUTES, UsageSample.HOURLY):
+            bucket = floor_time(now, resolution)
+            # One collector per gateway owns these rows: read the bucket, write it back in one upsert
+            current = {
+                sample.mac_address: sample
+                for sample in UsageSample.objects.filter(resolution=resolution, bucket_start=bucket)
+            }
+            samples = []
+            for mac, (packets, bytes_) in usage.items():
+                sample = current.get(mac) or UsageSample(mac_address=mac, resolution=resolution, bucket_start=bucket)
+                sample.packets += packets
+                sample.bytes += bytes_
+                samples.append(sample)
+            UsageSample.objects.bulk_create(
+                samples, update_conflicts=True, update_fields=['packets', 'bytes'],
+                unique_fields=['mac_address', 'resolution', 'bucket_start'],
+            )
+
+    def prune(self, now):
+        pruned = 0
+        for name, resolution in TIERS.items():
+            cutoff = now - timedelta(seconds=self.retention[name])
+            # No relations or signals - a single DELETE over usage_resolution_bucket_idx
+            pruned += UsageSample.objects.filter(resolution=resolution, bucket_start__lt=cutoff).delete()[0]
+        return pruned
+
+
+def usage_since(mac_address, since):
+    """(bytes, packets) the device sent since `since`, from the hourly tier; None before any sample"""
+    totals = UsageSample.objects.filter(
+        mac_address=mac_address, resolution=UsageSample.HOURLY, bucket_start__gte=floor_time(since, 3600)
+    ).aggregate(bytes=Sum('bytes'), packets=Sum('packets'))
+    return None if totals['bytes'] is None else (totals['bytes'], totals['packets'])
@@ -0,0 +1,395 @@
+"""
+In-process metrics exported in the Prometheus text format at /metrics.
+
+Recording sits on the request path, so it must not serialize the threads
+doing the work. Every counter and histogram keeps one shard per thread: an
+observation is a bisect plus a few list increments in the calling thread's
+own shard, with no lock. The registry lock is only taken the first time a
+thread touches a metric and when a scrape sums the shards.
+
+Each process has its own registry. With several workers, set METRICS_DIR to
+a directory all of them can write: every process dumps a snapshot there
+every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the files of the
+processes that are still alive. Gauges read from the database (active
+sessions, upcoming expiries) are computed once per scrape.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+# Per-request query counter, read by the execute wrapper on every connection
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Sharded:
+    """Per-thread series: label values -> list of numbers, summed on collect"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _series(self, labelvalues):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        series = shard.get(labelvalues)
+        if series is None:
+            series = shard[labelvalues] = self._new_series()
+        return series
+
+    def collect(self):
+        """{label values: summed series} across every thread"""
+        with self._lock:
+            shards = list(self._shards)
+        totals = {}
+        for shard in shards:
+            for labelvalues, series in list(shard.items()):
+                total = totals.get(labelvalues)
+                if total is None:
+                    totals[labelvalues] = list(series)
+                else:
+                    for i, value in enumerate(series):
+                        total[i] += value
+        return totals
+
+
+class Counter(_Sharded):
+    kind = 'counter'
+
+    def _new_series(self):
+        return [0]
+
+    def inc(self, *labelvalues, amount=1):
+        self._series(labelvalues)[0] += amount
+
+    def render(self, totals):
+        for labelvalues, (value,) in sorted(totals.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}'
+
+
+class Histogram(_Sharded):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_series(self):
+        # One count per bucket, then +Inf, then the sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value, *labelvalues):
+        series = self._series(labelvalues)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def render(self, totals):
+        for labelvalues, series in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, [('le', _format_value(bound))])
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f'{self.name}_sum{labels} {_format_value(series[-1])}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Gauge:
+    """Value read at collect time: collect() returns a number or {label values: number}
+
+    Per-process gauges (queue depth, cache counters) travel in snapshots and are
+    summed across workers; shared ones (database counts) are only read by the
+    process answering the scrape.
+    """
+
+    def __init__(self, name, documentation, collect, labelnames=(), kind='gauge', per_process=True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+        self.per_process = per_process
+        self._collect = collect
+
+    def collect(self):
+        value = self._collect()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return {labelvalues: [number] for labelvalues, number in value.items()}
+
+    def render(self, totals):
+        for labelvalues, (value,) in sorted(totals.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, collect, labelnames=(), kind='gauge', per_process=True):
+        return self.register(Gauge(name, documentation, collect, labelnames, kind, per_process))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self):
+        """This process's per-process series, JSON-serializable"""
+        snapshot = {}
+        for metric in self.metrics():
+            if getattr(metric, 'per_process', True):
+                try:
+                    totals = metric.collect()
+                except Exception as e:
+                    logger.warning(f"Collecting {metric.name} failed: {e}")
+                    continue
+                snapshot[metric.name] = [[list(labelvalues), series] for labelvalues, series in totals.items()]
+        return snapshot
+
+    def write_snapshot(self, directory):
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.snapshot(), fh)
+        os.replace(tmp, path)  # readers never see a half-written file
+
+    def start_flusher(self, directory, interval):
+        """Dump snapshots to `directory` every `interval` seconds from a daemon thread"""
+        with self._lock:
+            if self._flusher is not None:
+                return
+            os.makedirs(directory, exist_ok=True)
+            self._flusher = threading.Thread(
+                target=self._flush_forever, args=(directory, interval), name='metrics-flusher', daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_forever(self, directory, interval):
+        while True:
+            try:
+                self.write_snapshot(directory)
+            except OSError as e:
+                logger.warning(f"Writing metrics snapshot failed: {e}")
+            time.sleep(interval)
+
+    def _peer_snapshots(self, directory):
+        for entry in os.listdir(directory):
+            if not entry.endswith('.json'):
+                continue
+            try:
+                pid = int(entry[:-5])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            path = os.path.join(directory, entry)
+            if not _alive(pid):
+                # Worker exited or was recycled - its counters restart with the new one
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as fh:
+                    yield json.load(fh)
+            except (OSError, ValueError):
+                continue
+
+    def render(self, directory=None):
+        """Prometheus text exposition of every metric, summed across METRICS_DIR peers"""
+        peers = list(self._peer_snapshots(directory)) if directory and os.path.isdir(directory) else []
+        lines = []
+        for metric in self.metrics():
+            try:
+                totals = metric.collect()
+            except Exception as e:
+                logger.warning(f"Collecting {metric.name} failed: {e}")
+                continue
+            if getattr(metric, 'per_process', True):
+                for peer in peers:
+                    for labelvalues, series in peer.get(metric.name, []):
+                        labelvalues = tuple(labelvalues)
+                        total = totals.setdefault(labelvalues, [0] * len(series))
+                        for i, value in enumerate(series):
+                            total[i] += value
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render(totals))
+        return '\n'.join(lines) + '\n'
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+
+portal_decision_seconds = registry.histogram(
+    'wifi_portal_decision_seconds', 'CaptivePortalMiddleware decision latency', ['decision'])
+mac_resolution_seconds = registry.histogram(
+    'wifi_mac_resolution_seconds', 'Client IP to MAC resolution latency', ['result'])
+request_seconds = registry.histogram('wifi_request_seconds', 'Request latency through the whole middleware stack')
+request_queries = registry.histogram(
+    'wifi_db_queries_per_request', 'Database queries per request', buckets=QUERY_BUCKETS)
+traffic_control_seconds = registry.histogram(
+    'wifi_traffic_control_seconds', 'Firewall / router grant and revoke latency', ['method', 'action'])
+traffic_control_failures = registry.counter(
+    'wifi_traffic_control_failures_total', 'Grants and revokes that reported failure', ['method', 'action'])
+router_request_seconds = registry.histogram(
+    'wifi_router_request_seconds', 'Router API call latency including retries', ['path', 'outcome'])
+provisioning_wait_seconds = registry.histogram(
+    'wifi_provisioning_wait_seconds', 'Time a paid session waited in the provisioning queue')
+
+
+# Request query counting
+
+def _count_query(execute, sql, params, many, context):
+    counter = _request_queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def _install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _count_query)
+
+
+def install_query_counter():
+    """Count the queries of every request on every new connection"""
+    from django.db.backends.signals import connection_created
+    connection_created.connect(_install_query_counter, dispatch_uid='metrics_query_counter')
+
+
+def start_request():
+    """Begin counting queries for the current request; pass the token to finish_request()"""
+    return _request_queries.set([0]), time.perf_counter()
+
+
+def finish_request(state):
+    token, start = state
+    queries = _request_queries.get()
+    _request_queries.reset(token)
+    request_seconds.observe(time.perf_counter() - start)
+    if queries is not None:
+        request_queries.observe(queries[0])
+
+
+def start_flusher():
+    directory = getattr(settings, 'METRICS_DIR', None)
+    if directory:
+        registry.start_flusher(directory, getattr(settings, 'METRICS_FLUSH_INTERVAL', 5))
+
+
+def install_collectors():
+    """Gauges over the app's shared state - imported lazily to keep this module dependency-free"""
+    from datetime import timedelta
+
+    from django.utils import timezone
+
+    from .authcache import authorization_cache
+    from .leases import lease_index
+    from .models import WifiSession
+    from .neighbors import neighbor_table
+    from .provisioning import provisioning_queue
+    from .reconcile import live_sessions
+
+    def provisioning_jobs():
+        stats = provisioning_queue.stats()
+        return {('queued',): stats['queued'], ('unfinished',): stats['unfinished']}
+
+    def expiring():
+        now = timezone.now()
+        return {
+            (label,): WifiSession.objects.filter(
+                is_active=True, is_paid=True, expires_at__gt=now, expires_at__lte=now + window
+            ).count()
+            for label, window in (('5m', timedelta(minutes=5)), ('1h', timedelta(hours=1)))
+        }
+
+    registry.gauge('wifi_provisioning_jobs', 'Provisioning jobs waiting or in flight', provisioning_jobs, ['state'])
+    registry.gauge(
+        'wifi_neighbor_lookups_total', 'Neighbor table lookups', kind='counter', labelnames=['result'],
+        collect=lambda: {('hit',): neighbor_table.hits, ('miss',): neighbor_table.misses},
+    )
+    registry.gauge('wifi_neighbor_refreshes_total', 'Neighbor table reloads',
+                   lambda: neighbor_table.refreshes, kind='counter')
+    registry.gauge(
+        'wifi_authorization_cache_lookups_total', 'Authorization cache lookups', kind='counter', labelnames=['result'],
+        collect=lambda: {('hit',): authorization_cache.hits, ('miss',): authorization_cache.misses},
+    )
+    registry.gauge(
+        'wifi_lease_lookups_total', 'DHCP lease index lookups', kind='counter', labelnames=['result'],
+        collect=lambda: {('hit',): lease_index.hits, ('miss',): lease_index.misses},
+    )
+    registry.gauge('wifi_dhcp_leases', 'Current leases in the DHCP lease index', lambda: len(lease_index._leases))
+    registry.gauge('wifi_active_paid_sessions', 'Paid sessions that have not expired',
+                   lambda: live_sessions(timezone.now()).count(), per_process=False)
+    registry.gauge('wifi_sessions_expiring', 'Paid sessions expiring within the window', expiring,
+                   ['within'], per_process=False)
@@ -1,14 +1,66 @@
 from django.shortcuts import redirect
-from django.urls import reverse, resolve
 from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
-from .views import get_client_mac, get_client_ip
+from .views import aget_client_mac, get_client_mac, get_client_ip
 from .models import WifiSession
-from django.utils import timezone
+from .authcache import authorization_cache
+from .bypass import BypassMatcher
+from .macaddr import dev_mac
+from .metrics import finish_request, portal_decision_seconds, start_flusher, start_request
+from .probes import PROBES, probe_preloader
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+# All AuthorizationCache.store_session() reads
+SESSION_AUTH_FIELDS = ('is_paid', 'is_active', 'expires_at')
+
+def device_mac(request, client_mac):
+    client_ip = get_client_ip(request)
+    
+    # Log for debugging
+    logger.debug(f"Captive portal check - IP: {client_ip}, MAC: {client_mac}, Path: {request.path}")
+    
+    # In development, create a test MAC if none found
+    if not client_mac and getattr(settings, 'ENVIRONMENT', 'development') == 'development':
+        client_mac = dev_mac(client_ip or '127.0.0.1')
+        logger.debug(f"Development mode - using test MAC: {client_mac}")
+    return client_mac
+
+
+class CaptivePortalProbeMiddleware(MiddlewareMixin):
+    """Answers OS connectivity probes from memory, before sessions, CSRF, auth or the ORM (see probes.py)"""
+
+    async def __acall__(self, request):
+        probe = PROBES.get(request.path_info)
+        if probe is not None:
+            start = time.perf_counter()
+            if probe_preloader.due():
+                await probe_preloader.aload()
+            response = self.respond(probe, device_mac(request, await aget_client_mac(request)), start)
+            if response is not None:
+                return response
+        return await self.get_response(request)
+
+    def process_request(self, request):
+        probe = PROBES.get(request.path_info)
+        if probe is None:
+            return None
+        start = time.perf_counter()
+        if probe_preloader.due():
+            probe_preloader.load()
+        return self.respond(probe, device_mac(request, get_client_mac(request)), start)
+
+    def respond(self, probe, client_mac, start):
+        authorized = authorization_cache.decision(client_mac) if client_mac else False
+        if authorized is None:
+            # Changed since the last preload - CaptivePortalMiddleware asks the database
+            return None
+        portal_decision_seconds.observe(time.perf_counter() - start, 'probe_online' if authorized else 'probe_redirect')
+        return probe.success() if authorized else redirect('portal_login')
+
+
 class CaptivePortalMiddleware(MiddlewareMixin):
     def __init__(self, get_response=None):
         super().__init__(get_response)
@@ -22,6 +74,8 @@ class CaptivePortalMiddleware(MiddlewareMixin):
             '/portal/',
             '/payment/',
             '/process-payment/',
+            '/redeem-voucher/',
+            '/provisioning-status/',
             '/internet-access/',
             '/__debug__/',  # Django debug toolbar
             '/favicon.ico',
@@ -33,81 +87,113 @@ class CaptivePortalMiddleware(MiddlewareMixin):
             'select_plan', 
             'payment_page',
             'process_payment',
+            'redeem_voucher',
+            'provisioning_status',
             'internet_access',
+            'metrics',
             'admin:index',
         ]
 
+        # Whole namespaces that bypass (e.g. every admin page)
+        self.bypass_namespaces = ['admin']
+
+        # Compiled once - one regex match per request instead of resolve()
+        self.bypass_matcher = BypassMatcher(self.bypass_urls, self.bypass_url_names, self.bypass_namespaces)
+
+    async def __acall__(self, request):
+        # Native async path under ASGI - no thread hop for the portal check
+        response = await self.aprocess_request(request)
+        return response or await self.get_response(request)
+
     def process_request(self, request):
-        # Skip in development if explicitly disabled
-        if (getattr(settings, 'ENVIRONMENT', 'development') == 'development' and 
-            getattr(settings, 'DISABLE_CAPTIVE_PORTAL', False)):
-            return None
-        
-        # Check if current URL should bypass captive portal
-        if self.should_bypass(request):
+        start = time.perf_counter()
+        if self.skip(request):
+            portal_decision_seconds.observe(time.perf_counter() - start, 'bypass')
             return None
         
         # Get client information
-        client_mac = get_client_mac(request)
-        client_ip = get_client_ip(request)
+        client_mac = self.device_mac(request, get_client_mac(request))
+        
+        authorized = False
+        if client_mac:
+            authorized = authorization_cache.get(client_mac)
+            if authorized is None:
+                try:
+                    session = WifiSession.objects.only(*SESSION_AUTH_FIELDS).get(mac_address=client_mac)
+                except WifiSession.DoesNotExist:
+                    session = None
+                authorized = authorization_cache.store_session(client_mac, session)
+        return self.respond(client_mac, authorized, start)
+
+    async def aprocess_request(self, request):
+        """process_request with async neighbor lookup and ORM calls"""
+        start = time.perf_counter()
+        if self.skip(request):
+            portal_decision_seconds.observe(time.perf_counter() - start, 'bypass')
+            return None
         
-        # Log for debugging
-        logger.debug(f"Captive portal check - IP: {client_ip}, MAC: {client_mac}, Path: {request.path}")
+        client_mac = self.device_mac(request, await aget_client_mac(request))
         
-        # In development, create a test MAC if none found
-        if not client_mac and getattr(settings, 'ENVIRONMENT', 'development') == 'development':
-            client_mac = f"dev:mac:{hash(client_ip or '127.0.0.1') % 1000000:06d}"
-            logger.debug(f"Development mode - using test MAC: {client_mac}")
+        authorized = False
+        if client_mac:
+            authorized = authorization_cache.get(client_mac)
+            if authorized is None:
+                try:
+                    session = await WifiSession.objects.only(*SESSION_AUTH_FIELDS).aget(mac_address=client_mac)
+                except WifiSession.DoesNotExist:
+                    session = None
+                authorized = authorization_cache.store_session(client_mac, session)
+        return self.respond(client_mac, authorized, start)
+
+    def skip(self, request):
+        # Skip in development if explicitly disabled
+        if (getattr(settings, 'ENVIRONMENT', 'development') == 'development' and 
+            getattr(settings, 'DISABLE_CAPTIVE_PORTAL', False)):
+            return True
         
+        # Check if current URL should bypass captive portal
+        return self.should_bypass(request)
+
+    def device_mac(self, request, client_mac):
+        return device_mac(request, client_mac)
+
+    def respond(self, client_mac, authorized, start):
+        portal_decision_seconds.observe(time.perf_counter() - start, 'allowed' if authorized else 'redirect')
+        if authorized:
+            # Valid session - allow access
+            return None
+
         if client_mac:
-            try:
-                session = WifiSession.objects.get(mac_address=client_mac)
-                
-                # Check if session is valid and paid
-                if (session.is_paid and 
-                    session.expires_at and 
-                    session.expires_at > timezone.now() and
-                    session.is_active):
-                    # Valid session - allow access
-                    return None
-                else:
-                    # Invalid/expired session - redirect to portal
-                    logger.debug(f"Invalid session for {client_mac} - redirecting to portal")
-                    return redirect('portal_login')
-                    
-            except WifiSession.DoesNotExist:
-                # New device - redirect to portal
-                logger.debug(f"New device {client_mac} - redirecting to portal")
-                return redirect('portal_login')
+            # New device or invalid/expired session - redirect to portal
+            logger.debug(f"Unauthorized device {client_mac} - redirecting to portal")
         else:
             # Can't identify device - redirect to portal (it will handle the error)
             logger.debug("Cannot identify device - redirecting to portal")
-            return redirect('portal_login')
-        
-        return None
+        return redirect('portal_login')
     
     def should_bypass(self, request):
         """Check if the current request should bypass captive portal"""
-        
-        # Check URL paths
-        for bypass_url in self.bypass_urls:
-            if request.path.startswith(bypass_url):
-                return True
-        
-        # Check URL names (safer method)
-        try:
-            resolved_url = resolve(request.path_info)
-            if resolved_url.url_name in self.bypass_url_names:
-                return True
-            
-            # Check namespaced URLs (like admin:*)
-            if resolved_url.namespace:
-                full_name = f"{resolved_url.namespace}:{resolved_url.url_name}"
-                if full_name in self.bypass_url_names or resolved_url.namespace in ['admin']:
-                    return True
-                    
-        except Exception as e:
-            logger.debug(f"Could not resolve URL {request.path}: {e}")
-        
-        return False
+        return self.bypass_matcher.matches(request.path_info)
+
+
+class RequestMetricsMiddleware(MiddlewareMixin):
+    """Request latency and database queries per request, exported at /metrics"""
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        # Only serving processes dump METRICS_DIR snapshots
+        start_flusher()
+
+    async def __acall__(self, request):
+        self.process_request(request)
+        response = await self.get_response(request)
+        return self.process_response(request, response)
+
+    def process_request(self, request):
+        request._metrics_state = start_request()
 
+    def process_response(self, request, response):
+        state = getattr(request, '_metrics_state', None)
+        if state is not None:
+            finish_request(state)
+        return response
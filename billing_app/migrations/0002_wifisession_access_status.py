@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wifisession',
+            name='access_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='wifisession',
+            name='access_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('live', 'Live'), ('failed', 'Failed')], max_length=10),
+        ),
+    ]
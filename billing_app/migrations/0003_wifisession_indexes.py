@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing_app', '0002_wifisession_access_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='wifisession',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['expires_at'], name='wifisession_active_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wifisession',
+            index=models.Index(condition=models.Q(('is_active', True), ('is_paid', True)), fields=['expires_at'], name='wifisession_paid_live_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wifisession',
+            index=models.Index(fields=['created_at'], name='wifisession_created_idx'),
+        ),
+    ]
@@ -0,0 +1,99 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:02
+
+import zlib
+
+from django.db import migrations, models
+
+import billing_app.macaddr
+
+
+SYNTHETIC_BASE = 0x0201_0000_0000  # locally administered 02:01:xx:xx:xx:xx
+SYNTHETIC_MASK = 0xffff_ffff
+
+
+def keep_first(session):
+    """Among rows that are the same device: the live paid one, else the latest"""
+    live = session.is_paid and session.is_active
+    return (not live, -(session.expires_at.timestamp() if session.expires_at else 0),
+            -session.created_at.timestamp(), -session.id)
+
+
+def macs_to_int(apps, schema_editor):
+    WifiSession = apps.get_model('billing_app', 'WifiSession')
+    sessions = list(WifiSession.objects.only(
+        'id', 'mac_address', 'is_paid', 'is_active', 'expires_at', 'created_at'
+    ).order_by('id'))
+
+    devices, unparsed = {}, []
+    for session in sessions:
+        try:
+            devices.setdefault(billing_app.macaddr.parse_mac(session.mac_address), []).append(session)
+        except ValueError:
+            unparsed.append(session)
+
+    # 'AA:BB:...' and 'aa-bb-...' are one device: merge into its live/latest row, never
+    # onto a neighbouring MAC that belongs to some other device
+    keep, duplicates = [], []
+    for value, rows in devices.items():
+        rows.sort(key=keep_first)
+        rows[0].mac_int = value
+        keep.append(rows[0])
+        duplicates.extend(row.id for row in rows[1:])
+
+    # Synthetic development MACs ('dev:mac:...') get a locally administered address that
+    # no parsed MAC uses
+    used = set(devices)
+    for session in unparsed:
+        offset = zlib.crc32(session.mac_address.encode())
+        while SYNTHETIC_BASE | offset in used:
+            offset = (offset + 1) & SYNTHETIC_MASK
+        session.mac_int = SYNTHETIC_BASE | offset
+        used.add(session.mac_int)
+        keep.append(session)
+
+    WifiSession.objects.filter(id__in=duplicates).delete()
+    WifiSession.objects.bulk_update(keep, ['mac_int'], batch_size=500)
+
+
+def macs_to_text(apps, schema_editor):
+    WifiSession = apps.get_model('billing_app', 'WifiSession')
+    sessions = list(WifiSession.objects.only('id', 'mac_int'))
+    for session in sessions:
+        session.mac_address = session.mac_int
+    WifiSession.objects.bulk_update(sessions, ['mac_address'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing_app', '0003_wifisession_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wifisession',
+            name='mac_int',
+            field=billing_app.macaddr.MACAddressField(null=True),
+        ),
+        # Nullable and not unique while both columns exist, so the reverse can refill it
+        migrations.AlterField(
+            model_name='wifisession',
+            name='mac_address',
+            field=models.CharField(max_length=17, null=True),
+        ),
+        migrations.RunPython(macs_to_int, macs_to_text),
+        migrations.RemoveField(
+            model_name='wifisession',
+            name='mac_address',
+        ),
+        migrations.RenameField(
+            model_name='wifisession',
+            old_name='mac_int',
+            new_name='mac_address',
+        ),
+        migrations.AlterField(
+            model_name='wifisession',
+            name='mac_address',
+            field=billing_app.macaddr.MACAddressField(unique=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing_app', '0004_wifisession_mac_int'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='wifisession',
+            index=models.Index(condition=models.Q(('is_paid', True)), fields=['created_at'], name='wifisession_paid_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wifisession',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['created_at'], name='wifisession_active_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wifisession',
+            index=models.Index(fields=['ip_address'], name='wifisession_ip_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-17 20:40
+
+import billing_app.macaddr
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing_app', '0005_wifisession_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reference', models.CharField(max_length=100, unique=True)),
+                ('mac_address', billing_app.macaddr.MACAddressField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('rolled_up', models.BooleanField(default=False)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='payments', to='billing_app.paymentplan')),
+                ('session', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payments', to='billing_app.wifisession')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['mac_address', 'created_at'], name='payment_mac_created_idx'), models.Index(fields=['created_at'], name='payment_created_idx'), models.Index(condition=models.Q(('rolled_up', False)), fields=['id'], name='payment_pending_rollup_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='RevenueRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket_start', models.DateTimeField()),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('purchases', models.PositiveIntegerField(default=0)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='revenue_rollups', to='billing_app.paymentplan')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('period', 'bucket_start', 'plan'), name='revenue_rollup_bucket_uniq')],
+            },
+        ),
+    ]
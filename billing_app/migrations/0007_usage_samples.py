@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:15
+
+import billing_app.macaddr
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing_app', '0006_payment_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsageSample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mac_address', billing_app.macaddr.MACAddressField()),
+                ('resolution', models.PositiveIntegerField(choices=[(0, 'Raw'), (300, '5 minutes'), (3600, 'Hourly')])),
+                ('bucket_start', models.DateTimeField()),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('packets', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['resolution', 'bucket_start'], name='usage_resolution_bucket_idx')],
+                'constraints': [models.UniqueConstraint(fields=('mac_address', 'resolution', 'bucket_start'), name='usage_sample_bucket_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 18:21
+
+import billing_app.macaddr
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing_app', '0007_usage_samples'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoucherBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.CharField(blank=True, max_length=100)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('seed', models.CharField(editable=False, max_length=32)),
+                ('code_length', models.PositiveSmallIntegerField(editable=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='voucher_batches', to='billing_app.paymentplan')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Voucher',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial', models.PositiveIntegerField()),
+                ('code_hash', models.CharField(max_length=64, unique=True)),
+                ('redeemed_at', models.DateTimeField(blank=True, null=True)),
+                ('redeemed_mac', billing_app.macaddr.MACAddressField(blank=True, null=True)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='vouchers', to='billing_app.voucherbatch')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('batch', 'serial'), name='voucher_batch_serial_uniq')],
+            },
+        ),
+    ]
@@ -1,11 +1,21 @@
 # models.py
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
 
+from .macaddr import MACAddressField
+
 class WifiSession(models.Model):
+    ACCESS_STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('live', 'Live'),
+        ('failed', 'Failed'),
+    ]
+
     session_id = models.UUIDField(default=uuid.uuid4, unique=True)
-    mac_address = models.CharField(max_length=17, unique=True)
+    # 48-bit integer; reads back as 'aa:bb:cc:dd:ee:ff', lookups take any notation
+    mac_address = MACAddressField(unique=True)
     ip_address = models.GenericIPAddressField()
     is_paid = models.BooleanField(default=False)
     payment_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
@@ -13,6 +23,30 @@ class WifiSession(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=False)
+    # Firewall/router provisioning after payment (see billing_app/provisioning.py)
+    access_status = models.CharField(max_length=10, choices=ACCESS_STATUS_CHOICES, blank=True)
+    access_error = models.TextField(blank=True)
+    
+    class Meta:
+        indexes = [
+            # Cleanup, expiry scheduler: is_active=True AND expires_at < now. Partial rather
+            # than (is_active, expires_at) - SQLite gets a bare "is_active" term it can't seek on
+            models.Index(fields=['expires_at'], name='wifisession_active_expiry_idx',
+                         condition=models.Q(is_active=True)),
+            # Reconcile/admin: only the (few) live paid sessions are indexed
+            models.Index(fields=['expires_at'], name='wifisession_paid_live_idx',
+                         condition=models.Q(is_active=True, is_paid=True)),
+            # Admin created_at filter and date ordering
+            models.Index(fields=['created_at'], name='wifisession_created_idx'),
+            # Admin keyset pages (created_at, id) filtered on is_paid / is_active. Only the
+            # selective True side is indexed; False pages walk wifisession_created_idx
+            models.Index(fields=['created_at'], name='wifisession_paid_created_idx',
+                         condition=models.Q(is_paid=True)),
+            models.Index(fields=['created_at'], name='wifisession_active_created_idx',
+                         condition=models.Q(is_active=True)),
+            # Admin exact and prefix search by IP
+            models.Index(fields=['ip_address'], name='wifisession_ip_idx'),
+        ]
     
     def __str__(self):
         return f"{self.mac_address} - {'Paid' if self.is_paid else 'Unpaid'}"
@@ -26,3 +60,112 @@ class PaymentPlan(models.Model):
     
     def __str__(self):
         return f"{self.name} - ${self.price}"
+
+class Payment(models.Model):
+    """One row per purchase - never updated or deleted (see billing_app/ledger.py)"""
+    reference = models.CharField(max_length=100, unique=True)
+    session = models.ForeignKey(WifiSession, on_delete=models.SET_NULL, null=True, blank=True, related_name='payments')
+    # PROTECT: a plan with purchases is retired with is_active=False, keeping its revenue history
+    plan = models.ForeignKey(PaymentPlan, on_delete=models.PROTECT, related_name='payments')
+    mac_address = MACAddressField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Set once the compactor has folded the row into RevenueRollup (on write by default)
+    rolled_up = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Purchase history per device
+            models.Index(fields=['mac_address', 'created_at'], name='payment_mac_created_idx'),
+            # Admin keyset pages
+            models.Index(fields=['created_at'], name='payment_created_idx'),
+            # Compactor backlog - empty when rollups are maintained on write
+            models.Index(fields=['id'], name='payment_pending_rollup_idx', condition=models.Q(rolled_up=False)),
+        ]
+
+    def __str__(self):
+        return f"{self.reference} - {self.amount}"
+
+class RevenueRollup(models.Model):
+    """Revenue and purchase count per plan for one hour or day (TIME_ZONE), kept current incrementally"""
+    PERIOD_CHOICES = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    ]
+
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket_start = models.DateTimeField()
+    plan = models.ForeignKey(PaymentPlan, on_delete=models.PROTECT, related_name='revenue_rollups')
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    purchases = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also the report's index: period = ? AND bucket_start >= ?
+            models.UniqueConstraint(fields=['period', 'bucket_start', 'plan'], name='revenue_rollup_bucket_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.period} {self.bucket_start:%Y-%m-%d %H:%M} {self.plan_id}: {self.revenue}"
+
+class UsageSample(models.Model):
+    """Bytes/packets a device sent through its grant rules during one bucket (see billing_app/metering.py)"""
+    RAW, FIVE_MINUTES, HOURLY = 0, 300, 3600
+    RESOLUTION_CHOICES = [
+        (RAW, 'Raw'),
+        (FIVE_MINUTES, '5 minutes'),
+        (HOURLY, 'Hourly'),
+    ]
+
+    mac_address = MACAddressField()
+    resolution = models.PositiveIntegerField(choices=RESOLUTION_CHOICES)  # Bucket length in seconds, 0 = one collection
+    bucket_start = models.DateTimeField()
+    bytes = models.BigIntegerField(default=0)
+    packets = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            # Also a device's history: mac_address = ? AND resolution = ? AND bucket_start >= ?
+            models.UniqueConstraint(fields=['mac_address', 'resolution', 'bucket_start'], name='usage_sample_bucket_uniq'),
+        ]
+        indexes = [
+            # The collector's current-bucket reads, retention pruning and the admin's keyset pages
+            models.Index(fields=['resolution', 'bucket_start'], name='usage_resolution_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.mac_address} {self.get_resolution_display()} {self.bucket_start:%Y-%m-%d %H:%M}: {self.bytes}"
+
+class VoucherBatch(models.Model):
+    """One print run of prepaid codes for a plan (see billing_app/vouchers.py)"""
+    # PROTECT: like payments, a batch keeps its plan from being deleted
+    plan = models.ForeignKey(PaymentPlan, on_delete=models.PROTECT, related_name='voucher_batches')
+    label = models.CharField(max_length=100, blank=True)
+    count = models.PositiveIntegerField(default=0)
+    # Codes are derived from (seed, serial) with VOUCHER_SECRET - the database never holds them
+    seed = models.CharField(max_length=32, editable=False)
+    code_length = models.PositiveSmallIntegerField(editable=False)
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(null=True, blank=True)  # Unredeemed codes stop working after this
+    is_active = models.BooleanField(default=True)  # False voids the unredeemed codes (e.g. a lost stack)
+
+    def __str__(self):
+        return f"#{self.pk} {self.label or self.plan.name} ({self.count})"
+
+class Voucher(models.Model):
+    """A prepaid code; redeeming it activates a WifiSession like a payment does"""
+    batch = models.ForeignKey(VoucherBatch, on_delete=models.PROTECT, related_name='vouchers')
+    serial = models.PositiveIntegerField()
+    # Keyed hash of the normalized code - redemption is one lookup on its unique index
+    code_hash = models.CharField(max_length=64, unique=True)
+    redeemed_at = models.DateTimeField(null=True, blank=True)
+    redeemed_mac = MACAddressField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # Also the export order: batch_id = ? ORDER BY serial
+            models.UniqueConstraint(fields=['batch', 'serial'], name='voucher_batch_serial_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.batch_id}/{self.serial} - {'Redeemed' if self.redeemed_at else 'Unused'}"
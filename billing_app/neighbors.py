@@ -0,0 +1,227 @@
+"""
+In-process IP -> MAC neighbor table.
+
+Resolving a client's MAC used to fork `arp` (and sometimes `ip neighbor`)
+on every request. The table below reads the whole kernel neighbor cache in
+one pass, keeps it in memory for a short TTL and only reloads it - in bulk -
+when a lookup misses or the snapshot goes stale. alookup() is the same for
+async views: sources with an aload() (the `arp` command) reload without
+blocking the event loop.
+"""
+import asyncio
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+MAC_RE = re.compile(r'([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}')
+IP_RE = re.compile(r'\(?(\d{1,3}(?:\.\d{1,3}){3}|[0-9a-fA-F:]*:[0-9a-fA-F:]+)\)?')
+
+# Entries the kernel keeps for hosts that never answered
+INCOMPLETE_MACS = {'00:00:00:00:00:00', 'ff:ff:ff:ff:ff:ff'}
+
+
+class ProcNetArpSource:
+    """Read the IPv4 neighbor table straight from /proc/net/arp (Linux)"""
+
+    def __init__(self, path='/proc/net/arp'):
+        self.path = path
+
+    def __call__(self):
+        table = {}
+        with open(self.path) as fh:
+            next(fh, None)  # header line
+            for line in fh:
+                fields = line.split()
+                if len(fields) < 4:
+                    continue
+                ip, flags, mac = fields[0], fields[2], fields[3].lower()
+                # Flags 0x0 means the entry is incomplete
+                if flags == '0x0' or mac in INCOMPLETE_MACS:
+                    continue
+                table[ip] = mac
+        return table
+
+
+class CommandSource:
+    """Dump the whole neighbor table with a single command (macOS / BSD / no procfs)"""
+
+    def __init__(self, command=('arp', '-an')):
+        self.command = list(command)
+
+    def __call__(self):
+        output = subprocess.check_output(self.command).decode('utf-8', 'replace')
+        return self.parse(output)
+
+    async def aload(self):
+        process = await asyncio.create_subprocess_exec(*self.command, stdout=asyncio.subprocess.PIPE)
+        output, _ = await process.communicate()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, self.command)
+        return self.parse(output.decode('utf-8', 'replace'))
+
+    @staticmethod
+    def parse(output):
+        table = {}
+        for line in output.splitlines():
+            mac_match = MAC_RE.search(line)
+            if not mac_match:
+                continue
+            for token in line.split():
+                ip_match = IP_RE.fullmatch(token)
+                if ip_match:
+                    mac = mac_match.group(0).lower().replace('-', ':')
+                    if mac not in INCOMPLETE_MACS:
+                        table[ip_match.group(1)] = mac
+                    break
+        return table
+
+
+class StaticSource:
+    """Fixed table for tests and benchmarks - no root, no kernel"""
+
+    def __init__(self, table=None):
+        self.table = dict(table or {})
+        self.loads = 0
+
+    def __call__(self):
+        self.loads += 1
+        return dict(self.table)
+
+
+def default_source():
+    """Pick the cheapest neighbor source available on this host"""
+    source = getattr(settings, 'NEIGHBOR_TABLE_SOURCE', None)
+    if source:
+        return import_string(source)() if isinstance(source, str) else source
+    if os.path.exists('/proc/net/arp'):
+        return ProcNetArpSource()
+    return CommandSource()
+
+
+class NeighborTable:
+    """Bulk-refreshed IP -> MAC map with a TTL"""
+
+    def __init__(self, source=None, ttl=None, min_refresh_interval=None, clock=time.monotonic):
+        self._source = source
+        self.ttl = ttl if ttl is not None else getattr(settings, 'NEIGHBOR_TABLE_TTL', 30)
+        # Unknown IPs must not turn every request into a reload
+        self.min_refresh_interval = (
+            min_refresh_interval if min_refresh_interval is not None
+            else getattr(settings, 'NEIGHBOR_TABLE_MIN_REFRESH', 1)
+        )
+        self.clock = clock
+        self._table = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._reload_task = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = default_source()
+        return self._source
+
+    def set_source(self, source):
+        """Swap the underlying source (e.g. a StaticSource in tests) and drop the snapshot"""
+        with self._lock:
+            self._source = source
+            self._table = {}
+            self._loaded_at = None
+
+    def refresh(self):
+        """Reload the whole table in one pass"""
+        with self._lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        try:
+            table = self.source()
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Keep serving the old snapshot, retry after min_refresh_interval
+            table = self._table
+            logger.warning(f"Neighbor table refresh failed: {e}")
+        self._table = table
+        self._loaded_at = self.clock()
+        self.refreshes += 1
+
+    def lookup(self, ip):
+        """Return the MAC for `ip`, reloading the table at most once"""
+        if not ip:
+            return None
+
+        loaded_at = self._loaded_at
+        if loaded_at is not None and self.clock() - loaded_at < self.ttl:
+            mac = self._table.get(ip)
+            if mac:
+                self.hits += 1
+                return mac
+
+        with self._lock:
+            # Another thread may have reloaded while we waited for the lock
+            if self._loaded_at == loaded_at and (
+                    self._loaded_at is None or
+                    self.clock() - self._loaded_at >= self.min_refresh_interval):
+                self._refresh_locked()
+            self.misses += 1
+            return self._table.get(ip)
+
+    async def alookup(self, ip):
+        """lookup() for async code - the reload runs on the event loop"""
+        if not ip:
+            return None
+
+        loaded_at = self._loaded_at
+        if loaded_at is not None and self.clock() - loaded_at < self.ttl:
+            mac = self._table.get(ip)
+            if mac:
+                self.hits += 1
+                return mac
+
+        aload = getattr(self.source, 'aload', None)
+        if aload is None:
+            # /proc/net/arp and static tables are read without blocking
+            return self.lookup(ip)
+
+        task = self._reload_task
+        if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+            # Join the reload another request already started
+            await task
+        elif self._loaded_at is None or self.clock() - self._loaded_at >= self.min_refresh_interval:
+            task = self._reload_task = asyncio.ensure_future(self._areload(aload))
+            await task
+        self.misses += 1
+        return self._table.get(ip)
+
+    async def _areload(self, aload):
+        try:
+            table = await aload()
+        except (OSError, subprocess.CalledProcessError) as e:
+            table = None
+            logger.warning(f"Neighbor table refresh failed: {e}")
+        with self._lock:
+            if table is not None:
+                self._table = table
+            self._loaded_at = self.clock()
+            self.refreshes += 1
+
+    def stats(self):
+        return {
+            'entries': len(self._table),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+        }
+
+
+neighbor_table = NeighborTable()
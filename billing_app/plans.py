@@ -0,0 +1,132 @@
+"""
+Versioned PaymentPlan catalog.
+
+Plans change maybe once a month, but every portal landing queried them and
+re-rendered the plan cards. The catalog keeps all plans plus the rendered
+plan_cards.html fragment under a version key in the Django cache. Saving or
+deleting a PaymentPlan (admin included) bumps the version through signals
+once the transaction commits, so no request can cache the rows of an
+uncommitted change under the new version. Every process notices on its next
+request and rebuilds once. Each process also memoizes the current snapshot,
+so a hit costs one cache.get().
+
+Processes only see each other's bumps through a shared CACHES backend. With
+a per-process one (the default LocMemCache), or a change the signals don't
+see (QuerySet.update(), another process's shell), the version key still
+expires after PLAN_CATALOG_TTL seconds, which bounds how long any process
+shows and charges an old price. Call plan_catalog.invalidate() after bulk
+updates to make them visible at once.
+"""
+import uuid
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.http import Http404
+from django.template.loader import render_to_string
+
+from .models import PaymentPlan
+
+VERSION_KEY = 'plan_catalog:version'
+SNAPSHOT_TIMEOUT = 24 * 3600  # old versions' snapshots are dropped after this
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    version: str
+    plans: dict = field(default_factory=dict)  # id -> PaymentPlan, inactive plans included
+    active: list = field(default_factory=list)  # plans shown on the portal, in display order
+    plan_cards: str = ''  # rendered plan_cards.html (SafeString)
+
+    def plan_or_404(self, plan_id):
+        try:
+            return self.plans[int(plan_id)]
+        except (KeyError, TypeError, ValueError):
+            raise Http404('No PaymentPlan matches the given query.')
+
+
+class PlanCatalog:
+    def __init__(self, cache_alias=None):
+        self.cache_alias = cache_alias or getattr(settings, 'PLAN_CATALOG_CACHE', 'default')
+        self._snapshot = None
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'PLAN_CATALOG_TTL', 60)
+
+    def invalidate(self):
+        """Start a new version; every process rebuilds on its next lookup"""
+        version = uuid.uuid4().hex
+        self.cache.set(VERSION_KEY, version, self.ttl)
+        return version
+
+    def current_version(self):
+        version = self.cache.get(VERSION_KEY)
+        if version is None:
+            # Expired - the first process to notice starts the next version, the rest share it
+            self.cache.add(VERSION_KEY, uuid.uuid4().hex, self.ttl)
+            version = self.cache.get(VERSION_KEY)
+        return version
+
+    def build(self, version):
+        plans = list(PaymentPlan.objects.order_by('id'))
+        active = [plan for plan in plans if plan.is_active]
+        return CatalogSnapshot(
+            version=version,
+            plans={plan.id: plan for plan in plans},
+            active=active,
+            plan_cards=render_to_string('plan_cards.html', {'plans': active}),
+        )
+
+    def _memoized(self, version):
+        snapshot = self._snapshot
+        return snapshot if snapshot is not None and snapshot.version == version else None
+
+    def get(self):
+        """Current CatalogSnapshot - no query unless the version changed"""
+        version = self.current_version()
+        snapshot = self._memoized(version)
+        if snapshot is None:
+            key = f'plan_catalog:{version}'
+            snapshot = self.cache.get(key)
+            if snapshot is None:
+                snapshot = self.build(version)
+                self.cache.set(key, snapshot, SNAPSHOT_TIMEOUT)
+            self._snapshot = snapshot
+        return snapshot
+
+    async def aget(self):
+        """get() for async views"""
+        version = await self.cache.aget(VERSION_KEY)
+        if version is None:
+            version = await sync_to_async(self.current_version)()
+        snapshot = self._memoized(version)
+        if snapshot is None:
+            key = f'plan_catalog:{version}'
+            snapshot = await self.cache.aget(key)
+            if snapshot is None:
+                snapshot = await sync_to_async(self.build)(version)
+                await self.cache.aset(key, snapshot, SNAPSHOT_TIMEOUT)
+            self._snapshot = snapshot
+        return snapshot
+
+
+plan_catalog = PlanCatalog()
+
+
+def _plan_changed(sender, **kwargs):
+    # After commit: bumping earlier lets a concurrent request cache the old rows as the new version
+    transaction.on_commit(plan_catalog.invalidate)
+
+
+def install_signal_handlers():
+    """Bump the catalog version whenever a PaymentPlan is saved or deleted"""
+    post_save.connect(_plan_changed, sender=PaymentPlan, dispatch_uid='plan_catalog_save')
+    post_delete.connect(_plan_changed, sender=PaymentPlan, dispatch_uid='plan_catalog_delete')
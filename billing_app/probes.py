@@ -0,0 +1,110 @@
+"""
+Fast path for operating-system captive-portal detection probes.
+
+Phones and laptops request a well-known URL whenever they join a network,
+and again every few minutes. Android and ChromeOS ask for /generate_204,
+Apple devices for /hotspot-detect.html, Windows for /connecttest.txt,
+Firefox and NetworkManager for their own files. These probes are most of
+the portal's traffic, and each one used to run the whole middleware
+stack: sessions, CSRF, auth, then CaptivePortalMiddleware's database
+lookup for every device the authorization cache didn't know.
+
+CaptivePortalProbeMiddleware sits first in MIDDLEWARE and answers a probe
+itself:
+
+- paid devices get the response their OS expects (a 204, or the exact
+  "Success" body) and report the network as online;
+- everyone else is redirected to the portal, which opens the OS's sign-in
+  sheet.
+
+The decision comes from the authorization cache, which ProbePreloader
+fills with every authorized device at most once per PORTAL_PROBE_REFRESH
+seconds. A device left out of that preload is known to be unpaid, so a
+probe needs no query of its own. A device whose state changed since the
+preload is unknown again; that probe continues down the normal stack,
+where CaptivePortalMiddleware asks the database and connectivity_probe
+answers.
+"""
+import threading
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import timezone
+
+from .authcache import authorization_cache
+from .models import WifiSession
+
+APPLE_SUCCESS = '<HTML><HEAD><TITLE>Success</TITLE></HEAD><BODY>Success</BODY></HTML>'
+
+
+@dataclass(frozen=True)
+class Probe:
+    platform: str
+    status: int = 200
+    body: str = ''
+    content_type: str = 'text/plain'
+
+    def success(self):
+        return HttpResponse(self.body, status=self.status, content_type=self.content_type)
+
+
+PROBES = {
+    '/generate_204': Probe('android', status=204),
+    '/gen_204': Probe('android', status=204),
+    '/hotspot-detect.html': Probe('apple', body=APPLE_SUCCESS, content_type='text/html'),
+    '/library/test/success.html': Probe('apple', body=APPLE_SUCCESS, content_type='text/html'),
+    '/connecttest.txt': Probe('windows', body='Microsoft Connect Test'),
+    '/ncsi.txt': Probe('windows', body='Microsoft NCSI'),
+    '/success.txt': Probe('firefox', body='success\n'),
+    '/check_network_status.txt': Probe('networkmanager', body='NetworkManager is online\n'),
+}
+
+
+class ProbePreloader:
+    """Loads every authorized device into the authorization cache, at most once per interval"""
+
+    def __init__(self, cache=None, interval=None):
+        self.cache = cache or authorization_cache
+        self._interval = interval
+        self._lock = threading.Lock()  # one load at a time; other probes use the previous one
+        self.loads = 0
+
+    @property
+    def interval(self):
+        if self._interval is not None:
+            return self._interval
+        return getattr(settings, 'PORTAL_PROBE_REFRESH', 5)
+
+    def due(self):
+        loaded_at = self.cache.preloaded_at
+        return loaded_at is None or self.cache.clock() - loaded_at >= self.interval
+
+    def authorized(self):
+        # A range scan of wifisession_paid_live_idx - only live sessions are read
+        return WifiSession.objects.filter(
+            is_active=True, is_paid=True, expires_at__gt=timezone.now()
+        ).values_list('mac_address', 'expires_at')
+
+    def load(self):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            token = self.cache.begin_preload()
+            self.cache.preload(list(self.authorized()), token)
+            self.loads += 1
+        finally:
+            self._lock.release()
+
+    async def aload(self):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            token = self.cache.begin_preload()
+            self.cache.preload([row async for row in self.authorized()], token)
+            self.loads += 1
+        finally:
+            self._lock.release()
+
+
+probe_preloader = ProbePreloader()
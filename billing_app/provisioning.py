@@ -0,0 +1,194 @@
+"""
+Access provisioning off the payment request path.
+
+process_payment used to call allow_internet_access inline - three sudo
+iptables forks or a router HTTP call of up to several seconds while the
+worker was held. It now records the session as 'pending' and hands the
+grant to this in-process queue. A bounded pool of threads applies it,
+retrying failures with backoff; the outcome is written to
+WifiSession.access_status so the payment page (polling
+provisioning_status) and the operator (admin list filter) can see it from
+any worker process.
+
+Submissions for a MAC that is still queued are merged into the queued job.
+
+Jobs live only in this process. Sessions a previous process left 'pending'
+(restarted mid-retry, crashed) are picked up again by requeue_pending:
+`manage.py requeue_provisioning`, run once per host before the web workers
+start. Not from every worker, which would re-queue grants its siblings
+still have in flight.
+"""
+import logging
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .metrics import provisioning_wait_seconds
+from .models import WifiSession
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProvisioningJob:
+    session_id: int
+    mac_address: str
+    ip_address: str
+    expires_at: object
+    attempts: int = 0
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+def _allow_internet_access(mac_address, ip_address, expires_at):
+    from .views import allow_internet_access
+    return allow_internet_access(mac_address, ip_address, expires_at)
+
+
+class ProvisioningQueue:
+    """Bounded worker pool applying grants, deduplicated per MAC"""
+
+    def __init__(self, workers=None, max_attempts=None, backoff=None, run_async=None, provision=None):
+        self.workers = workers or getattr(settings, 'PROVISIONING_WORKERS', 4)
+        self.max_attempts = max_attempts or getattr(settings, 'PROVISIONING_MAX_ATTEMPTS', 5)
+        self.backoff = backoff if backoff is not None else getattr(settings, 'PROVISIONING_RETRY_BACKOFF', 2)
+        self.run_async = run_async if run_async is not None else getattr(settings, 'PROVISIONING_ASYNC', True)
+        self.provision = provision or _allow_internet_access
+        self._queue = queue.Queue()
+        self._pending = {}  # mac -> queued job, not yet picked up
+        self._threads = []
+        self._unfinished = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self.deduplicated = 0
+
+    def submit(self, session):
+        """Queue a grant for a paid session; returns the ticket the payment page polls"""
+        ticket = str(session.session_id)
+        job = ProvisioningJob(session.pk, session.mac_address, session.ip_address, session.expires_at)
+        if not self.run_async:
+            self._run(job)
+            return ticket
+
+        with self._lock:
+            queued = self._pending.get(job.mac_address)
+            if queued is not None:
+                # Still waiting for a worker - just carry the newest deadline
+                queued.session_id = job.session_id
+                queued.ip_address = job.ip_address
+                queued.expires_at = job.expires_at
+                self.deduplicated += 1
+                return ticket
+            self._pending[job.mac_address] = job
+            self._unfinished += 1
+            self._start_workers()
+        self._queue.put(job.mac_address)
+        return ticket
+
+    async def asubmit(self, session):
+        """submit() for async views - only the inline (PROVISIONING_ASYNC = False) grant needs a thread"""
+        if not self.run_async:
+            return await sync_to_async(self.submit)(session)
+        return self.submit(session)
+
+    def join(self, timeout=None):
+        """Wait until every queued job and retry has finished (tests, shutdown)"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._unfinished == 0, timeout)
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f'provisioning-{len(self._threads)}', daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        while True:
+            mac_address = self._queue.get()
+            with self._lock:
+                job = self._pending.pop(mac_address, None)
+            if job is None:
+                continue
+            provisioning_wait_seconds.observe(time.monotonic() - job.queued_at)
+            try:
+                retrying = self._run(job)
+            except Exception:
+                logger.exception(f"Provisioning job for {mac_address} crashed")
+                retrying = False
+            finally:
+                close_old_connections()
+            if not retrying:
+                self._finish()
+
+    def _finish(self):
+        with self._idle:
+            self._unfinished -= 1
+            self._idle.notify_all()
+
+    def _run(self, job):
+        """Apply one attempt; returns True when a retry was scheduled"""
+        job.attempts += 1
+        try:
+            ok = self.provision(job.mac_address, job.ip_address, job.expires_at)
+            error = '' if ok else 'traffic control reported failure'
+        except Exception as e:
+            ok, error = False, str(e)
+
+        sessions = WifiSession.objects.filter(pk=job.session_id)
+        if ok:
+            sessions.update(access_status='live', access_error='')
+            return False
+
+        if self.run_async and job.attempts < self.max_attempts:
+            sessions.update(access_error=f'Attempt {job.attempts}/{self.max_attempts}: {error}')
+            delay = random.uniform(0.5, 1.0) * self.backoff * 2 ** (job.attempts - 1)
+            logger.warning(f"Provisioning {job.mac_address} failed ({error}), retrying in {delay:.1f}s")
+            timer = threading.Timer(delay, self._retry, args=[job])
+            timer.daemon = True
+            timer.start()
+            return True
+
+        sessions.update(access_status='failed', access_error=error)
+        logger.error(f"Provisioning {job.mac_address} failed after {job.attempts} attempts: {error}")
+        return False
+
+    def _retry(self, job):
+        with self._lock:
+            if job.mac_address in self._pending:
+                # A fresh submission for this device is already queued
+                self._unfinished -= 1
+                self._idle.notify_all()
+                return
+            job.queued_at = time.monotonic()
+            self._pending[job.mac_address] = job
+        self._queue.put(job.mac_address)
+
+    def requeue_pending(self):
+        """Queue the grants of live paid sessions still 'pending' - jobs an earlier process never finished"""
+        sessions = list(WifiSession.objects.filter(
+            is_active=True, is_paid=True, access_status='pending', expires_at__gt=timezone.now(),
+        ))
+        for session in sessions:
+            self.submit(session)
+        if sessions:
+            logger.info(f"Re-queued provisioning for {len(sessions)} pending sessions")
+        return len(sessions)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': len(self._pending),
+                'unfinished': self._unfinished,
+                'workers': len(self._threads),
+                'deduplicated': self.deduplicated,
+            }
+
+
+provisioning_queue = ProvisioningQueue()
+
@@ -0,0 +1,134 @@
+"""
+Converge the firewall to the active WifiSessions.
+
+Kernel state and the database drift apart: a reboot wipes the rules, a
+failed revoke leaves a rule behind, repeated grants add duplicates. The
+reconciler reads the current chain/set once, diffs it against the sessions
+that should have access and applies the whole diff as one
+iptables-restore / ipset restore / nft -f payload.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connection
+from django.utils import timezone
+
+from .firewall import BACKENDS as FIREWALL_BACKENDS, IptablesChain, get_firewall_backend, ipv4_only
+from .models import WifiSession
+
+logger = logging.getLogger(__name__)
+
+
+class ReconcileNotSupported(Exception):
+    pass
+
+
+@dataclass
+class ReconcileReport:
+    method: str
+    desired: int = 0
+    current: int = 0
+    missing: list = field(default_factory=list)
+    stale: list = field(default_factory=list)
+    duplicates: int = 0
+    applied: bool = False
+    timings: dict = field(default_factory=dict)
+
+    @property
+    def drift(self):
+        return len(self.missing) + len(self.stale) + self.duplicates
+
+
+def get_reconcile_backend(method=None):
+    method = method or getattr(settings, 'TRAFFIC_CONTROL_METHOD', 'simulation')
+    if method == 'iptables':
+        return IptablesChain()
+    if method in FIREWALL_BACKENDS:
+        return get_firewall_backend(method)
+    raise ReconcileNotSupported(f"TRAFFIC_CONTROL_METHOD '{method}' has no readable kernel state")
+
+
+def live_sessions(now=None):
+    """(mac_address, ip_address, expires_at) of paid sessions that should have access"""
+    now = now or timezone.now()
+    return WifiSession.objects.filter(is_active=True, is_paid=True, expires_at__gt=now).values_list(
+        'mac_address', 'ip_address', 'expires_at'
+    )
+
+
+def desired_state(now=None):
+    """('mac'|'ip', value) -> expires_at for every session that should have access"""
+    items = {}
+    for mac_address, ip_address, expires_at in live_sessions(now):
+        keys = [('mac', mac_address.lower())]
+        if ipv4_only(ip_address):
+            keys.append(('ip', ip_address))
+        for key in keys:
+            # Two sessions may share a recycled IP - keep the later expiry
+            if key not in items or items[key] < expires_at:
+                items[key] = expires_at
+    return items
+
+
+def reconcile_firewall(backend=None, dry_run=False, now=None):
+    """Diff kernel state against the database and apply the difference in one batch"""
+    backend = backend or get_reconcile_backend()
+    report = ReconcileReport(method=backend.method)
+
+    started = time.perf_counter()
+    current = backend.snapshot()
+    report.timings['snapshot_ms'] = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    desired = desired_state(now)
+    report.timings['query_ms'] = (time.perf_counter() - started) * 1000
+
+    report.desired = len(desired)
+    report.current = sum(current.values())
+    report.missing = sorted(key for key in desired if key not in current)
+    report.stale = sorted(key for key in current if key not in desired)
+    report.duplicates = sum(count - 1 for key, count in current.items() if count > 1 and key in desired)
+
+    if report.drift and not dry_run:
+        grant_entries = [
+            (value, None, desired[(kind, value)]) if kind == 'mac' else (None, value, desired[(kind, value)])
+            for kind, value in report.missing
+        ]
+        revoke_entries = [
+            (value, None) if kind == 'mac' else (None, value)
+            for kind, value in report.stale
+        ]
+        started = time.perf_counter()
+        backend.apply_diff(grant_entries, revoke_entries)
+        report.timings['apply_ms'] = (time.perf_counter() - started) * 1000
+        report.applied = True
+
+    logger.info(
+        f"Firewall reconcile ({report.method}): desired={report.desired} current={report.current} "
+        f"missing={len(report.missing)} stale={len(report.stale)} duplicates={report.duplicates} "
+        f"applied={report.applied}"
+    )
+    return report
+
+
+def _reconcile_in_background(**kwargs):
+    request_started.disconnect(_reconcile_in_background, dispatch_uid='reconcile_firewall_on_startup')
+
+    def run():
+        try:
+            reconcile_firewall()
+        except Exception as e:
+            logger.error(f"Startup firewall reconcile failed: {e}")
+        finally:
+            connection.close()
+
+    threading.Thread(target=run, name='reconcile-firewall', daemon=True).start()
+
+
+def install_startup_hook():
+    """Reconcile once, off the request path, when the first request arrives"""
+    request_started.connect(_reconcile_in_background, dispatch_uid='reconcile_firewall_on_startup')
@@ -0,0 +1,134 @@
+"""
+Local stand-in for the Redis server behind GATEWAY_BUS_URL.
+
+Speaks just the RESP commands billing_app/gateways.py sends - PING, AUTH,
+SELECT, XADD, XREAD (with COUNT, BLOCK and '$'), XRANGE and XREVRANGE - on
+top of a LocalBus, over TCP or a Unix socket, so RedisStreamBus and several
+GatewaySync nodes can be exercised offline.
+"""
+import json
+import os
+import socketserver
+import threading
+
+from .gateways import BusError, LocalBus
+
+
+def encode_reply(value):
+    if isinstance(value, BusError):
+        return f'-{value}\r\n'.encode()
+    if value is None:
+        return b'*-1\r\n'
+    if isinstance(value, int):
+        return f':{value}\r\n'.encode()
+    if isinstance(value, list):
+        return f'*{len(value)}\r\n'.encode() + b''.join(encode_reply(item) for item in value)
+    data = str(value).encode()
+    return b'$%d\r\n%s\r\n' % (len(data), data)
+
+
+def entry(event_id, event):
+    return [event_id, ['event', json.dumps(event)]]
+
+
+class StubRedisHandler(socketserver.StreamRequestHandler):
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line.startswith(b'*'):
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2].decode())
+        return args
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            with self.server.lock:
+                self.server.commands += 1
+            try:
+                reply = self.dispatch(args[0].upper(), args[1:])
+            except (IndexError, ValueError) as e:
+                reply = BusError(f'ERR {e}')
+            self.wfile.write(encode_reply(reply))
+
+    def dispatch(self, command, args):
+        server = self.server
+        if command == 'PING':
+            return 'PONG'
+        if command == 'AUTH':
+            return 'OK' if args[-1] == server.password else BusError('WRONGPASS invalid password')
+        if command == 'SELECT':
+            return 'OK'
+        if command == 'XADD':
+            # XADD stream MAXLEN ~ n * event <json>
+            event = json.loads(args[args.index('event') + 1])
+            return server.bus.publish_many([event])[0]
+        if command == 'XREAD':
+            options = dict(zip(args[0:args.index('STREAMS'):2], args[1:args.index('STREAMS'):2]))
+            after = args[-1]
+            block = int(options['BLOCK']) / 1000 if 'BLOCK' in options else None
+            events = server.bus.read(after, count=int(options.get('COUNT', 500)), block=block)
+            return [[args[-2], [entry(*item) for item in events]]] if events else None
+        if command in ('XRANGE', 'XREVRANGE'):
+            items = server.bus.entries()
+            if command == 'XREVRANGE':
+                items.reverse()
+            count = int(args[args.index('COUNT') + 1]) if 'COUNT' in args else len(items)
+            return [entry(*item) for item in items[:count]]
+        return BusError(f'ERR unknown command {command}')
+
+
+class StubRedis(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), password=None, maxlen=None):
+        super().__init__(address, StubRedisHandler)
+        self.bus = LocalBus(maxlen)
+        self.password = password
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        auth = f':{self.password}@' if self.password else ''
+        return f'redis://{auth}{host}:{port}/0'
+
+    def start(self):
+        """Serve from a daemon thread; returns self for chaining"""
+        threading.Thread(target=self.serve_forever, name='stub-redis', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class UnixStubRedis(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, password=None, maxlen=None):
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, StubRedisHandler)
+        self.bus = LocalBus(maxlen)
+        self.password = password
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'unix://{self.server_address}'
+
+    start = StubRedis.start
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        os.unlink(self.server_address)
@@ -0,0 +1,172 @@
+"""
+Pooled HTTP client for the 'router_api' traffic-control method.
+
+The views used to call requests.post() per grant/revoke: a new TCP
+connection and auth handshake every time, a fixed 5s timeout and no retry,
+all while the payment request waited. RouterClient keeps one
+requests.Session (keep-alive, pooled connections), retries transient
+failures with jittered exponential backoff and stops calling a router that
+keeps failing (circuit breaker) so requests fail fast instead of queueing
+behind timeouts. Whitelist changes for many devices go out as one batch
+call when ROUTER_BATCH_API is enabled.
+"""
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+from .metrics import router_request_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class RouterUnavailable(Exception):
+    """The router call failed after retries, or the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Open after `threshold` consecutive failures; allow one trial call after `reset_timeout`"""
+
+    def __init__(self, threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'half-open':
+                # Let exactly one trial through; others wait for its outcome
+                self.opened_at = self.clock()
+                return True
+            return state == 'closed'
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = self.clock()
+
+
+class RouterClient:
+    """Keep-alive session to the router's whitelist API"""
+
+    # Worth retrying: the router may be busy or rebooting
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url=None, auth=None, timeout=None, max_retries=None, backoff=None,
+                 batch_api=None, batch_size=None, pool_size=None, breaker=None, sleep=time.sleep):
+        self.base_url = (base_url or f"http://{settings.ROUTER_IP}").rstrip('/')
+        self.timeout = timeout or getattr(settings, 'ROUTER_TIMEOUT', (2, 5))
+        self.max_retries = max_retries if max_retries is not None else getattr(settings, 'ROUTER_MAX_RETRIES', 2)
+        self.backoff = backoff if backoff is not None else getattr(settings, 'ROUTER_BACKOFF', 0.2)
+        self.batch_api = batch_api if batch_api is not None else getattr(settings, 'ROUTER_BATCH_API', False)
+        self.batch_size = batch_size or getattr(settings, 'ROUTER_BATCH_SIZE', 100)
+        self.breaker = breaker or CircuitBreaker(
+            threshold=getattr(settings, 'ROUTER_BREAKER_THRESHOLD', 5),
+            reset_timeout=getattr(settings, 'ROUTER_BREAKER_RESET', 30),
+        )
+        self.sleep = sleep
+
+        pool_size = pool_size or getattr(settings, 'ROUTER_POOL_SIZE', 10)
+        self.session = requests.Session()
+        self.session.auth = auth or (settings.ROUTER_USERNAME, settings.ROUTER_PASSWORD)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, path, payload):
+        """POST with retries; returns the response or raises RouterUnavailable"""
+        if not self.breaker.allow():
+            raise RouterUnavailable(f"Circuit open for {self.base_url}")
+
+        url = f"{self.base_url}{path}"
+        error = None
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                # Full jitter keeps many workers from retrying in lockstep
+                self.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = e
+                continue
+            if response.status_code not in self.RETRY_STATUSES:
+                self.breaker.record_success()
+                router_request_seconds.observe(time.perf_counter() - start, path, 'ok')
+                return response
+            error = f"HTTP {response.status_code}"
+
+        self.breaker.record_failure()
+        router_request_seconds.observe(time.perf_counter() - start, path, 'error')
+        raise RouterUnavailable(f"{url} failed after {self.max_retries + 1} attempts: {error}")
+
+    def _whitelist(self, action, mac_addresses, description=None):
+        mac_addresses = list(dict.fromkeys(mac for mac in mac_addresses if mac))
+        if not mac_addresses:
+            return True
+        path = f"/api/whitelist/{action}"
+        ok = True
+        if self.batch_api:
+            for start in range(0, len(mac_addresses), self.batch_size):
+                batch = mac_addresses[start:start + self.batch_size]
+                ok = self.post(path, {'macs': batch}).status_code == 200 and ok
+            return ok
+        for mac_address in mac_addresses:
+            payload = {'mac': mac_address}
+            if description:
+                payload['description'] = description.format(mac=mac_address)
+            ok = self.post(path, payload).status_code == 200 and ok
+        return ok
+
+    def whitelist_add(self, mac_addresses):
+        return self._whitelist('add', mac_addresses, description='Paid user {mac}')
+
+    def whitelist_remove(self, mac_addresses):
+        return self._whitelist('remove', mac_addresses)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_router_client():
+    """Shared client - one connection pool per process"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = RouterClient()
+        return _client
+
+
+def reset_router_client(client=None):
+    """Replace the shared client (tests, settings changes)"""
+    global _client
+    with _client_lock:
+        if _client is not None and _client is not client:
+            _client.close()
+        _client = client
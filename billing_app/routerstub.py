@@ -0,0 +1,89 @@
+"""
+Local stand-in for the router's whitelist API.
+
+Speaks the same /api/whitelist/add and /api/whitelist/remove calls as the
+'router_api' method (single {"mac": ...} or batch {"macs": [...]} bodies),
+with HTTP/1.1 keep-alive, basic auth and optional injected latency and
+failures, so RouterClient can be exercised and benchmarked offline.
+"""
+import base64
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubRouterHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.failure_rate and random.random() < server.failure_rate:
+            return self.reply(503, {'error': 'busy'})
+
+        expected = base64.b64encode(f'{server.username}:{server.password}'.encode()).decode()
+        if self.headers.get('Authorization') != f'Basic {expected}':
+            return self.reply(401, {'error': 'unauthorized'})
+
+        try:
+            payload = json.loads(body or b'{}')
+        except ValueError:
+            return self.reply(400, {'error': 'invalid json'})
+        macs = payload.get('macs') or ([payload['mac']] if payload.get('mac') else [])
+
+        with server.lock:
+            if self.path == '/api/whitelist/add':
+                server.whitelist.update(macs)
+            elif self.path == '/api/whitelist/remove':
+                server.whitelist.difference_update(macs)
+            else:
+                return self.reply(404, {'error': 'not found'})
+        self.reply(200, {'ok': True, 'count': len(macs)})
+
+
+class StubRouter(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), username='admin', password='admin', latency=0.0, failure_rate=0.0):
+        super().__init__(address, StubRouterHandler)
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.whitelist = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve from a daemon thread; returns self for chaining"""
+        threading.Thread(target=self.serve_forever, name='stub-router', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
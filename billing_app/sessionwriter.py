@@ -0,0 +1,102 @@
+"""
+Coalesced inserts for unpaid devices.
+
+Every new MAC that lands on the portal used to INSERT its WifiSession row
+inside the request, so a crowd joining at once meant one SQLite write
+transaction per phone, all fighting for the single write lock.
+portal_login now queues the row here instead. A writer thread inserts
+whatever has queued every UNPAID_SESSION_BATCH_INTERVAL seconds, at most
+UNPAID_SESSION_BATCH_SIZE rows per INSERT, with bulk_create.
+
+The portal page never reads the row back. A row still queued, or lost with a
+failed batch, is created by select_plan with get_or_create.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections
+
+from .models import WifiSession
+
+logger = logging.getLogger(__name__)
+
+
+class UnpaidSessionWriter:
+    """Queue of unsaved WifiSessions flushed by one background thread"""
+
+    def __init__(self, batch_size=None, interval=None, using='default', retries=3):
+        self.batch_size = batch_size or getattr(settings, 'UNPAID_SESSION_BATCH_SIZE', 200)
+        self.interval = interval if interval is not None else getattr(settings, 'UNPAID_SESSION_BATCH_INTERVAL', 0.05)
+        self.using = using
+        self.retries = retries
+        self._pending = {}  # mac -> unsaved WifiSession
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self.batches = 0
+        self.rows = 0
+        self.dropped = 0
+
+    def add(self, mac_address, ip_address):
+        """Queue a row for a new device; returns the (unsaved) session"""
+        with self._wakeup:
+            session = self._pending.get(mac_address)
+            if session is None:
+                session = WifiSession(mac_address=mac_address, ip_address=ip_address)
+                self._pending[mac_address] = session
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='unpaid-session-writer', daemon=True)
+                    self._thread.start()
+                if len(self._pending) >= self.batch_size:
+                    self._wakeup.notify()
+            return session
+
+    def flush(self):
+        """Write everything queued so far from the calling thread (tests, shutdown)"""
+        while True:
+            batch = self._take()
+            if not batch:
+                return
+            self._write(batch)
+
+    def _take(self):
+        with self._wakeup:
+            macs = list(self._pending)[:self.batch_size]
+            return [self._pending.pop(mac) for mac in macs]
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                self._wakeup.wait_for(lambda: self._pending)
+                # Let the batch fill up unless it is already full
+                if len(self._pending) < self.batch_size:
+                    self._wakeup.wait(self.interval)
+            batch = self._take()
+            if batch:
+                try:
+                    self._write(batch)
+                finally:
+                    close_old_connections()
+
+    def _write(self, sessions):
+        for attempt in range(self.retries):
+            try:
+                # A row another worker already inserted for the MAC is skipped
+                WifiSession.objects.using(self.using).bulk_create(sessions, ignore_conflicts=True)
+                self.batches += 1
+                self.rows += len(sessions)
+                return
+            except OperationalError as e:
+                logger.warning(f"Unpaid session batch of {len(sessions)} failed ({e}), attempt {attempt + 1}")
+                time.sleep(self.interval * 2 ** attempt)
+        self.dropped += len(sessions)
+        logger.error(f"Dropped {len(sessions)} unpaid session rows - select_plan will create them on demand")
+
+    def stats(self):
+        with self._wakeup:
+            queued = len(self._pending)
+        return {'queued': queued, 'batches': self.batches, 'rows': self.rows, 'dropped': self.dropped}
+
+
+unpaid_session_writer = UnpaidSessionWriter()
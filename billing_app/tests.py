@@ -1,3 +1,1736 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import posixpath
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.loader import MigrationLoader
+from django.db.models import Q
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test import (AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .admin import indexed_search
+from .assets import AssetBuilder, minify_css, portal_assets
+from .authcache import AuthorizationCache, authorization_cache
+from .bypass import BypassMatcher
+from .cleanup import cleanup_expired_sessions, deactivate_expired, expired_sessions
+from .expiry import ExpiryScheduler
+from .keyset import decode_cursor, encode_cursor, estimated_count
+from .leases import LeaseIndex
+from .ledger import compact, record_payment, revenue_report
+from .macaddr import format_mac, parse_mac, prefix_range
+from .gateways import (AuthorizationListener, BusError, GatewaySync, LocalBus, RedisStreamBus, gateway_events,
+                       open_bus, parse_id)
+from .firewall import (IpsetBackend, IptablesChain, NftablesBackend, RecordingExecutor, get_firewall_backend,
+                       reset_firewall_backends)
+from .firewallhelper import FirewallHelper, FirewallHelperClient, Ruleset, firewall_helper
+from .metering import UsageMeter, floor_time, usage_since
+from .metrics import Registry
+from .middleware import CaptivePortalMiddleware, CaptivePortalProbeMiddleware
+from .models import Payment, PaymentPlan, RevenueRollup, UsageSample, Voucher, VoucherBatch, WifiSession
+from .plans import plan_catalog
+from .probes import PROBES
+from .provisioning import ProvisioningQueue
+from .reconcile import live_sessions, reconcile_firewall
+from .router import CircuitBreaker, RouterClient, RouterUnavailable
+from .redisstub import StubRedis, UnixStubRedis
+from .routerstub import StubRouter
+from .sessionwriter import UnpaidSessionWriter
+from .vouchers import claim_voucher, csv_export, derive_code, generate_batch, lookup_hash, sheet_export
+from .neighbors import CommandSource, NeighborTable, ProcNetArpSource, StaticSource, neighbor_table
+from .views import (allow_access_iptables, allow_internet_access, block_internet_access, block_internet_access_bulk,
+                    get_client_mac, record_purchase)
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class NeighborTableTests(SimpleTestCase):
+    def test_proc_net_arp_source_skips_incomplete_entries(self):
+        with tempfile.NamedTemporaryFile('w', suffix='arp') as fh:
+            fh.write(
+                'IP address       HW type     Flags       HW address            Mask     Device\n'
+                '10.0.0.5         0x1         0x2         AA:BB:CC:DD:EE:05     *        wlan0\n'
+                '10.0.0.6         0x1         0x0         00:00:00:00:00:00     *        wlan0\n'
+            )
+            fh.flush()
+            table = ProcNetArpSource(fh.name)()
+
+        self.assertEqual(table, {'10.0.0.5': 'aa:bb:cc:dd:ee:05'})
+
+    def test_command_source_parses_bsd_arp_output(self):
+        table = CommandSource.parse(
+            '? (10.0.0.7) at aa:bb:cc:dd:ee:07 on en0 ifscope [ethernet]\n'
+            '? (10.0.0.8) at (incomplete) on en0 ifscope [ethernet]\n'
+        )
+        self.assertEqual(table, {'10.0.0.7': 'aa:bb:cc:dd:ee:07'})
+
+    def test_lookup_serves_from_snapshot_until_ttl(self):
+        source = StaticSource({'10.0.0.5': 'aa:bb:cc:dd:ee:05'})
+        clock = FakeClock()
+        table = NeighborTable(source, ttl=30, min_refresh_interval=1, clock=clock)
+
+        self.assertEqual(table.lookup('10.0.0.5'), 'aa:bb:cc:dd:ee:05')
+        self.assertEqual(table.lookup('10.0.0.5'), 'aa:bb:cc:dd:ee:05')
+        self.assertEqual(source.loads, 1)
+
+        clock.now += 31
+        table.lookup('10.0.0.5')
+        self.assertEqual(source.loads, 2)
+
+    def test_miss_reloads_whole_table_once_per_interval(self):
+        source = StaticSource({})
+        clock = FakeClock()
+        table = NeighborTable(source, ttl=30, min_refresh_interval=1, clock=clock)
+
+        self.assertIsNone(table.lookup('10.0.0.9'))
+        self.assertIsNone(table.lookup('10.0.0.9'))
+        self.assertEqual(source.loads, 1)
+
+        # Device associates; the next miss after the interval picks it up
+        source.table['10.0.0.9'] = 'aa:bb:cc:dd:ee:09'
+        clock.now += 1
+        self.assertEqual(table.lookup('10.0.0.9'), 'aa:bb:cc:dd:ee:09')
+        self.assertEqual(source.loads, 2)
+
+
+class AsyncNeighborLookupTests(SimpleTestCase):
+    class AsyncSource(StaticSource):
+        async def aload(self):
+            await asyncio.sleep(0.01)
+            return self()
+
+    async def test_concurrent_misses_share_one_reload(self):
+        source = self.AsyncSource({'10.0.0.5': 'aa:bb:cc:dd:ee:05'})
+        table = NeighborTable(source, ttl=30, min_refresh_interval=1, clock=FakeClock())
+
+        macs = await asyncio.gather(*(table.alookup('10.0.0.5') for _ in range(50)))
+
+        self.assertEqual(set(macs), {'aa:bb:cc:dd:ee:05'})
+        self.assertEqual(source.loads, 1)
+        self.assertEqual(await table.alookup('10.0.0.5'), 'aa:bb:cc:dd:ee:05')
+        self.assertEqual(table.stats()['hits'], 1)
+
+
+@override_settings(ENVIRONMENT='production')
+class GetClientMacTests(SimpleTestCase):
+    def setUp(self):
+        self.source = StaticSource({'10.0.0.5': 'aa:bb:cc:dd:ee:05'})
+        neighbor_table.set_source(self.source)
+        self.addCleanup(neighbor_table.set_source, None)
+
+    def test_mac_resolved_once_per_request(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.5')
+
+        self.assertEqual(get_client_mac(request), 'aa:bb:cc:dd:ee:05')
+        self.source.table.clear()
+        self.assertEqual(get_client_mac(request), 'aa:bb:cc:dd:ee:05')
+        self.assertEqual(self.source.loads, 1)
+
+    def test_unknown_ip_resolves_to_none(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.99')
+        self.assertIsNone(get_client_mac(request))
+
+
+class AuthorizationCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock(now=timezone.now().timestamp())
+        self.cache = AuthorizationCache(max_entries=2, negative_ttl=5, clock=self.clock)
+
+    def test_positive_entry_valid_until_expires_at(self):
+        self.cache = AuthorizationCache(max_entries=2, negative_ttl=5, positive_ttl=0, clock=self.clock)
+        expires_at = timezone.now() + timedelta(hours=1)
+        self.cache.set_authorized('aa:bb:cc:dd:ee:01', expires_at)
+
+        self.clock.now = expires_at.timestamp() - 1
+        self.assertIs(self.cache.get('aa:bb:cc:dd:ee:01'), True)
+        self.clock.now = expires_at.timestamp()
+        self.assertIsNone(self.cache.get('aa:bb:cc:dd:ee:01'))
+
+    def test_positive_entry_capped_so_other_processes_revocations_show(self):
+        cache = AuthorizationCache(positive_ttl=5, clock=self.clock)
+        expires_at = timezone.now() + timedelta(hours=1)
+        cache.preload([('aa:bb:cc:dd:ee:01', expires_at)], cache.begin_preload())
+
+        self.assertIs(cache.decision('aa:bb:cc:dd:ee:01'), True)
+        self.clock.now += 5
+        # Re-checked against the DB - not taken as unauthorized because the preload saw it
+        self.assertIsNone(cache.decision('aa:bb:cc:dd:ee:01'))
+        self.assertIs(cache.decision('aa:bb:cc:dd:ee:02'), False)
+
+    def test_negative_entry_uses_short_ttl(self):
+        self.cache.set_unauthorized('aa:bb:cc:dd:ee:02')
+        self.assertIs(self.cache.get('aa:bb:cc:dd:ee:02'), False)
+        self.clock.now += 5
+        self.assertIsNone(self.cache.get('aa:bb:cc:dd:ee:02'))
+
+    def test_lru_eviction_and_counters(self):
+        for i in range(3):
+            self.cache.set_unauthorized(f'aa:bb:cc:dd:ee:0{i}')
+
+        self.assertIsNone(self.cache.get('aa:bb:cc:dd:ee:00'))
+        self.assertIs(self.cache.get('aa:bb:cc:dd:ee:02'), False)
+        self.assertEqual(self.cache.stats(), {'entries': 2, 'hits': 1, 'misses': 1, 'evictions': 1})
+
+
+class BypassMatcherTests(SimpleTestCase):
+    def test_prefixes_url_names_and_namespaces(self):
+        matcher = BypassMatcher(['/static/'], ['portal_login', 'select_plan'], ['admin'])
+
+        for path in ['/', '/static/css/main.css', '/select-plan/3/', '/admin/billing_app/']:
+            self.assertTrue(matcher.matches(path), path)
+        # URL names match exactly, not as prefixes
+        for path in ['/news/', '/select-plan/x/', '/select-plan/3/extra/', '/payment/']:
+            self.assertFalse(matcher.matches(path), path)
+
+    def test_middleware_bypass_uses_the_matcher(self):
+        middleware = CaptivePortalMiddleware(lambda request: HttpResponse())
+
+        self.assertTrue(middleware.should_bypass(RequestFactory().get('/static/css/main.css')))
+        self.assertFalse(middleware.should_bypass(RequestFactory().get('/news/')))
+
+
+@override_settings(ENVIRONMENT='production', TRAFFIC_CONTROL_METHOD='simulation')
+class CaptivePortalMiddlewareTests(TestCase):
+    def setUp(self):
+        neighbor_table.set_source(StaticSource({'10.0.0.5': 'aa:bb:cc:dd:ee:05'}))
+        self.addCleanup(neighbor_table.set_source, None)
+        authorization_cache.clear()
+        self.addCleanup(authorization_cache.clear)
+        self.middleware = CaptivePortalMiddleware(lambda request: HttpResponse())
+
+    def browse(self):
+        request = RequestFactory().get('/news/', REMOTE_ADDR='10.0.0.5')
+        return self.middleware.process_request(request)
+
+    def test_paid_session_served_from_cache_without_queries(self):
+        WifiSession.objects.create(
+            mac_address='aa:bb:cc:dd:ee:05', ip_address='10.0.0.5', is_paid=True,
+            is_active=True, expires_at=timezone.now() + timedelta(hours=1),
+        )
+        self.assertIsNone(self.browse())
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.browse())
+
+    async def test_async_stack_authorizes_with_async_orm(self):
+        async def get_response(request):
+            return HttpResponse()
+
+        middleware = CaptivePortalMiddleware(get_response)
+        await WifiSession.objects.acreate(
+            mac_address='aa:bb:cc:dd:ee:05', ip_address='10.0.0.5', is_paid=True,
+            is_active=True, expires_at=timezone.now() + timedelta(hours=1),
+        )
+
+        response = await middleware(AsyncRequestFactory().get('/news/', headers={'X-Forwarded-For': '10.0.0.5'}))
+        self.assertEqual(response.status_code, 200)
+        response = await middleware(AsyncRequestFactory().get('/news/', headers={'X-Forwarded-For': '10.0.0.99'}))
+        self.assertEqual(response.status_code, 302)
+
+    def test_unknown_device_cached_negatively_until_invalidated(self):
+        self.assertEqual(self.browse().status_code, 302)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.browse().status_code, 302)
+
+        WifiSession.objects.create(
+            mac_address='aa:bb:cc:dd:ee:05', ip_address='10.0.0.5', is_paid=True,
+            is_active=True, expires_at=timezone.now() + timedelta(hours=1),
+        )
+        authorization_cache.invalidate('aa:bb:cc:dd:ee:05')
+        self.assertIsNone(self.browse())
+
+
+class FirewallSetBackendTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = RecordingExecutor()
+        self.expires_at = timezone.now() + timedelta(hours=1)
+
+    def test_ipset_grant_is_one_restore_batch_with_timeouts(self):
+        backend = IpsetBackend(self.executor)
+        backend.grant([
+            ('aa:bb:cc:dd:ee:01', '10.0.0.1', self.expires_at),
+            ('aa:bb:cc:dd:ee:02', 'fe80::2', self.expires_at),
+        ])
+        setup_batches = len(self.executor.batches)
+        backend.grant([('aa:bb:cc:dd:ee:03', '10.0.0.3', self.expires_at)])
+
+        args, payload = self.executor.batches[setup_batches - 1]
+        self.assertEqual(args, ['ipset', '-exist', 'restore'])
+        self.assertEqual(payload.splitlines(), [
+            'add wifi_paid_macs aa:bb:cc:dd:ee:01 timeout 3600',
+            'add wifi_paid_ips 10.0.0.1 timeout 3600',
+            'add wifi_paid_macs aa:bb:cc:dd:ee:02 timeout 3600',
+        ])
+        # Sets and rules are only created once; later grants are a single fork
+        self.assertEqual(len(self.executor.batches), setup_batches + 1)
+
+    def test_ipset_setup_references_sets_from_one_rule_each(self):
+        IpsetBackend(self.executor).ensure()
+        rules = [args for args, _ in self.executor.batches if args[:2] == ['iptables', '-C']]
+        self.assertEqual([rule[6] for rule in rules], ['wifi_paid_macs', 'wifi_paid_ips'])
+
+    def test_nftables_revoke_is_one_transaction(self):
+        backend = NftablesBackend(self.executor)
+        backend._ready = True
+        backend.revoke([('aa:bb:cc:dd:ee:01', '10.0.0.1')])
+
+        self.assertEqual(len(self.executor.batches), 1)
+        args, payload = self.executor.batches[0]
+        self.assertEqual(args, ['nft', '-f', '-'])
+        self.assertIn('delete element inet captive_portal paid_macs { aa:bb:cc:dd:ee:01 }', payload)
+        self.assertIn('delete element inet captive_portal paid_ips { 10.0.0.1 }', payload)
+
+    def test_nftables_setup_filters_from_a_forward_base_chain(self):
+        with override_settings(NFT_CLIENT_INTERFACE='wlan0'):
+            NftablesBackend(self.executor).ensure()
+
+        payload = self.executor.batches[0][1]
+        self.assertIn('chain captive_portal { type filter hook forward priority filter; policy accept; }', payload)
+        self.assertEqual([line for line in payload.splitlines() if line.startswith('add rule')], [
+            'add rule inet captive_portal captive_portal iifname != "wlan0" accept',
+            'add rule inet captive_portal captive_portal ether saddr @paid_macs accept',
+            'add rule inet captive_portal captive_portal ip saddr @paid_ips accept',
+            'add rule inet captive_portal captive_portal meta l4proto { tcp, udp } th dport 53 accept',
+            'add rule inet captive_portal captive_portal drop',
+        ])
+
+    def test_failed_batch_reports_failure(self):
+        backend = IpsetBackend(RecordingExecutor(fail=True))
+        backend._ready = True
+        self.assertFalse(backend.grant([('aa:bb:cc:dd:ee:01', '10.0.0.1', self.expires_at)]))
+
+    @override_settings(TRAFFIC_CONTROL_METHOD='ipset')
+    def test_traffic_control_method_dispatch(self):
+        reset_firewall_backends(self.executor)
+        self.addCleanup(reset_firewall_backends)
+
+        self.assertTrue(allow_internet_access('aa:bb:cc:dd:ee:01', '10.0.0.1', self.expires_at))
+        self.assertTrue(block_internet_access('aa:bb:cc:dd:ee:01', '10.0.0.1'))
+        self.assertEqual(self.executor.batches[-1][1], 'del wifi_paid_macs aa:bb:cc:dd:ee:01\ndel wifi_paid_ips 10.0.0.1\n')
+
+
+class ReconcileFirewallTests(TestCase):
+    def setUp(self):
+        expires_at = timezone.now() + timedelta(hours=1)
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:01', ip_address='10.0.0.1',
+                                   is_paid=True, is_active=True, expires_at=expires_at)
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:02', ip_address='10.0.0.2',
+                                   is_paid=True, is_active=True, expires_at=expires_at)
+        # Expired but never cleaned up - must not be granted
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:03', ip_address='10.0.0.3',
+                                   is_paid=True, is_active=True, expires_at=timezone.now() - timedelta(minutes=1))
+
+    def test_iptables_drift_applied_in_one_restore_without_a_rewrite(self):
+        executor = RecordingExecutor(outputs={'iptables-save': (
+            '*filter\n'
+            ':CAPTIVE_PORTAL - [0:0]\n'
+            '-A CAPTIVE_PORTAL -s 10.0.0.1/32 -j ACCEPT\n'
+            '-A CAPTIVE_PORTAL -m mac --mac-source AA:BB:CC:DD:EE:01 -j ACCEPT\n'
+            '-A CAPTIVE_PORTAL -m mac --mac-source AA:BB:CC:DD:EE:01 -j ACCEPT\n'
+            '-A CAPTIVE_PORTAL -m mac --mac-source AA:BB:CC:DD:EE:03 -j ACCEPT\n'
+            '-A CAPTIVE_PORTAL -p udp --dport 53 -j ACCEPT\n'
+            'COMMIT\n'
+        )})
+        report = reconcile_firewall(IptablesChain(executor))
+
+        self.assertEqual(report.missing, [('ip', '10.0.0.2'), ('mac', 'aa:bb:cc:dd:ee:02')])
+        self.assertEqual(report.stale, [('mac', 'aa:bb:cc:dd:ee:03')])
+        self.assertEqual(report.duplicates, 1)
+        # The chain is never redeclared: the DNS rule keeps its place, untouched rules their counters
+        self.assertEqual([args[0] for args, _ in executor.batches],
+                         ['iptables-save', 'iptables-save', 'iptables-restore'])
+        self.assertEqual(executor.batches[2][0], ['iptables-restore', '--noflush'])
+        self.assertEqual(executor.batches[2][1].splitlines(), [
+            '*filter',
+            '-D CAPTIVE_PORTAL -m mac --mac-source aa:bb:cc:dd:ee:03 -j ACCEPT',
+            '-D CAPTIVE_PORTAL -m mac --mac-source aa:bb:cc:dd:ee:01 -j ACCEPT',
+            '-I CAPTIVE_PORTAL -s 10.0.0.2 -j ACCEPT',
+            '-I CAPTIVE_PORTAL -m mac --mac-source aa:bb:cc:dd:ee:02 -j ACCEPT',
+            'COMMIT',
+        ])
+
+    def test_ipset_dry_run_reports_without_applying(self):
+        executor = RecordingExecutor(outputs={'ipset': (
+            'create wifi_paid_macs hash:mac timeout 0\n'
+            'add wifi_paid_macs AA:BB:CC:DD:EE:01 timeout 100\n'
+            'add wifi_paid_ips 10.0.0.1 timeout 100\n'
+            'add wifi_paid_ips 10.0.0.2 timeout 100\n'
+        )})
+        report = reconcile_firewall(IpsetBackend(executor), dry_run=True)
+
+        self.assertEqual(report.missing, [('mac', 'aa:bb:cc:dd:ee:02')])
+        self.assertEqual(report.stale, [])
+        self.assertFalse(report.applied)
+        self.assertEqual(len(executor.batches), 1)
+
+
+@override_settings(TRAFFIC_CONTROL_METHOD='simulation')
+class ExpirySchedulerTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock(now=timezone.now().timestamp())
+        self.scheduler = ExpiryScheduler(clock=self.clock)
+
+    def test_deadlines_pop_in_order_and_extensions_supersede(self):
+        self.scheduler.schedule('aa:bb:cc:dd:ee:01', self.clock.now + 10)
+        self.scheduler.schedule('aa:bb:cc:dd:ee:02', self.clock.now + 5)
+        self.scheduler.handle_datagram(b'{"mac": "aa:bb:cc:dd:ee:02", "expires_at": %f}' % (self.clock.now + 60))
+
+        self.assertEqual(self.scheduler.seconds_until_next(), 10)
+        self.clock.now += 10
+        self.assertEqual(self.scheduler.pop_due(), ['aa:bb:cc:dd:ee:01'])
+        self.assertEqual(len(self.scheduler), 1)
+
+    def test_revoke_rechecks_database_and_records_lateness(self):
+        expired_at = timezone.now() - timedelta(seconds=2)
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:01', ip_address='10.0.0.1',
+                                   is_paid=True, is_active=True, expires_at=expired_at)
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:02', ip_address='10.0.0.2',
+                                   is_paid=True, is_active=True, expires_at=timezone.now() + timedelta(hours=1))
+
+        self.assertEqual(self.scheduler.load_window(horizon=60), 1)
+        due = self.scheduler.pop_due()
+        # The second device was extended after its deadline was queued
+        revoked = self.scheduler.revoke(due + ['aa:bb:cc:dd:ee:02'])
+
+        self.assertEqual(revoked, 1)
+        self.assertFalse(WifiSession.objects.get(mac_address='aa:bb:cc:dd:ee:01').is_active)
+        self.assertTrue(WifiSession.objects.get(mac_address='aa:bb:cc:dd:ee:02').is_active)
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertAlmostEqual(self.scheduler.lateness[0], self.clock.now - expired_at.timestamp())
+
+    def test_renewal_before_the_update_keeps_session_and_access(self):
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:01', ip_address='10.0.0.1', is_paid=True,
+                                   is_active=True, expires_at=timezone.now() - timedelta(seconds=2))
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:02', ip_address='10.0.0.2', is_paid=True,
+                                   is_active=True, expires_at=timezone.now() - timedelta(seconds=2))
+
+        def renew_first(ids, now):
+            WifiSession.objects.filter(mac_address='aa:bb:cc:dd:ee:01').update(
+                expires_at=timezone.now() + timedelta(hours=1)
+            )
+            return deactivate_expired(ids, now)
+
+        revoked, published = [], []
+        with mock.patch('billing_app.cleanup.deactivate_expired', renew_first), \
+                mock.patch('billing_app.views.block_internet_access_bulk', lambda entries: revoked.extend(entries)), \
+                mock.patch('billing_app.expiry.gateway_events.revoke', lambda entries: published.extend(entries)):
+            self.assertEqual(self.scheduler.revoke(['aa:bb:cc:dd:ee:01', 'aa:bb:cc:dd:ee:02']), 1)
+
+        self.assertTrue(WifiSession.objects.get(mac_address='aa:bb:cc:dd:ee:01').is_active)
+        self.assertFalse(WifiSession.objects.get(mac_address='aa:bb:cc:dd:ee:02').is_active)
+        self.assertEqual(revoked, [('aa:bb:cc:dd:ee:02', '10.0.0.2')])
+        self.assertEqual(published, [('aa:bb:cc:dd:ee:02', '10.0.0.2')])
+
+
+class CleanupExpiredSessionsTests(TestCase):
+    def setUp(self):
+        self.executor = RecordingExecutor()
+        reset_firewall_backends(self.executor)
+        self.addCleanup(reset_firewall_backends)
+        expired_at = timezone.now() - timedelta(minutes=5)
+        for i in range(1, 6):
+            WifiSession.objects.create(mac_address=f'aa:bb:cc:dd:ee:0{i}', ip_address=f'10.0.0.{i}',
+                                       is_paid=True, is_active=True, expires_at=expired_at)
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:09', ip_address='10.0.0.9',
+                                   is_paid=True, is_active=True, expires_at=timezone.now() + timedelta(hours=1))
+
+    @override_settings(TRAFFIC_CONTROL_METHOD='ipset')
+    def test_each_chunk_is_one_firewall_batch_and_one_update(self):
+        get_firewall_backend('ipset')._ready = True
+
+        # Per chunk: read it, then one UPDATE ... RETURNING
+        with self.assertNumQueries(3 * 2):
+            report = cleanup_expired_sessions(chunk_size=2)
+
+        self.assertEqual((report.expired, report.chunks, report.failed), (5, 3, 0))
+        self.assertEqual([args for args, _ in self.executor.batches], [['ipset', '-exist', 'restore']] * 3)
+        self.assertEqual(self.executor.batches[0][1].splitlines(), [
+            'del wifi_paid_macs aa:bb:cc:dd:ee:01',
+            'del wifi_paid_ips 10.0.0.1',
+            'del wifi_paid_macs aa:bb:cc:dd:ee:02',
+            'del wifi_paid_ips 10.0.0.2',
+        ])
+        self.assertEqual(list(WifiSession.objects.filter(is_active=True).values_list('mac_address', flat=True)),
+                         ['aa:bb:cc:dd:ee:09'])
+
+    @override_settings(TRAFFIC_CONTROL_METHOD='ipset')
+    def test_session_renewed_after_the_read_keeps_access(self):
+        get_firewall_backend('ipset')._ready = True
+        stale = list(expired_sessions())
+        WifiSession.objects.filter(mac_address='aa:bb:cc:dd:ee:02').update(
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+
+        with mock.patch('billing_app.cleanup.expired_sessions', return_value=stale):
+            report = cleanup_expired_sessions(chunk_size=10)
+
+        self.assertEqual(report.expired, 4)
+        self.assertTrue(WifiSession.objects.get(mac_address='aa:bb:cc:dd:ee:02').is_active)
+        revoked = self.executor.batches[0][1]
+        self.assertIn('aa:bb:cc:dd:ee:01', revoked)
+        self.assertNotIn('aa:bb:cc:dd:ee:02', revoked)
+
+    @override_settings(TRAFFIC_CONTROL_METHOD='ipset')
+    def test_session_deactivated_elsewhere_is_not_revoked_again(self):
+        get_firewall_backend('ipset')._ready = True
+        stale = list(expired_sessions())
+        # The expiry scheduler got to this one between the read and the UPDATE
+        WifiSession.objects.filter(mac_address='aa:bb:cc:dd:ee:03').update(is_active=False)
+
+        with mock.patch('billing_app.cleanup.expired_sessions', return_value=stale):
+            report = cleanup_expired_sessions(chunk_size=10)
+
+        self.assertEqual(report.expired, 4)
+        self.assertNotIn('aa:bb:cc:dd:ee:03', self.executor.batches[0][1])
+
+    def test_deactivate_expired_without_update_returning(self):
+        ids = list(WifiSession.objects.values_list('id', flat=True))
+        WifiSession.objects.filter(mac_address='aa:bb:cc:dd:ee:01').update(is_active=False)
+
+        with mock.patch.object(type(connection.features), 'can_return_rows_from_bulk_insert',
+                               new_callable=mock.PropertyMock, return_value=False):
+            changed = deactivate_expired(ids, timezone.now())
+
+        self.assertEqual(changed, set(WifiSession.objects.filter(
+            mac_address__in=['aa:bb:cc:dd:ee:02', 'aa:bb:cc:dd:ee:03', 'aa:bb:cc:dd:ee:04', 'aa:bb:cc:dd:ee:05'],
+        ).values_list('id', flat=True)))
+        self.assertEqual(WifiSession.objects.filter(is_active=True).count(), 1)
+
+    @override_settings(TRAFFIC_CONTROL_METHOD='ipset')
+    def test_dry_run_and_limit(self):
+        report = cleanup_expired_sessions(chunk_size=2, limit=3, dry_run=True)
+
+        self.assertEqual((report.expired, report.chunks), (3, 2))
+        self.assertEqual(self.executor.batches, [])
+        self.assertEqual(WifiSession.objects.filter(is_active=True).count(), 6)
+
+
+class RouterClientTests(SimpleTestCase):
+    def setUp(self):
+        self.server = StubRouter().start()
+        self.addCleanup(self.server.stop)
+        self.sleeps = []
+
+    def make_client(self, **kwargs):
+        client = RouterClient(base_url=self.server.base_url, auth=('admin', 'admin'), timeout=2,
+                              sleep=self.sleeps.append, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_batch_whitelist_calls(self):
+        client = self.make_client(batch_api=True, batch_size=2)
+        macs = ['aa:bb:cc:dd:ee:01', 'aa:bb:cc:dd:ee:02', 'aa:bb:cc:dd:ee:03']
+
+        self.assertTrue(client.whitelist_add(macs))
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.server.whitelist, set(macs))
+
+        self.assertTrue(client.whitelist_remove(macs[:2]))
+        self.assertEqual(self.server.whitelist, {'aa:bb:cc:dd:ee:03'})
+
+    def test_retries_with_backoff_then_opens_circuit(self):
+        self.server.failure_rate = 1.0
+        clock = FakeClock()
+        client = self.make_client(batch_api=False, max_retries=2, backoff=0.1,
+                             breaker=CircuitBreaker(threshold=1, reset_timeout=30, clock=clock))
+
+        with self.assertRaises(RouterUnavailable):
+            client.whitelist_add(['aa:bb:cc:dd:ee:01'])
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertLessEqual(self.sleeps[1], 0.2)
+
+        # Open circuit fails fast without touching the router
+        with self.assertRaises(RouterUnavailable):
+            client.whitelist_add(['aa:bb:cc:dd:ee:01'])
+        self.assertEqual(self.server.requests, 3)
+
+        self.server.failure_rate = 0.0
+        clock.now += 30
+        self.assertTrue(client.whitelist_add(['aa:bb:cc:dd:ee:01']))
+        self.assertEqual(client.breaker.state, 'closed')
+
+
+class ProvisioningQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.session = WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:01', ip_address='10.0.0.1',
+                                                  is_paid=True, is_active=True, access_status='pending',
+                                                  expires_at=timezone.now() + timedelta(hours=1))
+
+    def test_failed_grant_is_retried_until_live(self):
+        outcomes = [False, True]
+        provisioning = ProvisioningQueue(workers=2, backoff=0, provision=lambda *args: outcomes.pop(0))
+
+        provisioning.submit(self.session)
+        self.assertTrue(provisioning.join(timeout=5))
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.access_status, self.session.access_error), ('live', ''))
+
+    def test_exhausted_retries_stay_visible(self):
+        def provision(*args):
+            raise OSError('sudo: iptables: command not found')
+
+        provisioning = ProvisioningQueue(workers=1, max_attempts=3, backoff=0, provision=provision)
+        provisioning.submit(self.session)
+        self.assertTrue(provisioning.join(timeout=5))
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.access_status, 'failed')
+        self.assertIn('command not found', self.session.access_error)
+
+    def test_queued_submissions_for_a_mac_are_merged(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def provision(mac_address, ip_address, expires_at):
+            calls.append(mac_address)
+            started.set()
+            return release.wait(5)
+
+        other = WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:02', ip_address='10.0.0.2',
+                                           is_paid=True, is_active=True)
+        provisioning = ProvisioningQueue(workers=1, provision=provision)
+        provisioning.submit(other)
+        started.wait(5)  # the only worker is now busy
+        provisioning.submit(self.session)
+        provisioning.submit(self.session)
+        release.set()
+
+        self.assertTrue(provisioning.join(timeout=5))
+        self.assertEqual(calls, ['aa:bb:cc:dd:ee:02', 'aa:bb:cc:dd:ee:01'])
+        self.assertEqual(provisioning.deduplicated, 1)
+
+    def test_requeue_pending_picks_up_stranded_grants(self):
+        later = timezone.now() + timedelta(hours=1)
+        WifiSession.objects.filter(pk=self.session.pk).update(access_status='pending', expires_at=later)
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:02', ip_address='10.0.0.2', is_paid=True,
+                                   is_active=True, access_status='pending',
+                                   expires_at=timezone.now() - timedelta(minutes=1))
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:03', ip_address='10.0.0.3', is_paid=True,
+                                   is_active=True, access_status='live', expires_at=later)
+        calls = []
+        provisioning = ProvisioningQueue(run_async=False, provision=lambda *args: calls.append(args) or True)
+
+        self.assertEqual(provisioning.requeue_pending(), 1)
+        self.assertEqual(calls, [('aa:bb:cc:dd:ee:01', self.session.ip_address, later)])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.access_status, 'live')
+
+    def test_repeated_iptables_grant_inserts_each_rule_once(self):
+        present = set()
+
+        def run(args, check=True, **kwargs):
+            rule = tuple(args[3:])
+            if args[2] == '-C':
+                return subprocess.CompletedProcess(args, 0 if rule in present else 1)
+            if args[2] == '-I':
+                present.add(rule)
+            return subprocess.CompletedProcess(args, 0)
+
+        with mock.patch('billing_app.views.subprocess.run', side_effect=run) as mocked:
+            self.assertTrue(allow_access_iptables('aa:bb:cc:dd:ee:01', '10.0.0.1'))
+            self.assertTrue(allow_access_iptables('aa:bb:cc:dd:ee:01', '10.0.0.1'))
+
+        inserts = [call.args[0] for call in mocked.call_args_list if call.args[0][2] == '-I']
+        self.assertEqual(inserts, [
+            ['sudo', 'iptables', '-I', 'CAPTIVE_PORTAL', '-m', 'mac', '--mac-source', 'aa:bb:cc:dd:ee:01', '-j', 'ACCEPT'],
+            ['sudo', 'iptables', '-I', 'CAPTIVE_PORTAL', '-s', '10.0.0.1', '-j', 'ACCEPT'],
+        ])
+
+
+@override_settings(ENVIRONMENT='development', TRAFFIC_CONTROL_METHOD='simulation')
+class ProcessPaymentTests(TestCase):
+    def test_payment_returns_ticket_and_status_reports_live(self):
+        plan = PaymentPlan.objects.create(name='1 Hour', price='2.00', duration_hours=1)
+        WifiSession.objects.create(mac_address='02:00:7f:00:00:01', ip_address='127.0.0.1')
+        session = self.client.session
+        session['selected_plan_id'] = plan.id
+        session.save()
+
+        provisioning = ProvisioningQueue(run_async=False)
+        with mock.patch('billing_app.views.provisioning_queue', provisioning):
+            data = self.client.post('/process-payment/', '{}', content_type='application/json').json()
+
+        wifi_session = WifiSession.objects.get(mac_address='02:00:7f:00:00:01')
+        self.assertEqual(data['ticket'], str(wifi_session.session_id))
+        self.assertEqual(self.client.get(data['status_url']).json(), {'status': 'live', 'live': True})
+
+    def test_repeat_purchases_are_all_kept_in_the_ledger(self):
+        plan = PaymentPlan.objects.create(name='1 Hour', price='2.00', duration_hours=1)
+        WifiSession.objects.create(mac_address='02:00:7f:00:00:01', ip_address='127.0.0.1')
+        session = self.client.session
+        session['selected_plan_id'] = plan.id
+        session.save()
+
+        with mock.patch('billing_app.views.provisioning_queue', ProvisioningQueue(run_async=False)):
+            for _ in range(2):
+                self.client.post('/process-payment/', '{}', content_type='application/json')
+
+        wifi_session = WifiSession.objects.get(mac_address='02:00:7f:00:00:01')
+        payments = list(wifi_session.payments.order_by('id'))
+        self.assertEqual(len(payments), 2)
+        self.assertEqual(wifi_session.payment_id, payments[-1].reference)
+        self.assertEqual(RevenueRollup.objects.get(period='day').purchases, 2)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+class WifiSessionQueryPlanTests(TestCase):
+    def assertPlan(self, queryset, expected):
+        plan = queryset.explain()
+        self.assertIn(expected, plan)
+        self.assertNotIn('SCAN billing_app_wifisession', plan)
+
+    def test_cleanup_streams_expired_sessions_off_the_partial_index(self):
+        # Ordered by the index too - no temp b-tree sort
+        plan = expired_sessions().explain()
+        self.assertIn('USING INDEX wifisession_active_expiry_idx (expires_at<?)', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_reconcile_reads_only_live_paid_sessions(self):
+        self.assertPlan(live_sessions(), 'USING INDEX wifisession_paid_live_idx (expires_at>?)')
+
+    def test_expiry_window_uses_active_expiry_index(self):
+        queryset = WifiSession.objects.filter(is_active=True, expires_at__lte=timezone.now())
+        self.assertPlan(queryset, 'USING INDEX wifisession_active_expiry_idx (expires_at<?)')
+
+    def test_device_lookups_use_the_mac_unique_index(self):
+        queryset = WifiSession.objects.only('expires_at', 'payment_amount').filter(
+            mac_address='aa:bb:cc:dd:ee:01', is_paid=True
+        )
+        self.assertPlan(queryset, '(mac_address=?)')
+
+    def test_admin_keyset_pages_filtered_on_paid_or_active_use_partial_indexes(self):
+        created_at, pk = decode_cursor(encode_cursor(timezone.now(), 42))
+        for flag, index in (('is_paid', 'wifisession_paid_created_idx'), ('is_active', 'wifisession_active_created_idx')):
+            queryset = WifiSession.objects.filter(**{flag: True}).filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk), created_at__lte=created_at
+            ).order_by('-created_at', '-pk')
+            plan = queryset.explain()
+            self.assertIn(f'USING INDEX {index} (created_at<?)', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_admin_ip_prefix_search_is_an_index_range(self):
+        self.assertPlan(WifiSession.objects.filter(indexed_search('10.0.3.')), 'USING INDEX wifisession_ip_idx (ip_address>? AND ip_address<?)')
+
+
+@override_settings(ENVIRONMENT='development')
+class PlanCatalogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        plan_catalog._snapshot = None
+        self.plan = PaymentPlan.objects.create(name='1 Hour', price='2.00', duration_hours=1)
+
+    def test_catalog_rebuilt_only_when_a_plan_changes(self):
+        with self.assertNumQueries(1):
+            plan_catalog.get()
+        with self.assertNumQueries(0):
+            snapshot = plan_catalog.get()
+        self.assertIn('$2.00', snapshot.plan_cards)
+
+        self.plan.price = '3.00'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.plan.save()
+            # Not before the change commits
+            self.assertIs(plan_catalog.get(), snapshot)
+        snapshot = plan_catalog.get()
+        self.assertEqual(str(snapshot.plan_or_404(self.plan.id).price), '3.00')
+        self.assertIn('$3.00', snapshot.plan_cards)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.plan.delete()
+        self.assertEqual(plan_catalog.get().active, [])
+
+    @override_settings(PLAN_CATALOG_TTL=60)
+    def test_unsignalled_change_shows_up_after_ttl(self):
+        plan_catalog.get()
+        PaymentPlan.objects.filter(pk=self.plan.pk).update(price='4.00')  # no signal, e.g. another process
+        self.assertEqual(str(plan_catalog.get().plan_or_404(self.plan.id).price), '2.00')
+
+        cache.delete('plan_catalog:version')  # what the TTL does
+        self.assertEqual(str(plan_catalog.get().plan_or_404(self.plan.id).price), '4.00')
+
+    def test_portal_landing_does_not_query_plans(self):
+        self.client.get('/')  # warm the catalog
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/')
+
+        self.assertContains(response, '1 Hour')
+        self.assertFalse([q for q in queries.captured_queries if 'billing_app_paymentplan' in q['sql']])
+
+
+@override_settings(ENVIRONMENT='development')
+class UnpaidSessionWriterTests(TestCase):
+    def setUp(self):
+        # A long interval keeps the background thread idle; the test flushes itself
+        self.writer = UnpaidSessionWriter(batch_size=100, interval=60)
+
+    def test_new_devices_are_inserted_in_one_batch(self):
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:00', ip_address='10.0.0.1')
+        for i in range(5):
+            self.writer.add(f'aa:bb:cc:dd:ee:{i:02x}', f'10.0.0.{i + 1}')
+        self.writer.add('aa:bb:cc:dd:ee:01', '10.0.0.2')  # same device landing twice
+
+        with self.assertNumQueries(1):
+            self.writer.flush()
+
+        self.assertEqual(WifiSession.objects.count(), 5)
+        self.assertEqual(self.writer.stats(), {'queued': 0, 'batches': 1, 'rows': 5, 'dropped': 0})
+
+    @override_settings(UNPAID_SESSION_BATCHING=True)
+    def test_select_plan_creates_a_row_still_queued(self):
+        plan = PaymentPlan.objects.create(name='1 Hour', price='2.00', duration_hours=1)
+        with mock.patch('billing_app.views.unpaid_session_writer', self.writer):
+            self.client.get('/')
+            self.assertFalse(WifiSession.objects.exists())
+            response = self.client.get(f'/select-plan/{plan.id}/')
+
+        self.assertRedirects(response, '/payment/', fetch_redirect_response=False)
+        session = WifiSession.objects.get(mac_address='02:00:7f:00:00:01')
+        self.assertEqual(self.client.session['wifi_session_id'], str(session.session_id))
+        self.writer.flush()  # the queued duplicate is skipped
+        self.assertEqual(WifiSession.objects.count(), 1)
+
+
+class BenchPortalTests(TransactionTestCase):
+    def test_full_flow_report(self):
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:01', ip_address='10.9.9.9', is_paid=True,
+                                   is_active=True)
+        out = StringIO()
+        call_command('bench_portal', devices=3, threads=2, browse=2, reuse_db=True, stdout=out)
+        report = json.loads(out.getvalue())
+
+        views = report['views']
+        self.assertEqual(views['probe']['statuses'], {'302': 3})
+        self.assertEqual(views['process_payment']['statuses'], {'200': 3})
+        self.assertEqual(views['internet_access']['statuses'], {'200': 3})
+        self.assertEqual(views['browse']['requests'], 6)
+        self.assertEqual(report['spawns_per_request'], 0)
+        # The bench devices' sessions are gone from the reused database, the existing one stays
+        self.assertEqual(list(WifiSession.objects.values_list('mac_address', flat=True)), ['aa:bb:cc:dd:ee:01'])
+
+
+class MetricsTests(SimpleTestCase):
+    def test_thread_shards_and_peer_snapshots_are_summed(self):
+        registry = Registry()
+        latency = registry.histogram('latency_seconds', 'Latency', ['view'], buckets=(0.1, 1.0))
+        errors = registry.counter('errors_total', 'Errors')
+
+        def work():
+            for _ in range(100):
+                latency.observe(0.05, 'portal')
+                errors.inc()
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latency.observe(5, 'portal')
+
+        with tempfile.TemporaryDirectory() as directory:
+            # A second (live) worker process reported one more error
+            with open(f'{directory}/{os.getppid()}.json', 'w') as fh:
+                json.dump({'errors_total': [[[], [1]]]}, fh)
+            text = registry.render(directory)
+
+        self.assertIn('latency_seconds_bucket{view="portal",le="0.1"} 400', text)
+        self.assertIn('latency_seconds_bucket{view="portal",le="+Inf"} 401', text)
+        self.assertIn('latency_seconds_count{view="portal"} 401', text)
+        self.assertIn('errors_total 401', text)
+        self.assertIn('# TYPE latency_seconds histogram', text)
+
+
+@override_settings(ENVIRONMENT='development', TRAFFIC_CONTROL_METHOD='simulation')
+class MetricsEndpointTests(TestCase):
+    def test_metrics_exported_to_allowed_ips_only(self):
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:01', ip_address='10.0.0.5', is_paid=True, is_active=True,
+                                   expires_at=timezone.now() + timedelta(minutes=3))
+        self.client.get('/internet-access/')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('wifi_active_paid_sessions 1', text)
+        self.assertIn('wifi_sessions_expiring{within="5m"} 1', text)
+        self.assertIn('wifi_portal_decision_seconds_count{decision="bypass"}', text)
+        self.assertIn('wifi_db_queries_per_request_count', text)
+
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 404)
+        spoofed = self.client.get('/metrics', REMOTE_ADDR='10.0.0.5',
+                                  HTTP_X_FORWARDED_FOR='127.0.0.1', HTTP_X_REAL_IP='127.0.0.1')
+        self.assertEqual(spoofed.status_code, 404)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_token_required_when_configured(self):
+        # Proxied captive clients all arrive from 127.0.0.1
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+
+    def test_only_the_metrics_path_itself_bypasses_the_portal(self):
+        response = self.client.get('/metricsX', REMOTE_ADDR='10.0.0.5')
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+
+def dnsmasq_line(i, expires=2000000000):
+    return f'{expires} 02:00:00:{i >> 16 & 0xff:02x}:{i >> 8 & 0xff:02x}:{i & 0xff:02x} 10.8.{i >> 8 & 0xff}.{i & 0xff} phone-{i} *\n'
+
+
+def isc_block(ip, mac, state='active', ends='epoch 2000000000'):
+    return f'lease {ip} {{\n  starts epoch 1700000000;\n  ends {ends};\n  binding state {state};\n' \
+           f'  hardware ethernet {mac};\n  client-hostname "phone";\n}}\n'
+
+
+class LeaseIndexTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = Path(tmp.name)
+
+    def index(self, path, **kwargs):
+        index = LeaseIndex(path=str(path), watch=False, clock=lambda: 1900000000, **kwargs)
+        self.addCleanup(index.stop)
+        return index
+
+    def test_dnsmasq_rewrite_parses_only_changed_lines(self):
+        path = self.dir / 'dnsmasq.leases'
+        lines = ['duid 00:01:00:01:2c:aa:bb:cc\n'] + [dnsmasq_line(i) for i in range(1, 30001)]
+        path.write_text(''.join(lines))
+        index = self.index(path)
+
+        self.assertEqual(index.lookup('10.8.0.1'), '02:00:00:00:00:01')
+        self.assertEqual(index.stats()['leases'], 30000)
+        parsed = index.parsed
+
+        # dnsmasq rewrites the whole file: one lease renewed, one released, one expired, one new
+        lines[1] = dnsmasq_line(1, expires=2100000000)
+        del lines[2]
+        lines[3] = dnsmasq_line(3, expires=1800000000)
+        lines.append(dnsmasq_line(30001))
+        path.write_text(''.join(lines))
+        index.refresh()
+
+        self.assertEqual(index.parsed - parsed, 3)
+        self.assertEqual(index.lookup('10.8.0.1'), '02:00:00:00:00:01')
+        self.assertIsNone(index.lookup('10.8.0.2'))
+        self.assertIsNone(index.lookup('10.8.0.3'))  # expired
+        self.assertEqual(index.lookup('10.8.117.49'), '02:00:00:00:75:31')
+
+    def test_isc_appends_are_applied_incrementally(self):
+        path = self.dir / 'dhcpd.leases'
+        path.write_text('# The format of this file is documented in dhcpd.leases(5)\n'
+                        + isc_block('10.9.0.5', 'aa:bb:cc:00:00:05')
+                        + isc_block('10.9.0.6', 'aa:bb:cc:00:00:06', ends='3 2031/01/01 00:00:00'))
+        index = self.index(path)
+        self.assertEqual(index.lookup('10.9.0.6'), 'aa:bb:cc:00:00:06')
+
+        # dhcpd appends the new state; a half-written block waits for the rest
+        released = isc_block('10.9.0.5', 'aa:bb:cc:00:00:05', state='free')
+        reassigned = isc_block('10.9.0.6', 'aa:bb:cc:00:00:66')
+        with open(path, 'a') as fh:
+            fh.write(released + reassigned[:40])
+        index.refresh()
+        self.assertEqual(index.parsed, 3)
+        self.assertIsNone(index.lookup('10.9.0.5'))
+        self.assertEqual(index.lookup('10.9.0.6'), 'aa:bb:cc:00:00:06')
+
+        with open(path, 'a') as fh:
+            fh.write(reassigned[40:])
+        index.refresh()
+        self.assertEqual(index.parsed, 4)
+        self.assertEqual(index.lookup('10.9.0.6'), 'aa:bb:cc:00:00:66')
+        self.assertEqual(index.stats()['appends'], 2)
+
+        # Hourly compaction writes a new file and renames it over the old one
+        compacted = self.dir / 'dhcpd.leases~'
+        compacted.write_text(reassigned)
+        os.replace(compacted, path)
+        index.refresh()
+        self.assertEqual(index.parsed, 4)
+        self.assertEqual(index.lookup('10.9.0.6'), 'aa:bb:cc:00:00:66')
+
+    @skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_inotify_applies_changes_without_lookups_reloading(self):
+        path = self.dir / 'dnsmasq.leases'
+        path.write_text(dnsmasq_line(1))
+        index = LeaseIndex(path=str(path), clock=lambda: 1900000000)
+        self.addCleanup(index.stop)
+        self.assertEqual(index.lookup('10.8.0.1'), '02:00:00:00:00:01')
+        self.assertEqual(type(index._watcher).__name__, 'InotifyWatcher')
+
+        path.write_text(dnsmasq_line(1) + dnsmasq_line(2))
+        for _ in range(100):
+            if index.lookup('10.8.0.2'):
+                break
+            threading.Event().wait(0.02)
+        self.assertEqual(index.lookup('10.8.0.2'), '02:00:00:00:00:02')
+
+    def test_client_mac_prefers_lease_over_neighbor_table(self):
+        path = self.dir / 'dnsmasq.leases'
+        path.write_text(dnsmasq_line(1))
+        neighbors = NeighborTable(source=StaticSource({'10.8.0.1': 'ff:00:00:00:00:01',
+                                                       '10.8.0.2': '02:00:00:00:00:02'}))
+        with mock.patch('billing_app.views.lease_index', self.index(path)), \
+                mock.patch('billing_app.views.neighbor_table', neighbors):
+            self.assertEqual(get_client_mac(RequestFactory().get('/', REMOTE_ADDR='10.8.0.1')), '02:00:00:00:00:01')
+            self.assertEqual(get_client_mac(RequestFactory().get('/', REMOTE_ADDR='10.8.0.2')), '02:00:00:00:00:02')
+            self.assertEqual(neighbors.refreshes, 1)
+
+
+class MACConversionMigrationTests(TransactionTestCase):
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('billing_app', target)])
+        return executor.loader.project_state([('billing_app', target)]).apps
+
+    def test_same_device_rows_merge_and_nothing_moves_to_a_neighbour(self):
+        self.addCleanup(self.migrate, MigrationLoader(connection).graph.leaf_nodes('billing_app')[0][1])
+        WifiSession = self.migrate('0003_wifisession_indexes').get_model('billing_app', 'WifiSession')
+        now = timezone.now()
+        paid = WifiSession.objects.create(mac_address='aa-bb-cc-dd-ee-01', ip_address='10.0.0.2', is_paid=True,
+                                          is_active=True, expires_at=now + timedelta(hours=1))
+        WifiSession.objects.create(mac_address='AA:BB:CC:DD:EE:01', ip_address='10.0.0.1')
+        other = WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:02', ip_address='10.0.0.3')
+        # crc32('dev:mac:x') lands on a real device's MAC in the 02:01 space
+        taken = 0x0201_0000_0000 | zlib.crc32(b'dev:mac:x')
+        real = WifiSession.objects.create(mac_address=format_mac(taken), ip_address='10.0.0.4')
+        dev = WifiSession.objects.create(mac_address='dev:mac:x', ip_address='10.0.0.5')
+
+        WifiSession = self.migrate('0004_wifisession_mac_int').get_model('billing_app', 'WifiSession')
+        macs = dict(WifiSession.objects.values_list('id', 'mac_address'))
+        self.assertEqual(macs[paid.id], 'aa:bb:cc:dd:ee:01')
+        self.assertEqual(macs[other.id], 'aa:bb:cc:dd:ee:02')
+        self.assertEqual(macs[real.id], format_mac(taken))
+        self.assertEqual(macs[dev.id], format_mac(taken + 1))
+        self.assertEqual(len(macs), 4)
+
+
+class MACAddressFieldTests(TestCase):
+    def test_any_notation_parses_to_the_same_48_bit_value(self):
+        for notation in ('aa:bb:cc:0d:ee:0f', 'AA-BB-CC-0D-EE-0F', 'aabb.cc0d.ee0f', 'AABBCC0DEE0F', 'aa:bb:cc:d:ee:f'):
+            self.assertEqual(parse_mac(notation), 0xaabbcc0dee0f, notation)
+        self.assertEqual(format_mac(0xaabbcc0dee0f), 'aa:bb:cc:0d:ee:0f')
+        self.assertEqual(prefix_range('AA-BB-CC'), (0xaabbcc000000, 0xaabbccffffff))
+        for invalid in ('dev:mac:1', 'aa:bb:cc:dd:ee', 'aa:bb:cc:dd:ee:ff:00', 'zz:bb:cc:dd:ee:ff', ''):
+            with self.assertRaises(ValueError):
+                parse_mac(invalid)
+
+    def test_stored_as_integer_and_looked_up_in_any_notation(self):
+        session = WifiSession.objects.create(mac_address='AA-BB-CC-DD-EE-01', ip_address='10.0.0.1')
+        WifiSession.objects.create(mac_address='aa:bb:cd:00:00:01', ip_address='10.0.0.2')
+        self.assertEqual(session.mac_address, 'aa:bb:cc:dd:ee:01')
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT mac_address FROM billing_app_wifisession WHERE id = %s', [session.id])
+            self.assertEqual(cursor.fetchone()[0], 0xaabbccddee01)
+        self.assertEqual(WifiSession.objects.get(mac_address='aabb.ccdd.ee01'), session)
+        self.assertEqual(list(WifiSession.objects.filter(mac_address__prefix='AA:BB:CC')), [session])
+        self.assertEqual(list(WifiSession.objects.filter(mac_address__in=['AABBCCDDEE01'])), [session])
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN output is SQLite specific')
+    def test_oui_lookup_is_an_index_range_scan(self):
+        plan = WifiSession.objects.filter(mac_address__prefix='aa:bb:cc').explain()
+        self.assertIn('(mac_address>? AND mac_address<?)', plan)
+
+    def test_admin_search_matches_partial_macs(self):
+        from django.contrib.admin.sites import site
+        session = WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:01', ip_address='10.0.0.1')
+        WifiSession.objects.create(mac_address='aa:bb:cd:00:00:01', ip_address='10.0.0.2')
+        model_admin = site._registry[WifiSession]
+        results, _ = model_admin.get_search_results(None, WifiSession.objects.all(), 'AA-BB-CC')
+        self.assertEqual(list(results), [session])
+
+
+class WifiSessionAdminTests(TestCase):
+    def setUp(self):
+        from django.contrib.admin.sites import site
+        self.model_admin = site._registry[WifiSession]
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        now = timezone.now()
+        for i in range(7):
+            WifiSession.objects.create(mac_address=f'aa:bb:cc:00:00:{i:02x}', ip_address=f'10.0.{i}.1', is_paid=i % 2 == 0)
+        # Rows 2-4 share a timestamp: the id breaks the tie across page boundaries
+        for i, session in enumerate(WifiSession.objects.order_by('id')):
+            WifiSession.objects.filter(pk=session.pk).update(created_at=now - timedelta(minutes=min(i, 2) if i <= 4 else i))
+
+    def changelist(self, query=''):
+        with mock.patch.object(self.model_admin, 'list_per_page', 3):
+            return self.client.get(f'/admin/billing_app/wifisession/{query}')
+
+    def test_keyset_pages_cover_every_row_once_newest_first(self):
+        seen, query = [], ''
+        while True:
+            response = self.changelist(query)
+            cl = response.context['cl']
+            seen += [session.pk for session in cl.result_list]
+            if not cl.next_url:
+                break
+            query = cl.next_url
+        expected = list(WifiSession.objects.order_by('-created_at', '-pk').values_list('pk', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertContains(response, 'Newest')
+
+    def test_changelist_never_counts_the_table(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.changelist()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q['sql'] for q in queries if 'COUNT(' in q['sql'].upper()])
+        self.assertEqual(response.context['cl'].result_count, estimated_count(WifiSession))
+        self.assertContains(response, '~7 wifi sessions')
+
+    def test_bulk_delete_invalidates_and_publishes_every_device(self):
+        targets = list(WifiSession.objects.filter(is_paid=True).values_list('pk', 'mac_address', 'ip_address'))
+        for _pk, mac_address, _ip in targets:
+            authorization_cache.set_authorized(mac_address, timezone.now() + timedelta(hours=1))
+        self.addCleanup(authorization_cache.clear)
+
+        with mock.patch('billing_app.admin.gateway_events.revoke') as revoke:
+            response = self.client.post('/admin/billing_app/wifisession/', {
+                'action': 'delete_selected', 'post': 'yes', '_selected_action': [pk for pk, _mac, _ip in targets],
+            })
+
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(WifiSession.objects.filter(is_paid=True).exists())
+        self.assertEqual(sorted(revoke.call_args.args[0]), sorted((mac, ip) for _pk, mac, ip in targets))
+        for _pk, mac_address, _ip in targets:
+            self.assertIsNone(authorization_cache.get(mac_address))
+
+    def test_filtered_count_is_capped_and_respects_the_filter(self):
+        response = self.changelist('?is_paid__exact=1')
+        cl = response.context['cl']
+        self.assertEqual(cl.result_count, 4)
+        self.assertTrue(all(session.is_paid for session in cl.result_list))
+        self.assertIn('is_paid__exact=1', cl.next_url)
+        self.assertContains(response, '4 wifi sessions')
+
+    def test_search_is_exact_or_prefix_on_indexed_columns(self):
+        session = WifiSession.objects.get(ip_address='10.0.3.1')
+        for term in ('10.0.3.', '10.0.3.1', str(session.session_id), 'aa:bb:cc:00:00:03'):
+            results, _ = self.model_admin.get_search_results(None, WifiSession.objects.all(), term)
+            self.assertEqual(list(results), [session], term)
+        results, _ = self.model_admin.get_search_results(None, WifiSession.objects.all(), 'no such device')
+        self.assertEqual(list(results), [])
+
+
+@override_settings(TIME_ZONE='UTC')
+class PaymentLedgerTests(TestCase):
+    def setUp(self):
+        self.hour = PaymentPlan.objects.create(name='1 Hour', price='2.00', duration_hours=1)
+        self.day = PaymentPlan.objects.create(name='1 Day', price='10.00', duration_hours=24)
+        self.now = timezone.now().replace(hour=12, minute=30)
+        self.purchases = [
+            (self.hour, self.now), (self.hour, self.now - timedelta(minutes=20)),
+            (self.day, self.now - timedelta(hours=1)), (self.hour, self.now - timedelta(days=1)),
+        ]
+
+    def record_all(self):
+        for i, (plan, at) in enumerate(self.purchases):
+            record_payment(plan, f'aa:bb:cc:00:00:{i:02x}', at=at)
+
+    def rollups(self):
+        return sorted(RevenueRollup.objects.values_list('period', 'bucket_start', 'plan__name', 'revenue', 'purchases'))
+
+    def test_rollups_are_maintained_on_write(self):
+        self.record_all()
+        self.assertFalse(Payment.objects.filter(rolled_up=False).exists())
+        noon = self.now.replace(minute=0, second=0, microsecond=0)
+        midnight = noon.replace(hour=0)
+        self.assertEqual(self.rollups(), [
+            ('day', midnight - timedelta(days=1), '1 Hour', Decimal('2.00'), 1),
+            ('day', midnight, '1 Day', Decimal('10.00'), 1),
+            ('day', midnight, '1 Hour', Decimal('4.00'), 2),
+            ('hour', noon - timedelta(days=1), '1 Hour', Decimal('2.00'), 1),
+            ('hour', noon - timedelta(hours=1), '1 Day', Decimal('10.00'), 1),
+            ('hour', noon, '1 Hour', Decimal('4.00'), 2),
+        ])
+
+    def test_compactor_folds_the_backlog_to_the_same_rollups(self):
+        self.record_all()
+        expected = self.rollups()
+        RevenueRollup.objects.all().delete()
+        Payment.objects.update(rolled_up=False)
+
+        with override_settings(REVENUE_ROLLUP_ON_WRITE=False):
+            record_payment(self.hour, 'aa:bb:cc:00:00:09', at=self.now)
+        self.assertEqual(RevenueRollup.objects.count(), 0)
+        self.assertEqual(compact(batch_size=2), 5)
+        self.assertEqual(compact(), 0)
+        rollup = RevenueRollup.objects.get(period='hour', bucket_start=self.now.replace(minute=0, second=0, microsecond=0))
+        self.assertEqual((rollup.revenue, rollup.purchases), (Decimal('6.00'), 3))
+        self.assertEqual(len(self.rollups()), len(expected))
+
+    def test_report_reads_only_rollups(self):
+        self.record_all()
+        with CaptureQueriesContext(connection) as queries:
+            plans, rows = revenue_report('day', 7, now=self.now)
+        self.assertFalse([q['sql'] for q in queries if '"billing_app_payment"' in q['sql']])
+        self.assertEqual(plans, [self.hour, self.day])
+        self.assertEqual([(revenue, purchases) for _start, _by_plan, revenue, purchases in rows],
+                         [(Decimal('14.00'), 3), (Decimal('2.00'), 1)])
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        response = self.client.get('/admin/billing_app/revenuerollup/?period=hour')
+        self.assertContains(response, '<strong>10.00</strong> (1)', html=False)
+        response = self.client.get('/admin/billing_app/payment/?q=aa:bb:cc:00:00:01')
+        self.assertEqual([payment.mac_address for payment in response.context['cl'].result_list], ['aa:bb:cc:00:00:01'])
+
+
+class FakeCounters:
+    def __init__(self):
+        self.readings = {}
+
+    def counters(self):
+        return dict(self.readings)
+
+
+class UsageMeteringTests(TestCase):
+    def test_each_backend_reads_all_counters_in_one_dump(self):
+        executor = RecordingExecutor(outputs={
+            'iptables-save': (
+                '*filter\n'
+                ':CAPTIVE_PORTAL - [0:0]\n'
+                '[10:1500] -A CAPTIVE_PORTAL -m mac --mac-source AA:BB:CC:DD:EE:01 -j ACCEPT\n'
+                '[2:100] -A CAPTIVE_PORTAL -s 10.0.0.2/32 -j ACCEPT\n'
+                '[99:9999] -A CAPTIVE_PORTAL -p udp --dport 53 -j ACCEPT\n'
+                'COMMIT\n'
+            ),
+            'ipset': (
+                'create wifi_paid_macs hash:mac timeout 0 counters\n'
+                'add wifi_paid_macs AA:BB:CC:DD:EE:01 timeout 100 packets 10 bytes 1500\n'
+                'add wifi_paid_ips 10.0.0.2 timeout 100 packets 2 bytes 100\n'
+            ),
+            'nft': json.dumps({'nftables': [
+                {'set': {'name': 'paid_macs', 'elem': [
+                    {'elem': {'val': 'aa:bb:cc:dd:ee:01', 'timeout': 100, 'counter': {'packets': 10, 'bytes': 1500}}},
+                ]}},
+                {'set': {'name': 'paid_ips', 'elem': [
+                    {'elem': {'val': '10.0.0.2', 'counter': {'packets': 2, 'bytes': 100}}},
+                ]}},
+            ]}),
+        })
+        expected = {('mac', 'aa:bb:cc:dd:ee:01'): (10, 1500), ('ip', '10.0.0.2'): (2, 100)}
+        for backend in (IptablesChain(executor), IpsetBackend(executor), NftablesBackend(executor)):
+            self.assertEqual(backend.counters(), expected, backend.method)
+        self.assertEqual(len(executor.batches), 3)
+        self.assertEqual(executor.batches[0][0], ['iptables-save', '-c', '-t', 'filter'])
+
+    def test_deltas_are_attributed_per_mac_and_downsampled(self):
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:02', ip_address='10.0.0.2', is_active=True)
+        source = FakeCounters()
+        meter = UsageMeter(source)
+        start = floor_time(timezone.now(), 3600) + timedelta(minutes=1)
+
+        source.readings = {('mac', 'aa:bb:cc:dd:ee:01'): (10, 1000), ('ip', '10.0.0.2'): (1, 50)}
+        self.assertEqual(meter.collect(start).devices, 0)  # baseline only
+        source.readings = {('mac', 'aa:bb:cc:dd:ee:01'): (15, 1500), ('ip', '10.0.0.2'): (3, 250),
+                           ('mac', 'aa:bb:cc:dd:ee:02'): (1, 100), ('ip', '10.9.9.9'): (1, 10)}
+        report = meter.collect(start + timedelta(minutes=1))
+        self.assertEqual((report.devices, report.bytes, report.unattributed), (2, 800, ['10.9.9.9']))
+        # The rule for ...:01 was rewritten - its counter restarted
+        source.readings = {('mac', 'aa:bb:cc:dd:ee:01'): (2, 300)}
+        meter.collect(start + timedelta(minutes=6))
+
+        def samples(resolution):
+            return sorted(UsageSample.objects.filter(resolution=resolution).values_list('mac_address', 'bucket_start', 'bytes'))
+
+        self.assertEqual(len(samples(UsageSample.RAW)), 3)
+        self.assertEqual(samples(UsageSample.FIVE_MINUTES), [
+            ('aa:bb:cc:dd:ee:01', start - timedelta(minutes=1), 500),
+            ('aa:bb:cc:dd:ee:01', start + timedelta(minutes=4), 300),
+            ('aa:bb:cc:dd:ee:02', start - timedelta(minutes=1), 300),
+        ])
+        self.assertEqual(samples(UsageSample.HOURLY), [
+            ('aa:bb:cc:dd:ee:01', start - timedelta(minutes=1), 800),
+            ('aa:bb:cc:dd:ee:02', start - timedelta(minutes=1), 300),
+        ])
+        self.assertEqual(usage_since('aa:bb:cc:dd:ee:01', start), (800, 7))
+
+        # A day later the raw samples have aged out; the hourly ones stay
+        source.readings = {}
+        self.assertEqual(meter.collect(start + timedelta(days=1, minutes=7)).pruned, 3)
+        self.assertEqual(len(samples(UsageSample.HOURLY)), 2)
+
+    @override_settings(ENVIRONMENT='development', TRAFFIC_CONTROL_METHOD='simulation')
+    def test_usage_shown_on_success_page_and_in_admin(self):
+        plan = PaymentPlan.objects.create(name='1 Hour', price='2.00', duration_hours=1)
+        session = WifiSession.objects.create(mac_address='02:00:7f:00:00:01', ip_address='127.0.0.1')
+        record_purchase(session, plan)
+        UsageSample.objects.create(mac_address='02:00:7f:00:00:01', resolution=UsageSample.HOURLY,
+                                   bucket_start=floor_time(timezone.now(), 3600), bytes=5 * 1024 * 1024, packets=4000)
+        self.assertContains(self.client.get('/internet-access/'), 'Data Uploaded:</strong> 5.0\xa0MB')
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        response = self.client.get('/admin/billing_app/usagesample/')
+        self.assertRedirects(response, '/admin/billing_app/usagesample/?resolution__exact=3600')
+        response = self.client.get('/admin/billing_app/usagesample/?resolution__exact=3600&q=02:00:7f')
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+        self.assertContains(self.client.get(f'/admin/billing_app/wifisession/{session.pk}/change/'), '5.0\xa0MB')
+
+
+class GatewayBusTests(SimpleTestCase):
+    def check_stream(self, server):
+        bus = RedisStreamBus(server.url, stream='test:events', maxlen=100)
+        self.addCleanup(server.stop)
+        self.assertIsNone(bus.first_id())
+        ids = bus.publish_many([{'op': 'grant', 'mac': 'aa:bb:cc:dd:ee:01'}, {'op': 'revoke', 'mac': 'aa:bb:cc:dd:ee:02'}])
+        self.assertEqual((bus.first_id(), bus.last_id()), tuple(ids))
+        self.assertEqual([event['op'] for _id, event in bus.read('0-0')], ['grant', 'revoke'])
+        self.assertEqual(bus.read(ids[-1], block=0.05), [])
+
+        # A blocked XREAD returns as soon as another node publishes
+        threading.Timer(0.05, bus.publish_many, [[{'op': 'grant', 'mac': 'aa:bb:cc:dd:ee:03'}]]).start()
+        started = timezone.now()
+        events = bus.read(ids[-1], block=5)
+        self.assertEqual(events[0][1]['mac'], 'aa:bb:cc:dd:ee:03')
+        self.assertLess(timezone.now() - started, timedelta(seconds=2))
+
+    def test_stream_over_tcp(self):
+        server = StubRedis(password='s3cret').start()
+        with self.assertRaises(BusError):
+            RedisStreamBus(server.url.replace('s3cret', 'wrong')).last_id()
+        self.check_stream(server)
+
+    def test_stream_over_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'bus.sock')
+        self.check_stream(UnixStubRedis(path).start())
+
+    def test_local_bus_trims_to_maxlen(self):
+        bus = LocalBus(maxlen=2)
+        ids = bus.publish_many([{'n': n} for n in range(5)])
+        self.assertEqual(ids, sorted(ids, key=parse_id))
+        self.assertEqual([event['n'] for _id, event in bus.read('0-0')], [3, 4])
+        self.assertEqual(bus.read('$'), [])
+
+
+class GatewaySyncTests(TestCase):
+    def make_sync(self, bus, node='b'):
+        sync = GatewaySync(bus, node, cursor_path=self.cursor_path, grant=self.granted.append,
+                           revoke=self.revoked.extend, resync=lambda: None)
+        return sync
+
+    def setUp(self):
+        self.cursor_path = os.path.join(tempfile.mkdtemp(), 'gateway_sync.cursor')
+        self.granted, self.revoked = [], []
+        self.later = (timezone.now() + timedelta(hours=1)).timestamp()
+
+    def test_applies_peer_events_and_resumes_from_cursor(self):
+        bus = LocalBus()
+        bus.publish_many([{'op': 'grant', 'mac': 'aa:bb:cc:dd:ee:00', 'node': 'a', 'expires_at': self.later}])
+        sync = self.make_sync(bus)
+        sync.catch_up()
+        self.assertEqual(sync.resyncs, 1)  # first start: the database already has that grant
+
+        bus.publish_many([
+            {'op': 'grant', 'mac': 'aa:bb:cc:dd:ee:01', 'node': 'a', 'expires_at': self.later},
+            {'op': 'grant', 'mac': 'aa:bb:cc:dd:ee:02', 'node': 'b', 'expires_at': self.later},
+            {'op': 'grant', 'mac': 'aa:bb:cc:dd:ee:03', 'node': 'a', 'expires_at': self.later},
+            {'op': 'revoke', 'mac': 'aa:bb:cc:dd:ee:03', 'ip': '10.0.2.3', 'node': 'c'},
+            {'op': 'grant', 'mac': 'aa:bb:cc:dd:ee:04', 'node': 'a', 'expires_at': self.later - 7200},
+        ])
+        self.assertEqual(sync.run_once(), 5)
+        self.assertEqual([event['mac'] for event in self.granted], ['aa:bb:cc:dd:ee:01'])
+        self.assertEqual(self.revoked, [('aa:bb:cc:dd:ee:03', '10.0.2.3')])
+        self.assertEqual(sync.skipped, 1)
+
+        # Restarted: picks up where it stopped, without a resync
+        bus.publish_many([{'op': 'revoke', 'mac': 'aa:bb:cc:dd:ee:01', 'node': 'a'}])
+        restarted = self.make_sync(bus)
+        self.assertEqual(restarted.run_once(), 1)
+        self.assertEqual(restarted.resyncs, 0)
+        self.assertEqual(self.revoked[-1], ('aa:bb:cc:dd:ee:01', None))
+
+    @override_settings(TRAFFIC_CONTROL_METHOD='iptables', FIREWALL_HELPER_SOCKET=None)
+    def test_repeated_remote_grants_insert_the_rule_once(self):
+        bus = LocalBus()
+        sync = GatewaySync(bus, 'b', cursor_path=self.cursor_path, resync=lambda: None)
+        sync.catch_up()
+        present = set()
+
+        def run(args, check=True, **kwargs):
+            if args[2] == '-C':
+                return subprocess.CompletedProcess(args, 0 if tuple(args[3:]) in present else 1)
+            if args[2] == '-I':
+                present.add(tuple(args[3:]))
+            return subprocess.CompletedProcess(args, 0)
+
+        with mock.patch('billing_app.views.subprocess.run', side_effect=run) as mocked:
+            for _ in range(3):  # repeat purchases, events re-published after a catch-up
+                bus.publish_many([{'op': 'grant', 'mac': 'aa:bb:cc:dd:ee:01', 'node': 'a', 'expires_at': self.later}])
+                sync.run_once()
+
+        inserts = [call.args[0] for call in mocked.call_args_list if call.args[0][2] == '-I']
+        self.assertEqual(inserts, [
+            ['sudo', 'iptables', '-I', 'CAPTIVE_PORTAL', '-m', 'mac', '--mac-source', 'aa:bb:cc:dd:ee:01', '-j', 'ACCEPT'],
+        ])
+
+    def test_cursor_trimmed_out_of_the_stream_resyncs(self):
+        bus = LocalBus(maxlen=2)
+        sync = self.make_sync(bus)
+        sync.run_once()
+        bus.publish_many([{'op': 'revoke', 'mac': f'aa:bb:cc:dd:ee:0{n}', 'node': 'a'} for n in range(5)])
+
+        restarted = self.make_sync(bus)
+        self.assertEqual(restarted.catch_up(), bus.last_id())
+        self.assertEqual(restarted.resyncs, 1)
+        self.assertEqual(restarted.run_once(), 0)
+        self.assertEqual(self.revoked, [])
+
+    @override_settings(GATEWAY_BUS_URL='local://gateway-tests', GATEWAY_NODE_ID='a',
+                       TRAFFIC_CONTROL_METHOD='simulation')
+    def test_revocations_are_published_and_invalidate_peer_caches(self):
+        mac = 'aa:bb:cc:dd:ee:01'
+        WifiSession.objects.create(mac_address=mac, ip_address='10.0.0.1', is_paid=True, is_active=True,
+                                   expires_at=timezone.now() - timedelta(minutes=1))
+        cache = AuthorizationCache()
+        cache.set_authorized(mac, timezone.now() + timedelta(hours=1))
+        listener = AuthorizationListener(open_bus(), cache)
+        listener.start()
+        self.addCleanup(listener.stop)
+
+        cleanup_expired_sessions()
+        self.assertEqual(open_bus().entries()[-1][1], {'op': 'revoke', 'mac': mac, 'ip': '10.0.0.1', 'node': 'a'})
+        # The listener starts at '$' - keep publishing until its first XREAD is waiting
+        deadline = timezone.now() + timedelta(seconds=5)
+        while cache.get(mac) is not None and timezone.now() < deadline:
+            gateway_events.revoke([(mac, '10.0.0.1')])
+            listener._stop.wait(0.02)
+        self.assertIsNone(cache.get(mac))
+        self.assertGreater(listener.received, 0)
+
+
+class ScriptedBus:
+    """Hands out scripted read() results (an exception is raised), then stops the listener"""
+
+    def __init__(self, listener, reads):
+        self.listener = listener
+        self.reads = reads
+        self.afters = []
+
+    def read(self, after, count=None, block=None):
+        self.afters.append(after)
+        if not self.reads:
+            self.listener.stop()
+            return []
+        result = self.reads.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class AuthorizationListenerTests(SimpleTestCase):
+    def test_malformed_events_are_skipped_without_killing_the_listener(self):
+        cache = AuthorizationCache()
+        listener = AuthorizationListener(cache=cache)
+        bus = listener._bus = ScriptedBus(listener, [
+            [('1-0', {'op': 'revoke'}), ('2-0', {'op': 'revoke', 'mac': 'aa:bb:cc:dd:ee:01'})],
+            json.JSONDecodeError('Expecting value', '{', 1),
+            [('3-0', {'op': 'revoke', 'mac': 'aa:bb:cc:dd:ee:02'})],
+        ])
+        listener._stop.wait = lambda timeout: False  # no back-off in the test
+
+        with self.assertLogs('billing_app.gateways', 'WARNING') as logs:
+            listener.run()
+
+        self.assertEqual(listener.received, 2)
+        self.assertEqual(bus.afters, ['$', '2-0', '$', '3-0'])
+        self.assertEqual(len(logs.records), 2)
+
+
+@override_settings(ENVIRONMENT='production', TRAFFIC_CONTROL_METHOD='simulation')
+class ConnectivityProbeTests(TestCase):
+    def setUp(self):
+        neighbor_table.set_source(StaticSource({'10.0.0.5': 'aa:bb:cc:dd:ee:05', '10.0.0.6': 'aa:bb:cc:dd:ee:06'}))
+        self.addCleanup(neighbor_table.set_source, None)
+        authorization_cache.clear()
+        self.addCleanup(authorization_cache.clear)
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:05', ip_address='10.0.0.5', is_paid=True,
+                                   is_active=True, expires_at=timezone.now() + timedelta(hours=1))
+
+    def test_each_os_probe_answered_from_memory(self):
+        with self.assertNumQueries(1):  # the paid-device preload
+            self.client.get('/generate_204', REMOTE_ADDR='10.0.0.6')
+        with self.assertNumQueries(0):
+            for path, probe in PROBES.items():
+                response = self.client.get(path, REMOTE_ADDR='10.0.0.5')
+                self.assertEqual((response.status_code, response.content.decode()), (probe.status, probe.body), path)
+                self.assertFalse(response.cookies)
+                self.assertRedirects(self.client.get(path, REMOTE_ADDR='10.0.0.6'), '/', fetch_redirect_response=False)
+        self.assertContains(self.client.get('/hotspot-detect.html', REMOTE_ADDR='10.0.0.5'), 'Success')
+
+    def test_device_changed_since_preload_falls_through_to_the_database(self):
+        self.client.get('/generate_204', REMOTE_ADDR='10.0.0.5')
+        WifiSession.objects.create(mac_address='aa:bb:cc:dd:ee:06', ip_address='10.0.0.6', is_paid=True,
+                                   is_active=True, expires_at=timezone.now() + timedelta(hours=1))
+        authorization_cache.invalidate('aa:bb:cc:dd:ee:06')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/connecttest.txt', REMOTE_ADDR='10.0.0.6').content, b'Microsoft Connect Test')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/generate_204', REMOTE_ADDR='10.0.0.6').status_code, 204)
+
+    def test_invalidation_during_a_preload_wins(self):
+        cache = AuthorizationCache()
+        token = cache.begin_preload()
+        cache.invalidate('aa:bb:cc:dd:ee:05')  # paid/revoked while the sessions were being read
+        cache.preload([('aa:bb:cc:dd:ee:05', timezone.now() + timedelta(hours=1))], token)
+        self.assertIsNone(cache.decision('aa:bb:cc:dd:ee:05'))
+        self.assertIs(cache.decision('aa:bb:cc:dd:ee:07'), False)
+
+    async def test_async_stack_answers_probes(self):
+        async def get_response(request):
+            return HttpResponse('portal stack')
+
+        middleware = CaptivePortalProbeMiddleware(get_response)
+        response = await middleware(AsyncRequestFactory().get('/generate_204', headers={'X-Forwarded-For': '10.0.0.5'}))
+        self.assertEqual(response.status_code, 204)
+        response = await middleware(AsyncRequestFactory().get('/news/', headers={'X-Forwarded-For': '10.0.0.5'}))
+        self.assertEqual(response.content, b'portal stack')
+
+
+class PortalAssetTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.root = Path(tempfile.mkdtemp()) / 'portal_assets'
+        cls.addClassCleanup(shutil.rmtree, cls.root.parent)
+        cls.manifest = AssetBuilder(['error.html'], cls.root).build()
+        cls.enterClassContext(override_settings(PORTAL_ASSET_ROOT=cls.root, PORTAL_ASSETS_SERVE=True))
+        portal_assets.reload()
+        cls.addClassCleanup(portal_assets.reload)
+
+    def test_bundle_holds_only_referenced_assets_with_hashed_urls(self):
+        paths = self.manifest['paths']
+        self.assertIn('assets/css/style.css', paths)
+        self.assertIn('assets/fonts/fa-brands-400.woff2', paths)  # via fontawesome-all.min.css
+        self.assertNotIn('assets/img/post/post_1.png', paths)  # extra_pages only
+        stylesheet = (self.root / paths['assets/css/fontawesome-all.min.css']).read_text()
+        self.assertIn(posixpath.basename(paths['assets/fonts/fa-brands-400.eot']) + '?#iefix', stylesheet)
+        self.assertEqual(minify_css('a  >  b { content: "  /* kept */ "; }\n/* gone */ c { }'),
+                         'a>b{content: "  /* kept */ "}c{}')
+
+    def test_precompressed_immutable_responses(self):
+        url = Template("{% load static %}{% static 'assets/css/style.css' %}").render(Context())
+        hashed = self.manifest['paths']['assets/css/style.css']
+        self.assertEqual(url, f'/static/{hashed}')
+        original = (self.root / hashed).read_bytes()
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='br;q=0, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), original)
+
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(response.streaming_content), original)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        with override_settings(PORTAL_ASSETS_SERVE=False):
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.assertEqual(Template("{% load static %}{% static 'assets/css/style.css' %}").render(Context()),
+                             '/static/assets/css/style.css')
+
+
+class FirewallHelperTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.path = os.path.join(tmp, 'helper.sock')
+        self.executor = RecordingExecutor()
+
+    def start(self, window=0.0):
+        server = FirewallHelper(self.path, Ruleset('iptables', self.executor), window).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def restores(self):
+        return [payload for args, payload in self.executor.batches if args[0] == 'iptables-restore']
+
+    def test_concurrent_requests_share_one_commit(self):
+        server = self.start(window=0.3)
+        results = []
+
+        def grant(mac):
+            client = FirewallHelperClient(self.path)
+            try:
+                results.extend(client.grant([(mac, None, None)]))
+            finally:
+                client.close()
+
+        macs = [f'aa:bb:cc:dd:ee:{i:02x}' for i in range(8)]
+        threads = [threading.Thread(target=grant, args=(mac,)) for mac in macs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [True] * 8)
+        self.assertEqual(server.stats()['commits'], 1)
+        [payload] = self.restores()
+        for mac in macs:
+            self.assertIn(f'-I CAPTIVE_PORTAL -m mac --mac-source {mac} -j ACCEPT', payload)
+
+    def test_unexpected_backend_error_fails_the_batch_and_keeps_committing(self):
+        server = self.start()
+        client = FirewallHelperClient(self.path)
+        self.addCleanup(client.close)
+
+        with mock.patch.object(server.ruleset, 'commit', side_effect=[ValueError('unparsable snapshot'), None]), \
+                self.assertLogs('billing_app.firewallhelper', 'ERROR'):
+            self.assertEqual(client.submit(['G aa:bb:cc:dd:ee:01 - 60']), ['err unparsable snapshot'])
+            self.assertEqual(client.submit(['G aa:bb:cc:dd:ee:02 - 60']), ['ok'])
+        self.assertEqual(server.stats()['failed_commits'], 1)
+
+    def test_each_item_gets_its_own_result(self):
+        self.start()
+        client = FirewallHelperClient(self.path)
+        self.addCleanup(client.close)
+        self.assertEqual(
+            client.submit(['G AA-BB-CC-DD-EE-01 10.0.0.1 60', 'G zz 10.0.0.2 60', 'R - 10.0.0.300', 'X -j ACCEPT']),
+            ['ok', 'err invalid MAC address', 'err invalid IP address', 'err malformed item'],
+        )
+        [payload] = self.restores()
+        self.assertIn('-I CAPTIVE_PORTAL -m mac --mac-source aa:bb:cc:dd:ee:01 -j ACCEPT', payload)
+        self.assertIn('-I CAPTIVE_PORTAL -s 10.0.0.1 -j ACCEPT', payload)
+        self.assertNotIn('10.0.0.2', payload)
+
+    def test_last_operation_on_a_rule_wins(self):
+        ruleset = Ruleset('iptables', self.executor)
+        ruleset.commit([
+            ('G', 'aa:bb:cc:dd:ee:01', '10.0.0.1', 0),
+            ('G', 'aa:bb:cc:dd:ee:02', 'fe80::2', 0),
+            ('R', 'aa:bb:cc:dd:ee:01', None, 0),
+        ])
+        self.assertEqual(set(ruleset.target.items), {('ip', '10.0.0.1'), ('mac', 'aa:bb:cc:dd:ee:02')})
+        self.assertEqual(len(self.restores()), 1)
+
+    def test_commit_only_touches_changed_rules(self):
+        # Rules reconcile_firewall added after the helper started - they and their counters must survive
+        self.executor.outputs['iptables-save'] = (
+            '-A CAPTIVE_PORTAL -m mac --mac-source AA:BB:CC:DD:EE:01 -j ACCEPT\n'
+            '-A CAPTIVE_PORTAL -s 10.0.0.1/32 -j ACCEPT\n'
+            '-A CAPTIVE_PORTAL -m mac --mac-source AA:BB:CC:DD:EE:02 -j ACCEPT\n'
+        )
+        ruleset = Ruleset('iptables', self.executor)
+        ruleset.commit([
+            ('G', 'aa:bb:cc:dd:ee:01', '10.0.0.1', 0),
+            ('G', 'aa:bb:cc:dd:ee:03', None, 0),
+            ('R', 'aa:bb:cc:dd:ee:02', '10.0.0.2', 0),
+        ])
+        [payload] = self.restores()
+        self.assertEqual(payload.splitlines(), [
+            '*filter',
+            '-D CAPTIVE_PORTAL -m mac --mac-source aa:bb:cc:dd:ee:02 -j ACCEPT',
+            '-I CAPTIVE_PORTAL -m mac --mac-source aa:bb:cc:dd:ee:03 -j ACCEPT',
+            'COMMIT',
+        ])
+
+    def test_traffic_control_goes_through_helper(self):
+        server = self.start()
+        self.addCleanup(firewall_helper.close)
+        expires_at = timezone.now() + timedelta(hours=1)
+        with override_settings(TRAFFIC_CONTROL_METHOD='iptables', FIREWALL_HELPER_SOCKET=self.path), \
+                mock.patch('billing_app.views.subprocess.run') as run:
+            self.assertTrue(allow_internet_access('aa:bb:cc:dd:ee:01', '10.0.0.1', expires_at))
+            self.assertEqual(set(server.ruleset.target.items), {('mac', 'aa:bb:cc:dd:ee:01'), ('ip', '10.0.0.1')})
+            self.assertEqual(block_internet_access_bulk([('aa:bb:cc:dd:ee:01', '10.0.0.1')]), [True])
+            self.assertEqual(server.ruleset.target.items, {})
+            run.assert_not_called()
+
+            server.stop()
+            with self.assertLogs('billing_app.firewallhelper', 'ERROR'):
+                self.assertFalse(block_internet_access('aa:bb:cc:dd:ee:01', '10.0.0.1'))
+
+
+@override_settings(ENVIRONMENT='development', TRAFFIC_CONTROL_METHOD='simulation')
+class VoucherTests(TestCase):
+    MAC = '02:00:7f:00:00:01'  # dev_mac('127.0.0.1')
+
+    def setUp(self):
+        self.plan = PaymentPlan.objects.create(name='1 Hour', price='2.00', duration_hours=1)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def redeem(self, code):
+        with mock.patch('billing_app.views.provisioning_queue', ProvisioningQueue(run_async=False)):
+            return self.client.post('/redeem-voucher/', json.dumps({'code': code}), content_type='application/json')
+
+    def test_generated_in_chunks_with_only_hashes_stored(self):
+        seed = 'a' * 32
+        other = VoucherBatch.objects.create(plan=self.plan, seed='b' * 32, code_length=10)
+        # A code from another batch that serial 3 would collide with
+        Voucher.objects.create(batch=other, serial=0, code_hash=lookup_hash(derive_code(seed, 3, 10)))
+
+        with mock.patch('billing_app.vouchers.secrets.token_hex', return_value=seed):
+            batch = generate_batch(self.plan, 10, 'cafe', chunk_size=4)
+
+        self.assertEqual(batch.count, 10)
+        serials = list(batch.vouchers.order_by('serial').values_list('serial', flat=True))
+        self.assertEqual(serials, [0, 1, 2, 4, 5, 6, 7, 8, 9, 10])
+
+        lines = ''.join(csv_export(batch)).splitlines()
+        self.assertEqual(len(lines), 11)
+        code = lines[1].split(',')[2]
+        self.assertRegex(code, r'^[2-9A-HJ-NP-Z]{5}-[2-9A-HJ-NP-Z]{5}$')
+        self.assertTrue(batch.vouchers.filter(serial=0, code_hash=lookup_hash(code.replace('-', ''))).exists())
+        self.assertIn(code, ''.join(sheet_export(batch)))
+
+    def test_redemption_activates_session_once(self):
+        batch = generate_batch(self.plan, 3)
+        code = ''.join(csv_export(batch)).splitlines()[1].split(',')[2]
+
+        data = self.redeem(f' {code.lower()} ').json()
+        self.assertTrue(data['success'])
+        session = WifiSession.objects.get(mac_address=self.MAC)
+        self.assertTrue(session.is_paid and session.is_active)
+        self.assertEqual(self.client.get(data['status_url']).json(), {'status': 'live', 'live': True})
+        payment = Payment.objects.get(reference=session.payment_id)
+        self.assertEqual((payment.plan, payment.amount), (self.plan, Decimal('2.00')))
+        voucher = Voucher.objects.get(redeemed_at__isnull=False)
+        self.assertEqual((voucher.redeemed_mac, payment.reference), (self.MAC, f'vch_{voucher.pk}'))
+
+        self.assertEqual(self.redeem(code).json(), {'success': False, 'error': 'This voucher has already been used'})
+        # A reprinted sheet leaves the used voucher out
+        self.assertEqual(''.join(sheet_export(batch)).count('class="card"'), 2)
+
+    def test_losing_a_race_records_nothing(self):
+        voucher = Voucher.objects.get(batch=generate_batch(self.plan, 1))
+        session = WifiSession.objects.create(mac_address=self.MAC, ip_address='127.0.0.1')
+
+        self.assertTrue(claim_voucher(voucher, '02:00:00:00:00:09'))
+        self.assertIsNone(record_purchase(session, self.plan, claim=lambda: claim_voucher(voucher, self.MAC)))
+        self.assertFalse(Payment.objects.exists())
+        session.refresh_from_db()
+        self.assertFalse(session.is_paid)
+
+    @override_settings(VOUCHER_MAX_ATTEMPTS=3)
+    def test_guessing_is_throttled(self):
+        for code in ['22222-22222', 'not a code', '33333-33333']:
+            self.assertEqual(self.redeem(code).status_code, 200)
+        response = self.redeem('44444-44444')
+        self.assertEqual(response.status_code, 429)
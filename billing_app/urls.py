@@ -1,10 +1,17 @@
 from django.urls import path
 from . import views
+from .probes import PROBES
 
 urlpatterns = [
     path('', views.portal_login, name='portal_login'),
     path('select-plan/<int:plan_id>/', views.select_plan, name='select_plan'),
     path('payment/', views.payment_page, name='payment_page'),
     path('process-payment/', views.process_payment, name='process_payment'),
+    path('redeem-voucher/', views.redeem_voucher, name='redeem_voucher'),
+    path('provisioning-status/<uuid:ticket>/', views.provisioning_status, name='provisioning_status'),
     path('internet-access/', views.internet_access, name='internet_access'),
+    path('metrics', views.metrics, name='metrics'),
+] + [
+    # Normally answered by CaptivePortalProbeMiddleware before URL resolution
+    path(probe_path.lstrip('/'), views.connectivity_probe) for probe_path in PROBES
 ]
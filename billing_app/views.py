@@ -7,52 +7,96 @@ import json
 import subprocess
 import re
 from .models import WifiSession, PaymentPlan
-from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
+from django.http import Http404, JsonResponse, HttpResponse
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 from django.conf import settings
+from django.db import OperationalError, transaction
 from datetime import timedelta
+import hmac
 import json
+import logging
 import subprocess
 import re
-import requests
-import platform
-from .models import WifiSession, PaymentPlan
+import time
+import uuid
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from .models import Payment, WifiSession, PaymentPlan
+from .authcache import authorization_cache
+from .expiry import notify_expiry_scheduler
+from .gateways import gateway_events
+from .firewall import BACKENDS as FIREWALL_BACKENDS, IptablesChain, get_firewall_backend
+from .firewallhelper import METHODS as HELPER_METHODS, firewall_helper
+from .metrics import mac_resolution_seconds, registry, traffic_control_failures, traffic_control_seconds
+from .leases import lease_index
+from .ledger import record_payment
+from .macaddr import dev_mac, normalize_mac
+from .metering import usage_since
+from .neighbors import neighbor_table
+from .plans import plan_catalog
+from .probes import PROBES
+from .provisioning import provisioning_queue
+from .sessionwriter import unpaid_session_writer
+from .vouchers import afailed_attempt, afind_voucher, athrottled, claim_voucher, redemption_problem
+from .router import RouterUnavailable, get_router_client
+
+logger = logging.getLogger(__name__)
 
 
 def get_client_mac(request):
-    """Get MAC address from ARP table using IP - works in both environments"""
-    client_ip = get_client_ip(request)
-    
+    """Get MAC address for the client IP - resolved at most once per request"""
+    try:
+        return request._client_mac
+    except AttributeError:
+        pass
+
+    client_mac = resolve_client_mac(get_client_ip(request))
+    request._client_mac = client_mac
+    return client_mac
+
+
+async def aget_client_mac(request):
+    """get_client_mac for async views - the neighbor table reloads on the event loop"""
+    try:
+        return request._client_mac
+    except AttributeError:
+        pass
+
+    client_mac = await aresolve_client_mac(get_client_ip(request))
+    request._client_mac = client_mac
+    return client_mac
+
+
+def resolve_client_mac(client_ip):
+    """Look the IP up in the DHCP lease index, then the cached neighbor table"""
     # Development fallback - use a mock MAC for testing
     if settings.ENVIRONMENT == 'development' and client_ip in ['127.0.0.1', '::1']:
-        return f"dev:mac:{client_ip.replace('.', ':')[:17]}"
-    
-    try:
-        # Try different ARP commands based on OS
-        if platform.system() == 'Darwin':  # macOS
-            arp_output = subprocess.check_output(['arp', '-n', client_ip]).decode('utf-8')
-        else:  # Linux
-            arp_output = subprocess.check_output(['arp', '-n', client_ip]).decode('utf-8')
-        
-        mac_match = re.search(r'([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}', arp_output)
-        if mac_match:
-            return mac_match.group(0).lower()
-    except subprocess.CalledProcessError:
-        # Fallback: try alternative methods
-        try:
-            # Try ip neighbor (newer Linux systems)
-            ip_output = subprocess.check_output(['ip', 'neighbor', 'show', client_ip]).decode('utf-8')
-            mac_match = re.search(r'([0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}', ip_output)
-            if mac_match:
-                return mac_match.group(0).lower()
-        except:
-            pass
-    except Exception as e:
-        print(f"Error getting MAC address: {e}")
-    
-    return None
+        return dev_mac(client_ip)
+
+    start = time.perf_counter()
+    # The DHCP lease index (if configured) knows devices before the kernel does
+    client_mac = normalize_mac(lease_index.lookup(client_ip) or neighbor_table.lookup(client_ip))
+    observe_mac_resolution(start, client_ip, client_mac)
+    return client_mac
+
+
+async def aresolve_client_mac(client_ip):
+    if settings.ENVIRONMENT == 'development' and client_ip in ['127.0.0.1', '::1']:
+        return dev_mac(client_ip)
+
+    start = time.perf_counter()
+    client_mac = normalize_mac(lease_index.lookup(client_ip) or await neighbor_table.alookup(client_ip))
+    observe_mac_resolution(start, client_ip, client_mac)
+    return client_mac
+
+
+def observe_mac_resolution(start, client_ip, client_mac):
+    mac_resolution_seconds.observe(time.perf_counter() - start, 'resolved' if client_mac else 'unresolved')
+    if not client_mac:
+        logger.info(f"No neighbor entry for {client_ip} - cannot identify device")
 
 
 def get_client_ip(request):
@@ -73,14 +117,14 @@ def get_client_ip(request):
     return ip
 
 
-def portal_login(request):
+async def portal_login(request):
     """Main captive portal page with environment awareness"""
     client_ip = get_client_ip(request)
-    client_mac = get_client_mac(request)
+    client_mac = await aget_client_mac(request)
     
     # Development mode - allow simulation
     if settings.ENVIRONMENT == 'development' and not client_mac:
-        client_mac = f"dev:mac:{hash(client_ip) % 1000000:06d}"
+        client_mac = dev_mac(client_ip)
     
     if not client_mac:
         return render(request, 'error.html', {
@@ -93,32 +137,58 @@ def portal_login(request):
     
     # Check if session exists and is paid
     try:
-        session = WifiSession.objects.get(mac_address=client_mac)
+        session = await WifiSession.objects.only('is_paid', 'expires_at').aget(mac_address=client_mac)
         if session.is_paid and session.expires_at and session.expires_at > timezone.now():
             return redirect('internet_access')
     except WifiSession.DoesNotExist:
-        session = WifiSession.objects.create(
-            mac_address=client_mac,
-            ip_address=client_ip
-        )
+        if getattr(settings, 'UNPAID_SESSION_BATCHING', False):
+            # Inserted with other new devices in one batch - see sessionwriter.py
+            session = unpaid_session_writer.add(client_mac, client_ip)
+        else:
+            session = await WifiSession.objects.acreate(
+                mac_address=client_mac,
+                ip_address=client_ip
+            )
     
-    plans = PaymentPlan.objects.filter(is_active=True)
+    # Plans and their rendered cards come from the versioned catalog - no query
+    catalog = await plan_catalog.aget()
     
     return render(request, 'login.html', {
         'session': session,
-        'plans': plans,
+        'plans': catalog.active,
+        'plan_cards': catalog.plan_cards,
         'client_ip': client_ip,
         'client_mac': client_mac,
         'environment': settings.ENVIRONMENT
     })
 
 
-def allow_internet_access(mac_address, ip_address):
+def timed_traffic_control(action, method, call):
+    """Run one grant/revoke, recording its latency and failure"""
+    with traffic_control_seconds.time(method, action):
+        ok = call()
+    if not ok:
+        traffic_control_failures.inc(method, action)
+    return ok
+
+
+def allow_internet_access(mac_address, ip_address, expires_at=None):
     """Allow internet access with multiple methods"""
     method = getattr(settings, 'TRAFFIC_CONTROL_METHOD', 'simulation')
-    
-    if method == 'iptables':
+    return timed_traffic_control(
+        'grant', method, lambda: _allow_internet_access(method, mac_address, ip_address, expires_at)
+    )
+
+
+def _allow_internet_access(method, mac_address, ip_address, expires_at):
+    if method in HELPER_METHODS and firewall_helper.enabled:
+        # No sudo fork - the helper coalesces concurrent grants into one commit
+        return firewall_helper.grant([(mac_address, ip_address, expires_at)])[0]
+    elif method == 'iptables':
         return allow_access_iptables(mac_address, ip_address)
+    elif method in FIREWALL_BACKENDS:
+        # Kernel sets - the element times out at expires_at on its own
+        return get_firewall_backend(method).grant([(mac_address, ip_address, expires_at)])
     elif method == 'router_api':
         return allow_access_router_api(mac_address, ip_address)
     else:
@@ -127,6 +197,14 @@ def allow_internet_access(mac_address, ip_address):
         return True
 
 
+def insert_iptables_rule(*match):
+    """-I an ACCEPT rule into CAPTIVE_PORTAL unless it is already there (-C)"""
+    rule = ['CAPTIVE_PORTAL', *match, '-j', 'ACCEPT']
+    exists = subprocess.run(['sudo', 'iptables', '-C', *rule], check=False, stderr=subprocess.DEVNULL)
+    if exists.returncode != 0:
+        subprocess.run(['sudo', 'iptables', '-I', *rule], check=True)
+
+
 def allow_access_iptables(mac_address, ip_address):
     """Allow access using iptables (Linux systems)"""
     try:
@@ -135,66 +213,43 @@ def allow_access_iptables(mac_address, ip_address):
             'sudo', 'iptables', '-N', 'CAPTIVE_PORTAL'
         ], check=False)  # Don't fail if chain exists
         
-        # Add rule to allow this MAC
-        subprocess.run([
-            'sudo', 'iptables', '-I', 'CAPTIVE_PORTAL',
-            '-m', 'mac', '--mac-source', mac_address,
-            '-j', 'ACCEPT'
-        ], check=True)
+        # Add rule to allow this MAC - once: a repeated grant (re-queued job, re-published
+        # event) must not stack copies that a single -D on revoke would leave behind
+        insert_iptables_rule('-m', 'mac', '--mac-source', mac_address)
         
-        # Also allow by IP as backup
-        subprocess.run([
-            'sudo', 'iptables', '-I', 'CAPTIVE_PORTAL',
-            '-s', ip_address,
-            '-j', 'ACCEPT'
-        ], check=True)
+        # Also allow by IP as backup (not for grants relayed from another gateway)
+        if ip_address:
+            insert_iptables_rule('-s', ip_address)
         
         return True
     except subprocess.CalledProcessError as e:
-        print(f"Failed to allow access via iptables for {mac_address}: {e}")
+        logger.error(f"Failed to allow access via iptables for {mac_address}: {e}")
         return False
 
 
 def allow_access_router_api(mac_address, ip_address):
     """Allow access via router API (for mobile hotspot)"""
     try:
-        # This depends on your router's API
-        # Example for common router APIs:
-        
-        # Option 1: Add to allowed MAC list
-        api_url = f"http://{settings.ROUTER_IP}/api/whitelist/add"
-        payload = {
-            'mac': mac_address,
-            'description': f'Paid user {mac_address}'
-        }
-        
-        response = requests.post(
-            api_url,
-            json=payload,
-            auth=(settings.ROUTER_USERNAME, settings.ROUTER_PASSWORD),
-            timeout=5
-        )
-        
-        if response.status_code == 200:
-            return True
-            
-        # Option 2: Disable firewall for this device
-        # api_url = f"http://{settings.ROUTER_IP}/api/firewall/allow"
-        # ... similar implementation
-        
-        return False
-        
-    except requests.RequestException as e:
-        print(f"Failed to allow access via router API for {mac_address}: {e}")
+        # Pooled keep-alive session with retries - see billing_app/router.py
+        return get_router_client().whitelist_add([mac_address])
+    except RouterUnavailable as e:
+        logger.error(f"Failed to allow access via router API for {mac_address}: {e}")
         return False
 
 
 def block_internet_access(mac_address, ip_address=None):
     """Block internet access"""
     method = getattr(settings, 'TRAFFIC_CONTROL_METHOD', 'simulation')
-    
-    if method == 'iptables':
+    return timed_traffic_control('revoke', method, lambda: _block_internet_access(method, mac_address, ip_address))
+
+
+def _block_internet_access(method, mac_address, ip_address):
+    if method in HELPER_METHODS and firewall_helper.enabled:
+        return firewall_helper.revoke([(mac_address, ip_address)])[0]
+    elif method == 'iptables':
         return block_access_iptables(mac_address, ip_address)
+    elif method in FIREWALL_BACKENDS:
+        return get_firewall_backend(method).revoke([(mac_address, ip_address)])
     elif method == 'router_api':
         return block_access_router_api(mac_address)
     else:
@@ -202,6 +257,43 @@ def block_internet_access(mac_address, ip_address=None):
         return True
 
 
+def block_internet_access_bulk(entries, max_workers=8):
+    """Block many (mac_address, ip_address) pairs - one firewall batch where the method allows it"""
+    entries = list(entries)
+    if not entries:
+        return []
+    method = getattr(settings, 'TRAFFIC_CONTROL_METHOD', 'simulation')
+
+    if method in HELPER_METHODS and firewall_helper.enabled:
+        with traffic_control_seconds.time(method, 'revoke_batch'):
+            results = firewall_helper.revoke(entries)
+        if not all(results):
+            traffic_control_failures.inc(method, 'revoke_batch')
+        return results
+    if method in FIREWALL_BACKENDS:
+        ok = timed_traffic_control('revoke_batch', method, lambda: get_firewall_backend(method).revoke(entries))
+        return [ok] * len(entries)
+    if method == 'iptables':
+        try:
+            with traffic_control_seconds.time(method, 'revoke_batch'):
+                IptablesChain().revoke(entries)
+            return [True] * len(entries)
+        except (subprocess.CalledProcessError, OSError):
+            pass  # Some rule was already gone - fall back to one device at a time
+    if method == 'router_api' and get_router_client().batch_api:
+        try:
+            ok = timed_traffic_control(
+                'revoke_batch', method, lambda: get_router_client().whitelist_remove(mac for mac, _ip in entries)
+            )
+        except RouterUnavailable:
+            traffic_control_failures.inc(method, 'revoke_batch')
+            ok = False
+        return [ok] * len(entries)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda entry: block_internet_access(*entry), entries))
+
+
 def block_access_iptables(mac_address, ip_address):
     """Block access using iptables"""
     try:
@@ -212,11 +304,12 @@ def block_access_iptables(mac_address, ip_address):
         ], check=True)
         
         if ip_address:
+            # Not every gateway has the IP rule (remote grants are MAC-only)
             subprocess.run([
                 'sudo', 'iptables', '-D', 'CAPTIVE_PORTAL',
                 '-s', ip_address,
                 '-j', 'ACCEPT'
-            ], check=True)
+            ], check=False, stderr=subprocess.DEVNULL)
         
         return True
     except subprocess.CalledProcessError:
@@ -226,52 +319,100 @@ def block_access_iptables(mac_address, ip_address):
 def block_access_router_api(mac_address):
     """Block access via router API"""
     try:
-        api_url = f"http://{settings.ROUTER_IP}/api/whitelist/remove"
-        payload = {'mac': mac_address}
-        
-        response = requests.post(
-            api_url,
-            json=payload,
-            auth=(settings.ROUTER_USERNAME, settings.ROUTER_PASSWORD),
-            timeout=5
-        )
-        
-        return response.status_code == 200
-    except requests.RequestException:
+        return get_router_client().whitelist_remove([mac_address])
+    except RouterUnavailable:
         return False
 
 
 
-def select_plan(request, plan_id):
+async def select_plan(request, plan_id):
     """Handle plan selection and redirect to payment"""
-    client_mac = get_client_mac(request)
+    client_mac = await aget_client_mac(request)
     if not client_mac:
         return JsonResponse({'error': 'Unable to identify device'}, status=400)
     
-    plan = get_object_or_404(PaymentPlan, id=plan_id)
-    session = WifiSession.objects.get(mac_address=client_mac)
+    plan = (await plan_catalog.aget()).plan_or_404(plan_id)
+    try:
+        session_id = await WifiSession.objects.values_list('session_id', flat=True).aget(mac_address=client_mac)
+    except WifiSession.DoesNotExist:
+        # portal_login's row is still queued in the unpaid-session batch
+        session, _ = await WifiSession.objects.aget_or_create(
+            mac_address=client_mac, defaults={'ip_address': get_client_ip(request)}
+        )
+        session_id = session.session_id
     
     # Store selected plan in session
-    request.session['selected_plan_id'] = plan.id
-    request.session['wifi_session_id'] = str(session.session_id)
+    await request.session.aset('selected_plan_id', plan.id)
+    await request.session.aset('wifi_session_id', str(session_id))
     
     return redirect('payment_page')
 
-def payment_page(request):
+async def payment_page(request):
     """Payment processing page"""
-    plan_id = request.session.get('selected_plan_id')
+    plan_id = await request.session.aget('selected_plan_id')
     if not plan_id:
         return redirect('portal_login')
     
-    plan = get_object_or_404(PaymentPlan, id=plan_id)
+    plan = (await plan_catalog.aget()).plan_or_404(plan_id)
     
     return render(request, 'payment.html', {
         'plan': plan,
         'stripe_public_key': settings.STRIPE_PUBLIC_KEY
     })
 
+def record_purchase(session, plan, retries=3, reference=None, claim=None):
+    """Append the purchase to the ledger and mark the session paid, in one transaction
+
+    `claim` runs first in that transaction (a voucher's conditional update); when it
+    returns False nothing is recorded and None is returned.
+    """
+    reference = reference or f"pay_{uuid.uuid4().hex}"
+    for attempt in range(retries):
+        try:
+            with transaction.atomic():
+                if claim is not None and not claim():
+                    return None
+                payment = record_payment(plan, session.mac_address, session=session, reference=reference)
+                # The session keeps the latest purchase; the ledger keeps all of them
+                session.is_paid = True
+                session.payment_amount = payment.amount
+                session.payment_id = payment.reference
+                session.expires_at = payment.created_at + timedelta(hours=plan.duration_hours)
+                session.is_active = True
+                session.access_status = 'pending'
+                session.access_error = ''
+                session.save(update_fields=[
+                    'is_paid', 'payment_amount', 'payment_id', 'expires_at', 'is_active',
+                    'access_status', 'access_error',
+                ])
+            return session
+        except OperationalError as e:
+            # "database is locked" - the whole purchase rolled back, so it can be replayed
+            if attempt + 1 == retries:
+                raise
+            logger.warning(f"Recording payment {reference} failed ({e}), attempt {attempt + 1}")
+            time.sleep(0.05 * 2 ** attempt)
+
+async def activate_access(client_mac, session):
+    """After a purchase is recorded: propagate it and queue the grant; the page polls the ticket"""
+    authorization_cache.invalidate(client_mac)
+    notify_expiry_scheduler(client_mac, session.expires_at)
+    if gateway_events.enabled:
+        # The other gateways let the device roam onto them
+        await sync_to_async(gateway_events.grant)(client_mac, session.ip_address, session.expires_at)
+
+    # Allow internet access - queued, the page polls provisioning_status
+    ticket = await provisioning_queue.asubmit(session)
+
+    return JsonResponse({
+        'success': True,
+        'ticket': ticket,
+        'status_url': reverse('provisioning_status', args=[ticket]),
+        'redirect': '/internet-access/',
+    })
+
 @csrf_exempt
-def process_payment(request):
+async def process_payment(request):
     """Process payment (simplified version - integrate with your payment gateway)"""
     if request.method == 'POST':
         data = json.loads(request.body)
@@ -281,65 +422,94 @@ def process_payment(request):
         payment_successful = True  # Replace with actual payment processing
         
         if payment_successful:
-            client_mac = get_client_mac(request)
-            plan_id = request.session.get('selected_plan_id')
+            client_mac = await aget_client_mac(request)
+            plan_id = await request.session.aget('selected_plan_id')
             
             if client_mac and plan_id:
-                plan = PaymentPlan.objects.get(id=plan_id)
-                session = WifiSession.objects.get(mac_address=client_mac)
-                
-                # Update session with payment info
-                session.is_paid = True
-                session.payment_amount = plan.price
-                session.payment_id = f"pay_{session.session_id}"
-                session.expires_at = timezone.now() + timedelta(hours=plan.duration_hours)
-                session.is_active = True
-                session.save()
-                
-                # Allow internet access
-                allow_internet_access(client_mac, session.ip_address)
-                
-                return JsonResponse({'success': True, 'redirect': '/internet-access/'})
+                plan = (await plan_catalog.aget()).plan_or_404(plan_id)
+                session = await WifiSession.objects.aget(mac_address=client_mac)
+                session = await sync_to_async(record_purchase)(session, plan)
+                return await activate_access(client_mac, session)
         
         return JsonResponse({'success': False, 'error': 'Payment failed'})
     
     return JsonResponse({'error': 'Invalid request'}, status=400)
 
-def internet_access(request):
+async def redeem_voucher(request):
+    """Redeem a prepaid voucher code - activates the session like a payment (see vouchers.py)"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+    try:
+        code = json.loads(request.body).get('code', '')
+    except (ValueError, AttributeError):
+        return JsonResponse({'error': 'Invalid request'}, status=400)
+
+    client_ip = get_client_ip(request)
+    client_mac = await aget_client_mac(request)
+    if settings.ENVIRONMENT == 'development' and not client_mac:
+        client_mac = dev_mac(client_ip)
+    if not client_mac:
+        return JsonResponse({'success': False, 'error': 'Unable to identify device'})
+    if await athrottled(client_mac):
+        return JsonResponse({'success': False, 'error': 'Too many attempts - please try again later'}, status=429)
+
+    voucher = await afind_voucher(code)
+    problem = redemption_problem(voucher)
+    if problem is None:
+        session, _ = await WifiSession.objects.aget_or_create(
+            mac_address=client_mac, defaults={'ip_address': client_ip}
+        )
+        session = await sync_to_async(record_purchase)(
+            session, voucher.batch.plan, reference=f"vch_{voucher.pk}",
+            claim=lambda: claim_voucher(voucher, client_mac),
+        )
+        if session is not None:
+            return await activate_access(client_mac, session)
+        problem = 'This voucher has already been used'  # redeemed concurrently
+
+    await afailed_attempt(client_mac)
+    return JsonResponse({'success': False, 'error': problem})
+
+async def provisioning_status(request, ticket):
+    """Whether access for a paid session is live yet (polled by payment.html)"""
+    session = await aget_object_or_404(WifiSession.objects.only('access_status'), session_id=ticket)
+    return JsonResponse({
+        'status': session.access_status or 'pending',
+        'live': session.access_status == 'live',
+    })
+
+async def internet_access(request):
     """Success page after payment"""
-    client_mac = get_client_mac(request)
+    client_mac = await aget_client_mac(request)
     try:
-        session = WifiSession.objects.get(mac_address=client_mac, is_paid=True)
+        session = await WifiSession.objects.only('expires_at', 'payment_amount', 'payment_id').aget(
+            mac_address=client_mac, is_paid=True
+        )
+        paid_at = await Payment.objects.filter(reference=session.payment_id).values_list('created_at', flat=True).afirst()
+        # Upload only - the grant rules match the source address. None until run_usage_meter has seen traffic
+        usage = await sync_to_async(usage_since)(client_mac, paid_at) if paid_at else None
         return render(request, 'success.html', {
             'session': session,
-            'expires_at': session.expires_at
+            'expires_at': session.expires_at,
+            'bytes_sent': usage[0] if usage else None,
         })
     except WifiSession.DoesNotExist:
         return redirect('portal_login')
 
-def allow_internet_access(mac_address, ip_address):
-    """Add firewall rule to allow internet access"""
-    try:
-        # Example iptables command - adjust based on your setup
-        subprocess.run([
-            'sudo', 'iptables', '-I', 'FORWARD', 
-            '-m', 'mac', '--mac-source', mac_address,
-            '-j', 'ACCEPT'
-        ], check=True)
-        
-        # Alternative: Add to router's allowed MAC list
-        # This would depend on your router's API
-        
-    except subprocess.CalledProcessError:
-        print(f"Failed to allow access for {mac_address}")
+async def connectivity_probe(request):
+    """OS connectivity check from a device CaptivePortalMiddleware let through"""
+    return PROBES[request.path_info].success()
 
-def block_internet_access(mac_address):
-    """Remove firewall rule to block internet access"""
-    try:
-        subprocess.run([
-            'sudo', 'iptables', '-D', 'FORWARD',
-            '-m', 'mac', '--mac-source', mac_address,
-            '-j', 'ACCEPT'
-        ], check=True)
-    except subprocess.CalledProcessError:
-        print(f"Failed to block access for {mac_address}")
\ No newline at end of file
+async def metrics(request):
+    """Prometheus text exposition of the portal's metrics"""
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', None)
+    # The socket peer, not get_client_ip - any client can send X-Forwarded-For / X-Real-IP
+    if allowed is not None and request.META.get('REMOTE_ADDR') not in allowed:
+        raise Http404
+    # Behind the README's nginx every request comes from 127.0.0.1 - the token is what gates it there
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        raise Http404
+    # Gauges read the database
+    body = await sync_to_async(registry.render)(getattr(settings, 'METRICS_DIR', None))
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,244 @@
+"""
+Prepaid vouchers: printed codes sold over the counter, redeemed at the portal.
+
+`manage.py generate_vouchers` creates a VoucherBatch for a PaymentPlan and
+inserts its Voucher rows in chunked bulk_create batches. Each chunk is its
+own transaction, so portal writes keep getting through on SQLite while
+hundreds of thousands of codes go in.
+
+The database never holds a code. A code is derived from the batch's random
+seed and the voucher's serial with an HMAC keyed by VOUCHER_SECRET, and
+the row stores only a second keyed hash of it. That hash carries a unique
+index, and a collision just moves on to the next serial. A leaked database
+therefore leaks no usable codes, and exports regenerate the codes from
+(seed, serial) as they stream. Changing VOUCHER_SECRET voids every code
+already printed.
+
+Redemption (views.redeem_voucher) looks the typed code up with a single
+query on the unique index. It then claims the voucher with an UPDATE ...
+WHERE redeemed_at IS NULL, in the same transaction that records the
+purchase and activates the WifiSession (views.record_purchase). Of two
+concurrent redemptions, only one updates the row, and the other records
+nothing. Failed attempts are counted per device, VOUCHER_MAX_ATTEMPTS per
+VOUCHER_ATTEMPT_WINDOW, to make guessing codes impractical.
+"""
+import csv
+import functools
+import hashlib
+import hmac
+import logging
+import re
+import secrets
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.html import format_html
+
+from .models import Voucher, VoucherBatch
+
+logger = logging.getLogger(__name__)
+
+# No 0/O or 1/I - codes are read off paper
+ALPHABET = '23456789ABCDEFGHJKLMNPQRSTUVWXYZ'
+CODE_RE = re.compile(f'[{ALPHABET}]{{6,32}}')
+GROUP = 5  # printed as XXXXX-XXXXX
+EXPORT_CHUNK = 2000
+
+
+def voucher_secret():
+    return getattr(settings, 'VOUCHER_SECRET', None) or settings.SECRET_KEY
+
+
+@functools.lru_cache(maxsize=8)
+def _keyed(purpose, secret):
+    key = hashlib.sha256(f'billing_app.vouchers.{purpose}{secret}'.encode()).digest()
+    return hmac.new(key, digestmod=hashlib.sha256)
+
+
+def _hmac(purpose, message):
+    mac = _keyed(purpose, voucher_secret()).copy()
+    mac.update(message.encode())
+    return mac
+
+
+def derive_code(seed, serial, length):
+    """The code for a batch serial - the same every time for the same secret"""
+    value = int.from_bytes(_hmac('code', f'{seed}:{serial}').digest(), 'big')
+    return ''.join(ALPHABET[value >> (5 * i) & 31] for i in range(length))
+
+
+def lookup_hash(code):
+    """What Voucher.code_hash stores for a normalized code"""
+    return _hmac('lookup', code).hexdigest()
+
+
+def format_code(code):
+    return '-'.join(code[i:i + GROUP] for i in range(0, len(code), GROUP))
+
+
+def normalize_code(text):
+    """Typed code without separators, upper-cased; None when it can't be a code (no query needed)"""
+    code = re.sub(r'[\s-]', '', str(text or '')).upper()
+    return code if CODE_RE.fullmatch(code) else None
+
+
+def generate_batch(plan, count, label='', expires_at=None, chunk_size=None, progress=None):
+    """Create a VoucherBatch of `count` unique codes for `plan`, one chunk per transaction"""
+    length = getattr(settings, 'VOUCHER_CODE_LENGTH', 10)
+    chunk_size = chunk_size or getattr(settings, 'VOUCHER_CHUNK_SIZE', 5000)
+    batch = VoucherBatch.objects.create(
+        plan=plan, label=label, seed=secrets.token_hex(16), code_length=length, expires_at=expires_at,
+    )
+    created = serial = collisions = 0
+    while created < count:
+        start = serial
+        candidates = {}
+        for serial in range(start, start + min(chunk_size, count - created)):
+            candidates.setdefault(lookup_hash(derive_code(batch.seed, serial, length)), serial)
+        serial += 1
+        try:
+            with transaction.atomic():
+                taken = set(Voucher.objects.filter(code_hash__in=list(candidates)).values_list('code_hash', flat=True))
+                Voucher.objects.bulk_create(
+                    [Voucher(batch=batch, serial=s, code_hash=h) for h, s in candidates.items() if h not in taken],
+                    batch_size=chunk_size,
+                )
+        except IntegrityError:
+            # Another batch inserted a colliding hash after the check - redo the chunk
+            serial = start
+            continue
+        collisions += serial - start - len(candidates) + len(taken)
+        created += len(candidates) - len(taken)
+        if progress:
+            progress(created, count)
+    batch.count = created
+    batch.save(update_fields=['count'])
+    if collisions:
+        logger.info(f'Voucher batch {batch.pk}: skipped {collisions} colliding serials')
+    return batch
+
+
+def redemption_problem(voucher, now=None):
+    """Why `voucher` can't be redeemed, for the customer - None when it can"""
+    if voucher is None:
+        return 'Unknown voucher code'
+    if voucher.redeemed_at is not None:
+        return 'This voucher has already been used'
+    batch = voucher.batch
+    if not batch.is_active:
+        return 'This voucher is no longer valid'
+    if batch.expires_at and batch.expires_at <= (now or timezone.now()):
+        return 'This voucher has expired'
+    return None
+
+
+async def afind_voucher(code):
+    """The voucher (with batch and plan) for a typed code - one unique-index lookup"""
+    normalized = normalize_code(code)
+    if normalized is None:
+        return None
+    try:
+        return await Voucher.objects.select_related('batch__plan').aget(code_hash=lookup_hash(normalized))
+    except Voucher.DoesNotExist:
+        return None
+
+
+def claim_voucher(voucher, mac_address, at=None):
+    """Mark `voucher` redeemed unless someone got there first - call inside the purchase's transaction"""
+    return Voucher.objects.filter(pk=voucher.pk, redeemed_at__isnull=True).update(
+        redeemed_at=at or timezone.now(), redeemed_mac=mac_address,
+    ) == 1
+
+
+def _attempts_key(mac_address):
+    return f'voucher-attempts:{mac_address}'
+
+
+async def athrottled(mac_address):
+    """Whether a device used up its failed attempts for this window"""
+    return await cache.aget(_attempts_key(mac_address), 0) >= getattr(settings, 'VOUCHER_MAX_ATTEMPTS', 10)
+
+
+async def afailed_attempt(mac_address):
+    key = _attempts_key(mac_address)
+    if not await cache.aadd(key, 1, getattr(settings, 'VOUCHER_ATTEMPT_WINDOW', 900)):
+        try:
+            await cache.aincr(key)
+        except ValueError:  # expired in between
+            await cache.aadd(key, 1, getattr(settings, 'VOUCHER_ATTEMPT_WINDOW', 900))
+
+
+def export_rows(batch, unused_only=False):
+    """(serial, printed code, redeemed_at) in serial order, EXPORT_CHUNK rows in memory at a time"""
+    rows = Voucher.objects.filter(batch=batch)
+    if unused_only:
+        rows = rows.filter(redeemed_at__isnull=True)
+    for serial, redeemed_at in rows.order_by('serial').values_list('serial', 'redeemed_at').iterator(EXPORT_CHUNK):
+        yield serial, format_code(derive_code(batch.seed, serial, batch.code_length)), redeemed_at
+
+
+def _buffered(parts, size=EXPORT_CHUNK):
+    """Join small strings into fewer, larger chunks for a streamed response"""
+    buffer = []
+    for part in parts:
+        buffer.append(part)
+        if len(buffer) >= size:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+class _Echo:
+    """csv.writer target that hands each formatted row back instead of storing it"""
+
+    def write(self, value):
+        return value
+
+
+def csv_export(batch):
+    """The batch as CSV lines, for a StreamingHttpResponse or a file"""
+    writer = csv.writer(_Echo())
+    plan = batch.plan
+
+    def lines():
+        yield writer.writerow(['batch', 'serial', 'code', 'plan', 'duration_hours', 'price', 'expires_at', 'redeemed_at'])
+        expires_at = batch.expires_at.isoformat() if batch.expires_at else ''
+        for serial, code, redeemed_at in export_rows(batch):
+            yield writer.writerow([
+                batch.pk, serial, code, plan.name, plan.duration_hours, plan.price, expires_at,
+                redeemed_at.isoformat() if redeemed_at else '',
+            ])
+
+    return _buffered(lines())
+
+
+SHEET_HEAD = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Vouchers - {}</title>
+<style>
+@page {{ margin: 10mm; }}
+body {{ margin: 0; font-family: sans-serif; }}
+.sheet {{ display: grid; grid-template-columns: repeat(3, 1fr); gap: 4mm; }}
+.card {{ border: 1px dashed #888; padding: 4mm; text-align: center; break-inside: avoid; }}
+.code {{ font: bold 15pt monospace; letter-spacing: 1px; margin: 2mm 0; }}
+.meta {{ font-size: 8pt; color: #555; }}
+</style></head><body><div class="sheet">
+"""
+SHEET_CARD = ('<div class="card"><div>{}</div><div class="code">{}</div>'
+              '<div class="meta">{} hour(s) - ${}{}</div><div class="meta">#{}-{}</div></div>\n')
+
+
+def sheet_export(batch):
+    """Printable cut-out cards for the batch's unused codes, as streamed HTML"""
+    plan = batch.plan
+    until = f' - use by {timezone.localtime(batch.expires_at):%Y-%m-%d}' if batch.expires_at else ''
+
+    def parts():
+        yield format_html(SHEET_HEAD, batch)
+        for serial, code, _redeemed_at in export_rows(batch, unused_only=True):
+            yield format_html(SHEET_CARD, plan.name, code, plan.duration_hours, plan.price, until, batch.pk, serial)
+        yield '</div></body></html>\n'
+
+    return _buffered(parts())
@@ -56,6 +56,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # The billing_app middleware runs first and natively async, so probes from
+    # unpaid devices are redirected before the sync-only middleware below runs
+    # (each of those costs a thread hop under ASGI). OS connectivity probes are
+    # answered from memory before any of it
+    'billing_app.middleware.CaptivePortalProbeMiddleware',
+    'billing_app.middleware.RequestMetricsMiddleware',
+    'billing_app.middleware.CaptivePortalMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -63,7 +70,6 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'billing_app.middleware.CaptivePortalMiddleware',
 ]
 
 ROOT_URLCONF = 'wifi_billing_system.urls'
@@ -93,9 +99,63 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # On disk, so threaded tests wait on SQLite's busy timeout like production
+        # instead of failing on the shared in-memory cache's table locks
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# Production SQLite profile: readers never block the writer (WAL), writers wait
+# for the lock instead of failing with "database is locked", and connections
+# (with their page cache and mmap) outlive a single request
+SQLITE_PRODUCTION_OPTIONS = {
+    'timeout': 20,  # busy_timeout, seconds
+    'transaction_mode': 'IMMEDIATE',  # take the write lock at BEGIN - no mid-transaction upgrade deadlocks
+    'init_command': (
+        'PRAGMA journal_mode=WAL;'
+        'PRAGMA synchronous=NORMAL;'
+        'PRAGMA mmap_size=268435456;'
+        'PRAGMA temp_store=MEMORY;'
+    ),
+}
+
+if ENVIRONMENT == 'production':
+    DATABASES['default'].update({
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': SQLITE_PRODUCTION_OPTIONS,
+    })
+
+# Multi-gateway mode: every gateway shares one PostgreSQL session store
+if os.getenv('SHARED_DB_HOST'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'HOST': os.getenv('SHARED_DB_HOST'),
+        'PORT': os.getenv('SHARED_DB_PORT', '5432'),
+        'NAME': os.getenv('SHARED_DB_NAME', 'wifi_billing'),
+        'USER': os.getenv('SHARED_DB_USER', 'wifi_billing'),
+        'PASSWORD': os.getenv('SHARED_DB_PASSWORD', ''),
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+    }
+
+# portal_login: queue WifiSession rows for new unpaid devices and insert them in batches
+UNPAID_SESSION_BATCHING = ENVIRONMENT == 'production'
+UNPAID_SESSION_BATCH_SIZE = 200  # Rows per INSERT
+UNPAID_SESSION_BATCH_INTERVAL = 0.05  # Seconds a row may wait for its batch
+
+
+# Payment ledger: add each payment to the hourly/daily RevenueRollup in its own transaction.
+# False only appends - run `manage.py compact_revenue --interval 60` to fold payments in batches
+REVENUE_ROLLUP_ON_WRITE = True
+
+# Usage metering (manage.py run_usage_meter) from the traffic-control rule/set counters
+USAGE_METERING_INTERVAL = 60  # Seconds between counter dumps
+USAGE_RETENTION = {'raw': 86400, '5m': 7 * 86400, '1h': 90 * 86400}  # Seconds each resolution is kept
+
+# Sessions admin for large tables: keyset pages, estimated counts, indexed-only search
+WIFISESSION_ADMIN_HIGH_VOLUME = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -139,6 +199,28 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    # {% static %} links the fingerprinted portal bundle when PORTAL_ASSETS_SERVE is on
+    'staticfiles': {'BACKEND': 'billing_app.assets.PortalAssetStorage'},
+}
+
+# Portal asset bundle: `manage.py build_portal_assets` collects what these templates reference,
+# minified, content-hashed and precompressed (.gz, plus .br with the brotli package)
+PORTAL_TEMPLATES = ['login.html', 'payment.html', 'success.html', 'error.html']
+PORTAL_ASSET_ROOT = BASE_DIR / 'portal_assets'
+PORTAL_ASSETS_SERVE = ENVIRONMENT == 'production'  # Link and serve the bundle (build it first)
+
+# Caches - multi-worker deployments need a shared backend (e.g. Redis/Memcached)
+# so every process sees plan catalog changes made through the admin
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+PLAN_CATALOG_CACHE = 'default'  # Cache alias holding the versioned PaymentPlan catalog
+PLAN_CATALOG_TTL = 60  # Seconds before every process re-reads plans, even without a shared cache
+
 # Payment settings
 STRIPE_PUBLIC_KEY = 'your-stripe-public-key'
 STRIPE_SECRET_KEY = 'your-stripe-secret-key'
@@ -147,12 +229,79 @@ STRIPE_SECRET_KEY = 'your-stripe-secret-key'
 ROUTER_IP = '10.54.22.92'
 ROUTER_USERNAME = 'admin'
 ROUTER_PASSWORD = 'admin'
+ROUTER_TIMEOUT = (2, 5)  # (connect, read) seconds per router API attempt
+ROUTER_MAX_RETRIES = 2  # Retries for connection errors / 429 / 5xx, with jittered backoff
+ROUTER_BACKOFF = 0.2  # Base backoff in seconds (doubles per retry)
+ROUTER_POOL_SIZE = 10  # Keep-alive connections kept open to the router
+ROUTER_BREAKER_THRESHOLD = 5  # Consecutive failed calls before the router is skipped
+ROUTER_BREAKER_RESET = 30  # Seconds before a skipped router is tried again
+ROUTER_BATCH_API = False  # Router accepts {"macs": [...]} on /api/whitelist/add and /remove
+ROUTER_BATCH_SIZE = 100  # MACs per batch call
 
 # Network interface settings
 NETWORK_INTERFACE = 'wlan0'  # Adjust based on your setup
 
+# Neighbor (IP -> MAC) table cache
+NEIGHBOR_TABLE_TTL = 30  # Seconds a neighbor table snapshot is trusted
+NEIGHBOR_TABLE_MIN_REFRESH = 1  # Minimum seconds between reloads triggered by misses
+# NEIGHBOR_TABLE_SOURCE = 'billing_app.neighbors.ProcNetArpSource'  # Auto-detected when unset
+
+# DHCP lease file used as the primary IP -> MAC source (None = neighbor table only)
+DHCP_LEASE_FILE = os.getenv('DHCP_LEASE_FILE')  # e.g. /var/lib/misc/dnsmasq.leases or /var/lib/dhcp/dhcpd.leases
+DHCP_LEASE_FORMAT = None  # 'dnsmasq', 'isc', or None to detect from the file
+DHCP_LEASE_POLL_INTERVAL = 1  # Seconds between stat() checks where inotify is unavailable
+
+# Authorization cache used by CaptivePortalMiddleware
+AUTH_CACHE_MAX_ENTRIES = 10000  # LRU cap on cached devices
+AUTH_CACHE_NEGATIVE_TTL = 5  # Seconds unknown/unpaid devices stay cached
+AUTH_CACHE_POSITIVE_TTL = 5  # Max seconds a paid device stays cached - how long a revocation by another process takes without GATEWAY_BUS_URL; 0 = until expires_at
+PORTAL_PROBE_REFRESH = 5  # Seconds between reloads of the paid-device set connectivity probes are answered from
+
 # Traffic control method
-TRAFFIC_CONTROL_METHOD = 'iptables'  # 'iptables', 'router_api', or 'simulation'
+TRAFFIC_CONTROL_METHOD = 'iptables'  # 'iptables', 'ipset', 'nftables', 'router_api', or 'simulation'
+CAPTIVE_PORTAL_CHAIN = 'CAPTIVE_PORTAL'  # iptables chain the paid-device rules live in
+FIREWALL_USE_SUDO = True  # Prefix firewall commands with sudo
+IPSET_MAC_SET = 'wifi_paid_macs'  # ipset method: hash:mac set of paid devices
+IPSET_IP_SET = 'wifi_paid_ips'  # ipset method: hash:ip set of paid devices
+NFT_TABLE = 'inet captive_portal'  # nftables method: table holding the paid_macs/paid_ips sets
+NFT_CLIENT_INTERFACE = 'wlan0'  # nftables method: the forward base chain drops unpaid traffic from this interface
+FIREWALL_RECONCILE_ON_STARTUP = False  # Converge firewall to active sessions when the first request arrives
+
+# Privileged helper (`manage.py run_firewall_helper`, as root) that applies iptables/ipset/nftables
+# grants and revocations without a sudo fork per rule. None = run the firewall commands directly
+FIREWALL_HELPER_SOCKET = os.getenv('FIREWALL_HELPER_SOCKET')
+FIREWALL_HELPER_WINDOW = 0.005  # Seconds the helper waits to coalesce concurrent requests into one commit
+FIREWALL_HELPER_TIMEOUT = 10  # Seconds the app waits for the helper's reply
+
+# Grants/revocations are published to this Redis stream (redis://host:6379/0 or unix:///path.sock)
+# and applied by every other gateway's `manage.py run_gateway_sync`. None = single gateway
+GATEWAY_BUS_URL = os.getenv('GATEWAY_BUS_URL')
+GATEWAY_NODE_ID = os.getenv('GATEWAY_NODE_ID')  # Unique per gateway; None = the hostname
+GATEWAY_BUS_STREAM = 'wifi:access-events'
+GATEWAY_BUS_MAXLEN = 100000  # Events kept for catch-up; a node further behind reconciles from the database
+GATEWAY_SYNC_CURSOR = BASE_DIR / 'gateway_sync.cursor'  # Last event run_gateway_sync applied
+
+# Access provisioning after payment runs on an in-process worker pool
+PROVISIONING_ASYNC = True  # False applies the grant inline in process_payment (single attempt)
+PROVISIONING_WORKERS = 4  # Worker threads per process
+PROVISIONING_MAX_ATTEMPTS = 5  # Attempts before a session is marked access_status='failed'
+PROVISIONING_RETRY_BACKOFF = 2  # Base retry delay in seconds (doubles per attempt, jittered)
+
+# Prepaid vouchers (billing_app/vouchers.py, `manage.py generate_vouchers`)
+VOUCHER_SECRET = os.getenv('VOUCHER_SECRET')  # Derives and hashes the codes; None = SECRET_KEY. Changing it voids printed codes
+VOUCHER_CODE_LENGTH = 10  # Characters per new code (5 bits each), printed as XXXXX-XXXXX
+VOUCHER_CHUNK_SIZE = 5000  # Vouchers inserted per bulk_create transaction
+VOUCHER_MAX_ATTEMPTS = 10  # Failed redemptions a device gets per window before it must wait
+VOUCHER_ATTEMPT_WINDOW = 900  # Seconds
+
+# run_expiry_scheduler listens here for new/extended session deadlines (None disables notifications)
+EXPIRY_SCHEDULER_ADDRESS = ('127.0.0.1', 8765)
+
+# /metrics (Prometheus text format) - only these peer addresses (REMOTE_ADDR, proxy headers ignored) may scrape it (None allows everyone)
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # Scrapers must send 'Authorization: Bearer <token>'; None = no token check
+METRICS_DIR = os.getenv('METRICS_DIR')  # Shared by all workers of a multi-process server; None = this process only
+METRICS_FLUSH_INTERVAL = 5  # Seconds between snapshot dumps to METRICS_DIR
 
 
 # Default primary key field type
@@ -1,13 +1,21 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
 from django.conf.urls.static import static
 
+from billing_app.assets import serve_asset
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('billing_app.urls')),
 ]
 
+# Fingerprinted portal bundle (manage.py build_portal_assets) - precompressed, cached forever.
+# Answers only with PORTAL_ASSETS_SERVE on
+urlpatterns += [
+    re_path(rf'^{settings.STATIC_URL.lstrip("/")}(?P<path>.+\.[0-9a-f]{{12}}\.\w+)$', serve_asset),
+]
+
 # Only for development – serve static files
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file